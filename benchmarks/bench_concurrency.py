@@ -0,0 +1,227 @@
+"""
+Нагрузочный тест обработки обновлений: N сотрудников одновременно заполняют отчёт.
+
+Бот запускается с настоящими обработчиками и настоящей БД SQLite во временной папке,
+а Bot API подменяется фейковым транспортом с заданной задержкой ответа. Сравниваются режимы:
+
+  sequential — обработка по одному обновлению (поведение PTB по умолчанию);
+  per-user   — PerUserUpdateProcessor: параллельно между пользователями, по порядку внутри пользователя;
+  unordered  — параллельно без блокировок (для сравнения: порядок шагов диалога не гарантирован).
+
+Сценарий --flow fields — каждое поле по отдельности (кнопка поля → число),
+--flow bulk — все числа одним сообщением.
+
+В конце проверяется изоляция пользователей в per-user: один сотрудник присылает столько медленных
+обновлений, сколько слотов параллельной обработки, и меряется задержка быстрого обновления другого сотрудника
+(она должна быть близка к нулю, а не к длительности медленного обновления).
+
+Запуск:
+    python benchmarks/bench_concurrency.py --users 200 --latency 0.02
+    python benchmarks/bench_concurrency.py --flow bulk --modes per-user
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+import warnings
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from telegram import Update
+from telegram.ext import Application, SimpleUpdateProcessor, TypeHandler
+from telegram.warnings import PTBUserWarning
+
+from fake_telegram import BOT_ID, FakeTelegramRequest, callback_update, message_update
+
+FIRST_USER_ID = 5000000
+
+
+def field_value(user_id, index):
+    return (user_id + index) % 50 + 1
+
+
+def build_updates(m, users, flow):
+    """Обновления всех сотрудников, перемешанные по шагам: шаг 1 у всех, затем шаг 2 у всех и т.д."""
+    scripts = []
+    for user_id in users:
+        steps = [("text", "📝 Отправить отчет")]
+        if flow == "bulk":
+            steps.append(("text", " ".join(str(field_value(user_id, i)) for i in range(len(m.NUMERIC_FIELDS)))))
+        else:
+            for index, (key, _) in enumerate(m.NUMERIC_FIELDS):
+                steps.append(("callback", f"field|{key}"))
+                steps.append(("text", str(field_value(user_id, index))))
+        steps.append(("callback", "action|send"))
+        scripts.append((user_id, steps))
+
+    updates = []
+    update_id = 0
+    for step in range(len(scripts[0][1])):
+        for user_id, steps in scripts:
+            kind, payload = steps[step]
+            update_id += 1
+            if kind == "text":
+                updates.append(message_update(update_id, user_id, payload))
+            else:
+                updates.append(callback_update(update_id, user_id, payload))
+    return updates
+
+
+def count_correct_reports(m, users):
+    conn = m.get_db_conn()
+    keys = [k for k, _ in m.NUMERIC_FIELDS]
+    rows = conn.execute(f"SELECT user_id, {', '.join(keys)} FROM reports").fetchall()
+    correct = 0
+    for row in rows:
+        user_id, values = row[0], row[1:]
+        if user_id in users and all(v == field_value(user_id, i) for i, v in enumerate(values)):
+            correct += 1
+    return correct
+
+
+async def run_mode(m, mode, users, latency, flow):
+    request = FakeTelegramRequest(latency)
+    builder = (
+        Application.builder()
+        .token(f"{BOT_ID}:BENCH")
+        .request(request)
+        .get_updates_request(FakeTelegramRequest(0))
+        .persistence(m.SQLitePersistence())
+    )
+    if mode == "per-user":
+        builder = builder.concurrent_updates(m.PerUserUpdateProcessor(m.MAX_CONCURRENT_UPDATES))
+    elif mode == "unordered":
+        builder = builder.concurrent_updates(SimpleUpdateProcessor(m.MAX_CONCURRENT_UPDATES))
+    application = builder.build()
+    m.register_handlers(application)
+
+    raw_updates = build_updates(m, users, flow)
+    queued_at = {}
+    latencies = []
+    done = asyncio.Event()
+
+    async def on_processed(update, context):
+        latencies.append(time.perf_counter() - queued_at[update.update_id])
+        if len(latencies) == len(raw_updates):
+            done.set()
+
+    application.add_handler(TypeHandler(Update, on_processed), group=1)
+
+    await application.initialize()
+    await application.start()
+    started = time.perf_counter()
+    for raw in raw_updates:
+        update = Update.de_json(raw, application.bot)
+        queued_at[update.update_id] = time.perf_counter()
+        await application.update_queue.put(update)
+    await done.wait()
+    elapsed = time.perf_counter() - started
+    await m.report_menu_refresher.flush_all()
+    await m.deletion_scheduler.flush_all()
+    await application.stop()
+    await application.shutdown()
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "updates": len(raw_updates),
+        "seconds": elapsed,
+        "throughput": len(raw_updates) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "api_calls": sum(request.calls.values()),
+        "edits": request.calls.get("editMessageText", 0),
+        "correct": count_correct_reports(m, users),
+    }
+
+
+async def run_isolation(m, concurrency, slow_seconds):
+    """Задержка обновления одного пользователя, пока у другого в очереди concurrency медленных обновлений."""
+    slow_user, fast_user = FIRST_USER_ID, FIRST_USER_ID + 1
+    application = (
+        Application.builder()
+        .token(f"{BOT_ID}:BENCH")
+        .request(FakeTelegramRequest(0))
+        .get_updates_request(FakeTelegramRequest(0))
+        .concurrent_updates(m.PerUserUpdateProcessor(concurrency))
+        .build()
+    )
+    fast_done = asyncio.Event()
+
+    async def handler(update, context):
+        if update.effective_user.id == slow_user:
+            await asyncio.sleep(slow_seconds)
+        else:
+            fast_done.set()
+
+    application.add_handler(TypeHandler(Update, handler))
+    await application.initialize()
+    await application.start()
+    for update_id in range(1, concurrency + 1):
+        await application.update_queue.put(Update.de_json(message_update(update_id, slow_user, "медленно"), application.bot))
+    await asyncio.sleep(0.05)   # медленные обновления успели разойтись по обработке
+    started = time.perf_counter()
+    await application.update_queue.put(Update.de_json(message_update(concurrency + 1, fast_user, "быстро"), application.bot))
+    await fast_done.wait()
+    latency = time.perf_counter() - started
+    await application.stop()
+    await application.shutdown()
+    return latency
+
+
+def reset_reports(m):
+    conn = m.get_db_conn()
+    with conn:
+        conn.execute("DELETE FROM reports")
+        conn.execute("DELETE FROM persistence_user_data")
+        conn.execute("DELETE FROM persistence_conversations")
+    m.submission_tracker.load()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200, help="сколько сотрудников заполняют отчёт одновременно")
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка ответа Bot API, секунды")
+    parser.add_argument("--flow", choices=("fields", "bulk"), default="fields", help="как сотрудники вводят числа")
+    parser.add_argument("--modes", default="sequential,per-user,unordered", help="режимы через запятую")
+    parser.add_argument("--isolation-concurrency", type=int, default=4,
+                        help="слотов параллельной обработки в проверке изоляции пользователей")
+    parser.add_argument("--isolation-slow", type=float, default=1.0,
+                        help="длительность медленного обновления в проверке изоляции, секунды")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="uzotchet-bench-")
+    os.chdir(workdir)
+    logging.disable(logging.WARNING)
+    warnings.filterwarnings("ignore", category=PTBUserWarning)
+    import UZotchet as m
+
+    m.init_db()
+    users = list(range(FIRST_USER_ID, FIRST_USER_ID + args.users))
+    for user_id in users:
+        m.add_user(user_id, f"Имя{user_id}", f"Фамилия{user_id}", f"E{user_id}", "Сотрудник")
+    m.load_caches()
+
+    print(f"Сотрудников: {args.users}, сценарий: {args.flow}, задержка Bot API: {args.latency * 1000:.0f} мс, БД: {workdir}")
+    print(f"{'режим':<12}{'обновл.':>9}{'сек':>9}{'обн/с':>9}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}"
+          f"{'API':>8}{'правки':>8}{'отчёты OK':>11}")
+    for mode in args.modes.split(","):
+        reset_reports(m)
+        r = asyncio.run(run_mode(m, mode.strip(), users, args.latency, args.flow))
+        print(f"{r['mode']:<12}{r['updates']:>9}{r['seconds']:>9.2f}{r['throughput']:>9.1f}{r['p50_ms']:>10.0f}"
+              f"{r['p95_ms']:>10.0f}{r['p99_ms']:>10.0f}{r['api_calls']:>8}{r['edits']:>8}{r['correct']:>7}/{args.users}")
+    latency = asyncio.run(run_isolation(m, args.isolation_concurrency, args.isolation_slow))
+    print(f"Изоляция per-user: {args.isolation_concurrency} медленных обновлений ({args.isolation_slow:g} с) одного "
+          f"сотрудника, задержка обновления другого: {latency * 1000:.1f} мс")
+    m.db_async.shutdown()
+    m.db_manager.close_all()
+
+
+if __name__ == "__main__":
+    main()
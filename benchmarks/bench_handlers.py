@@ -0,0 +1,252 @@
+"""
+Бенчмарк обработчиков бота: каждый сценарий вызывает настоящий обработчик с синтетическим Update
+на заполненной БД и фейковом Bot API.
+
+Для каждого сценария выводятся перцентили задержки, число SQL-запросов и вызовов Bot API на одну операцию.
+Отложенная работа (пакетное удаление сообщений, обновление меню отчёта) сбрасывается после сценария
+и засчитывается ему же. Результаты можно сохранить в JSON (--output) и сравнивать между версиями.
+
+Запуск:
+    python benchmarks/bench_handlers.py --users 500 --days 60
+    python benchmarks/bench_handlers.py --scenarios export_csv,export_xlsx --export-iterations 3
+    python benchmarks/bench_handlers.py --db /tmp/big.db   # БД из generate_data.py (бенчмарк допишет в неё отчёты за сегодня)
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import warnings
+from datetime import timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from telegram import Update
+from telegram.ext import Application, CallbackContext
+from telegram.warnings import PTBUserWarning
+
+from fake_telegram import BOT_ID, FakeTelegramRequest, callback_update, message_update
+from generate_data import populate
+
+FIRST_USER_ID = 5000000
+ADMIN_ID = 4000000
+
+
+class QueryCounter:
+    """Число выполненных SQL-запросов (кроме PRAGMA) — из метрики бота uzotchet_db_queries_total."""
+
+    def __init__(self, m):
+        self.m = m
+
+    @property
+    def count(self):
+        return self.m.DB_QUERIES.value()
+
+
+def percentile(sorted_values, pct):
+    index = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class HandlerBench:
+    def __init__(self, m, application, fake, counter, users):
+        self.m = m
+        self.application = application
+        self.fake = fake
+        self.counter = counter
+        self.users = users
+        self._update_id = 0
+
+    def update(self, raw_factory, *args):
+        self._update_id += 1
+        return Update.de_json(raw_factory(self._update_id, *args), self.application.bot)
+
+    def context(self, update):
+        return CallbackContext.from_update(update, self.application)
+
+    def user(self, i):
+        return self.users[i % len(self.users)]
+
+    async def run(self, name, iterations, prepare):
+        """prepare(i) выполняется вне замера и возвращает корутину-функцию, время которой измеряется."""
+        latencies = []
+        queries = api_calls = 0
+        for i in range(iterations):
+            call = await prepare(i)
+            q0, a0 = self.counter.count, self.fake.total_calls()
+            started = time.perf_counter()
+            await call()
+            latencies.append(time.perf_counter() - started)
+            queries += self.counter.count - q0
+            api_calls += self.fake.total_calls() - a0
+        # Отложенная работа, порождённая сценарием
+        a0 = self.fake.total_calls()
+        await self.m.report_menu_refresher.flush_all()
+        await self.m.deletion_scheduler.flush_all()
+        deferred = self.fake.total_calls() - a0
+        latencies.sort()
+        return {
+            "scenario": name,
+            "iterations": iterations,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "max_ms": latencies[-1] * 1000,
+            "queries_per_op": queries / iterations,
+            "api_per_op": (api_calls + deferred) / iterations,
+        }
+
+    # --- Сценарии ---
+    def _handler_call(self, handler, update):
+        context = self.context(update)
+        return lambda: handler(update, context)
+
+    async def start(self, i):
+        return self._handler_call(self.m.start, self.update(message_update, self.user(i), "/start"))
+
+    async def start_submit_report(self, i):
+        uid = self.user(i)
+        self.application.user_data[uid].clear()
+        return self._handler_call(self.m.start_submit_report, self.update(message_update, uid, "📝 Отправить отчет"))
+
+    async def _open_report(self, uid):
+        self.application.user_data[uid].clear()
+        update = self.update(message_update, uid, "📝 Отправить отчет")
+        await self.m.start_submit_report(update, self.context(update))
+
+    async def field_button(self, i):
+        uid = self.user(i)
+        await self._open_report(uid)
+        key = self.m.NUMERIC_FIELDS[i % len(self.m.NUMERIC_FIELDS)][0]
+        return self._handler_call(self.m.callback_report_menu, self.update(callback_update, uid, f"field|{key}"))
+
+    async def fill_field(self, i):
+        uid = self.user(i)
+        await self._open_report(uid)
+        key = self.m.NUMERIC_FIELDS[i % len(self.m.NUMERIC_FIELDS)][0]
+        update = self.update(callback_update, uid, f"field|{key}")
+        await self.m.callback_report_menu(update, self.context(update))
+        return self._handler_call(self.m.message_fill_field, self.update(message_update, uid, str(i % 20)))
+
+    async def send_report(self, i):
+        uid = self.user(i)
+        await self._open_report(uid)
+        pending = self.application.user_data[uid]['pending_report']
+        for index, (key, _) in enumerate(self.m.NUMERIC_FIELDS):
+            pending[key] = (i + index) % 10
+        return self._handler_call(self.m.callback_report_menu, self.update(callback_update, uid, "action|send"))
+
+    async def admin_stats(self, i):
+        return self._handler_call(self.m.show_admin_stats, self.update(message_update, ADMIN_ID, "📊 Статистика за сегодня"))
+
+    async def export_menu(self, i):
+        return self._handler_call(
+            self.m.download_csv_reports, self.update(message_update, ADMIN_ID, "📥 Скачать все отчеты (CSV)")
+        )
+
+    def export(self, fmt, cached=False):
+        async def prepare(i):
+            # Без кэша меряется формирование файла; с кэшем — повторная отправка по file_id
+            if not cached:
+                self.m.export_cache.clear()
+            update = self.update(message_update, ADMIN_ID, "📥 Скачать все отчеты (CSV)")
+            await self.m.download_csv_reports(update, self.context(update))
+            return self._handler_call(self.m.callback_export_menu, self.update(callback_update, ADMIN_ID, f"export|{fmt}"))
+        return prepare
+
+    async def reminders(self, i):
+        context = CallbackContext(self.application)
+        return lambda: self.m._send_reminders(context)
+
+
+async def run_benchmarks(m, args, users, counter):
+    fake = FakeTelegramRequest(args.latency)
+    application = Application.builder().token(f"{BOT_ID}:BENCH").request(fake).get_updates_request(
+        FakeTelegramRequest()).build()
+    await application.initialize()
+    bench = HandlerBench(m, application, fake, counter, users)
+    scenarios = {
+        "start": (bench.start, args.iterations),
+        "start_submit_report": (bench.start_submit_report, args.iterations),
+        "callback_report_menu/field": (bench.field_button, args.iterations),
+        "message_fill_field": (bench.fill_field, args.iterations),
+        "callback_report_menu/send": (bench.send_report, args.iterations),
+        "show_admin_stats": (bench.admin_stats, args.iterations),
+        "download_csv_reports": (bench.export_menu, args.iterations),
+        "export_csv": (bench.export("csv"), args.export_iterations),
+        "export_xlsx": (bench.export("xlsx"), args.export_iterations),
+        "export_csv/cached": (bench.export("csv", cached=True), args.iterations),
+        "_send_reminders": (bench.reminders, args.reminder_iterations),
+    }
+    selected = args.scenarios.split(",") if args.scenarios else list(scenarios)
+    results = []
+    for name in selected:
+        prepare, iterations = scenarios[name.strip()]
+        results.append(await bench.run(name.strip(), iterations, prepare))
+        r = results[-1]
+        print(f"{r['scenario']:<28}{r['iterations']:>6}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}"
+              f"{r['max_ms']:>10.2f}{r['queries_per_op']:>10.1f}{r['api_per_op']:>10.1f}")
+    await application.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200, help="сколько сотрудников в БД")
+    parser.add_argument("--days", type=int, default=30, help="за сколько прошедших дней есть отчёты")
+    parser.add_argument("--iterations", type=int, default=50, help="повторов для быстрых сценариев")
+    parser.add_argument("--export-iterations", type=int, default=3, help="повторов для выгрузок")
+    parser.add_argument("--reminder-iterations", type=int, default=3, help="повторов для рассылки напоминаний")
+    parser.add_argument("--reminder-rate", type=float, default=1_000_000,
+                        help="лимит рассылки, сообщений/с (по умолчанию фактически без лимита, чтобы мерить накладные расходы бота)")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа Bot API, секунды")
+    parser.add_argument("--scenarios", default="", help="сценарии через запятую (по умолчанию все)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db", help="готовая БД (например, из generate_data.py) вместо временной")
+    parser.add_argument("--output", help="сохранить результаты в JSON-файл")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    db_path = os.path.abspath(args.db) if args.db else None
+    workdir = tempfile.mkdtemp(prefix="uzotchet-handlers-")
+    os.chdir(workdir)
+    logging.disable(logging.WARNING)
+    warnings.filterwarnings("ignore", category=PTBUserWarning)
+    import UZotchet as m
+
+    counter = QueryCounter(m)
+    m.db_manager = m.ConnectionManager(db_path or m.DB_NAME)
+    m.ADMIN_IDS.append(ADMIN_ID)
+    # Отложенные действия не должны срабатывать посреди чужого сценария — сбрасываются явно после каждого
+    m.deletion_scheduler = m.MessageDeletionScheduler(window=3600)
+    m.report_menu_refresher = m.ReportMenuRefresher(delay=3600)
+    m.broadcast_engine = m.BroadcastEngine(rate=args.reminder_rate)
+
+    m.init_db()
+    started = time.perf_counter()
+    if not db_path:
+        today = m.local_today()
+        populate(m.get_db_conn(), m, args.users, today - timedelta(days=args.days), today - timedelta(days=1),
+                 args.seed, first_user_id=FIRST_USER_ID)
+    m.load_caches()
+    users = sorted(uid for uid, *_ in m.user_directory.all_users() if uid != ADMIN_ID)
+    reports = m.get_db_conn().execute("SELECT COUNT(*) FROM reports").fetchone()[0]
+    print(f"БД: {db_path or workdir}; сотрудников: {len(users)}, отчётов: {reports} "
+          f"(подготовлено за {time.perf_counter() - started:.1f} с); задержка Bot API: {args.latency * 1000:.0f} мс")
+    print(f"{'сценарий':<28}{'n':>6}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'max мс':>10}{'SQL/оп':>10}{'API/оп':>10}")
+    results = asyncio.run(run_benchmarks(m, args, users, counter))
+    m.db_async.shutdown()
+    m.db_manager.close_all()
+
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump({"params": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Фейковый Bot API для бенчмарков: бот работает с настоящими обработчиками, но без сети.
+
+FakeTelegramRequest подставляется в Application.builder().request(...) и отвечает правдоподобными
+объектами после заданной задержки, считая вызовы по методам API. Функции message_update/callback_update
+собирают входящие обновления в формате Bot API.
+"""
+import asyncio
+import json
+import time
+
+from telegram.request import BaseRequest
+
+BOT_ID = 1000000
+BOT_USER = {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Транспорт Bot API без сети: отвечает правдоподобными объектами после задержки latency."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self._message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def _message(self, chat_id, text=""):
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bench"},
+            "text": text or "",
+        }
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        params = request_data.parameters if request_data else {}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if endpoint == "getMe":
+            result = BOT_USER
+        elif endpoint in ("sendMessage", "editMessageText"):
+            result = self._message(params.get("chat_id", 0), params.get("text"))
+        elif endpoint == "sendDocument":
+            result = self._message(params.get("chat_id", 0))
+            result["document"] = {"file_id": f"doc{self._message_id}", "file_unique_id": f"u{self._message_id}"}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def _sender(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"U{user_id}"}
+
+
+def message_update(update_id, user_id, text):
+    """Текстовое сообщение пользователя user_id в личном чате; команды получают entity bot_command."""
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": _sender(user_id),
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def callback_update(update_id, user_id, data, message_id=None):
+    """Нажатие инлайн-кнопки с callback_data=data под сообщением бота message_id."""
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": _sender(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id or update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bench"},
+                "text": "menu",
+            },
+        },
+    }
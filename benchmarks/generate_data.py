@@ -0,0 +1,241 @@
+"""
+Генератор синтетических данных для проверки бота на производственных объёмах.
+
+Заполняет БД бота сотрудниками и их ежедневными отчётами за несколько лет: значения всех NUMERIC_FIELDS
+правдоподобны (у каждого сотрудника своя «активность», редкие операции встречаются редко), в
+provedeny_peregovory и problemy иногда есть текст. Отчёты есть только за рабочие дни (пн–пт), часть дней
+сотрудники пропускают, часть сотрудников принята на работу позже начала периода.
+
+Результат полностью определяется --seed. Загрузка идёт пачками через executemany внутри крупных
+транзакций; схема создаётся штатными миграциями бота (init_db). На время загрузки триггеры итогов
+(report_totals_*), поискового индекса (reports_fts) и счетчика изменений (data_version) снимаются, а в конце
+всё пересчитывается и триггеры создаются заново — и тогда, когда загрузка прервана исключением или Ctrl+C.
+Если процесс убит совсем, недостающие триггеры восстановит init_db при следующем запуске бота.
+
+Запуск (по умолчанию — 5000 сотрудников × 3 года в reports_bot.db текущей папки):
+    python benchmarks/generate_data.py
+    python benchmarks/generate_data.py --db /tmp/big.db --employees 500 --years 1 --seed 7
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+FIRST_USER_ID = 100000000
+
+FIRST_NAMES = [
+    "Азиз", "Алишер", "Бахтиёр", "Дильшод", "Жасур", "Фаррух", "Шерзод", "Улугбек", "Санжар", "Тимур",
+    "Анна", "Мария", "Елена", "Дилноза", "Гульнора", "Нигора", "Зарина", "Малика", "Севара", "Ольга",
+]
+LAST_NAMES = [
+    "Каримов", "Юсупов", "Рахимов", "Абдуллаев", "Исмоилов", "Турсунов", "Назаров", "Хасанов",
+    "Иванов", "Петров", "Смирнов", "Кузнецов", "Ахмедов", "Султанов", "Мирзаев", "Эргашев",
+]
+POSITIONS = [
+    ("Специалист", 45), ("Ведущий специалист", 25), ("Главный специалист", 15),
+    ("Начальник отдела", 8), ("Заместитель начальника управления", 5), ("Начальник управления", 2),
+]
+# Среднее значение поля за день у сотрудника со средней активностью
+FIELD_MEANS = {
+    "prinyato_zayavok": 4.0,
+    "protokola_na_oformlenii": 2.0,
+    "oformleno_protokolov": 1.5,
+    "dogovora_na_oformlenii": 2.0,
+    "oformleno_dogovorov": 1.2,
+    "napravleno_zaprosov_tkp": 3.0,
+    "polucheno_tkp": 2.5,
+    "napravleno_na_techzaklyuchenie": 0.8,
+    "napravleno_na_prkf": 0.5,
+    "oformleno_doverennostey": 0.3,
+    "oformlena_zayavka_el_magazin": 1.0,
+    "oformlena_zayavka_el_aukcion": 0.4,
+    "oformlena_zayavka_kooper_portal": 0.6,
+    "oformlena_zayavka_spot": 0.2,
+}
+GOODS = [
+    "кабельной продукции", "трансформаторов", "запорной арматуры", "спецодежды", "оргтехники",
+    "металлопроката", "ГСМ", "подшипников", "насосного оборудования", "лакокрасочных материалов",
+    "электродов", "строительных материалов", "запасных частей к спецтехнике", "КИПиА", "шин",
+]
+PROBLEMS = [
+    "Задержка ответа поставщика по ТКП",
+    "Не подписан протокол со стороны заказчика",
+    "Ожидаем техническое заключение",
+    "Поставщик изменил цену после торгов",
+    "Нет доступа к электронному магазину",
+    "Требуется уточнение технического задания",
+]
+NEGOTIATION_SHARE = 0.35   # доля отчётов с заполненным полем переговоров
+PROBLEM_SHARE = 0.08       # доля отчётов с заполненными «прочими вопросами»
+SKIP_DAY_SHARE = 0.06      # доля рабочих дней без отчёта (отпуск, болезнь, забыл)
+
+
+def workdays(start, end):
+    day = start
+    while day <= end:
+        if day.weekday() < 5:
+            yield day
+        day += timedelta(days=1)
+
+
+def generate_users(rng, count, first_user_id=FIRST_USER_ID):
+    positions, weights = zip(*POSITIONS)
+    users = []
+    for n in range(count):
+        users.append((
+            first_user_id + n,
+            rng.choice(FIRST_NAMES),
+            rng.choice(LAST_NAMES),
+            f"T{n + 1:06d}",
+            rng.choices(positions, weights)[0],
+        ))
+    return users
+
+
+def generate_reports(rng, users, numeric_keys, text_keys, start, end):
+    """Строки отчётов (user_id, report_date, *числа, *тексты) по сотрудникам; генератор, без материализации."""
+    days = [d.isoformat() for d in workdays(start, end)]
+    means = [FIELD_MEANS.get(key, 1.0) for key in numeric_keys]
+    has_negotiations = "provedeny_peregovory" in text_keys
+    has_problems = "problemy" in text_keys
+    for user_id, *_ in users:
+        activity = rng.uniform(0.3, 2.0)
+        field_means = [m * activity for m in means]
+        # Часть сотрудников принята на работу в течение периода
+        first_day = rng.randrange(len(days) // 3) if rng.random() < 0.3 else 0
+        random_ = rng.random
+        for report_date in days[first_day:]:
+            if random_() < SKIP_DAY_SHARE:
+                continue
+            # Сумма двух равномерных величин: треугольное распределение со средним m, дёшево и без отрицательных
+            numbers = [int(m * (random_() + random_()) + 0.5) for m in field_means]
+            texts = []
+            for key in text_keys:
+                if key == "provedeny_peregovory" and has_negotiations and random_() < NEGOTIATION_SHARE:
+                    texts.append(f"Переговоры по поставке {rng.choice(GOODS)}")
+                elif key == "problemy" and has_problems and random_() < PROBLEM_SHARE:
+                    texts.append(rng.choice(PROBLEMS))
+                else:
+                    texts.append("")
+            yield (user_id, report_date, *numbers, *texts)
+
+
+def populate(conn, m, employees, start, end, seed, batch_size=20000, commit_every=500000,
+             first_user_id=FIRST_USER_ID, progress=None):
+    """Заполняет БД; возвращает (число сотрудников, число отчётов)."""
+    rng = random.Random(seed)
+    numeric_keys = [k for k, _ in m.NUMERIC_FIELDS]
+    text_keys = [k for k, _ in m.TEXT_FIELDS]
+    columns = ["user_id", "report_date"] + numeric_keys + text_keys
+    insert_report = f"INSERT INTO reports ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+
+    users = generate_users(rng, employees, first_user_id)
+    total = 0
+    conn.execute("BEGIN")
+    # Итоги по периодам и поисковый индекс строятся одним проходом в конце — триггеры на каждую строку в разы медленнее
+    cur = conn.cursor()
+    m.drop_report_totals_triggers(cur)
+    m.drop_reports_fts_triggers(cur)
+    m.drop_data_version_triggers(cur)
+    try:
+        conn.executemany(
+            "INSERT INTO users (user_id, first_name, last_name, employee_id, position) VALUES (?, ?, ?, ?, ?)", users
+        )
+        batch = []
+        since_commit = 0
+        for row in generate_reports(rng, users, numeric_keys, text_keys, start, end):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                conn.executemany(insert_report, batch)
+                total += len(batch)
+                since_commit += len(batch)
+                batch = []
+                if since_commit >= commit_every:
+                    conn.execute("COMMIT")
+                    conn.execute("BEGIN")
+                    since_commit = 0
+                if progress:
+                    progress(total)
+        if batch:
+            conn.executemany(insert_report, batch)
+            total += len(batch)
+    except BaseException:
+        # Незакоммиченная пачка отбрасывается; уже закоммиченные строки остаются, итоги пересчитываются ниже
+        conn.rollback()
+        conn.execute("BEGIN")
+        raise
+    finally:
+        m.rebuild_report_totals(cur)
+        m.create_report_totals_triggers(cur)
+        m.rebuild_reports_fts(cur)
+        m.create_reports_fts_triggers(cur)
+        m.create_data_version_triggers(cur)
+        m.bump_data_version(cur)
+        conn.execute("COMMIT")
+    return len(users), total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default="reports_bot.db", help="файл БД (будет создан при необходимости)")
+    parser.add_argument("--employees", type=int, default=5000)
+    parser.add_argument("--years", type=float, default=3.0, help="глубина истории отчётов в годах")
+    parser.add_argument("--end", type=date.fromisoformat, default=None,
+                        help="последний день с отчётами, ГГГГ-ММ-ДД (по умолчанию вчера)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--batch-size", type=int, default=20000, help="строк в одном executemany")
+    parser.add_argument("--commit-every", type=int, default=500000, help="строк в одной транзакции")
+    parser.add_argument("--force", action="store_true", help="дописать данные, даже если в БД уже есть отчёты")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    import UZotchet as m
+
+    m.db_manager = m.ConnectionManager(os.path.abspath(args.db))
+    m.init_db()
+    conn = m.get_db_conn()
+    existing = conn.execute("SELECT COUNT(*) FROM reports").fetchone()[0]
+    if existing and not args.force:
+        print(f"В {args.db} уже есть {existing} отчётов. Используйте --force, чтобы дописать данные, или другой --db.")
+        return 1
+    conflict = conn.execute(
+        "SELECT COUNT(*) FROM users WHERE user_id BETWEEN ? AND ?",
+        (FIRST_USER_ID, FIRST_USER_ID + args.employees - 1)
+    ).fetchone()[0]
+    if conflict:
+        print(f"В {args.db} уже есть сгенерированные сотрудники; укажите другой --db.")
+        return 1
+
+    end = args.end or (m.local_today() - timedelta(days=1))
+    start = end - timedelta(days=int(args.years * 365))
+    # На время загрузки не ждём fsync после каждой транзакции — при сбое данные просто генерируются заново
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA cache_size=-262144")
+
+    started = time.perf_counter()
+
+    def progress(total):
+        elapsed = time.perf_counter() - started
+        print(f"\r  загружено отчётов: {total:,} ({total / elapsed:,.0f} строк/с)", end="", flush=True)
+
+    print(f"Генерация: {args.employees} сотрудников, {start} — {end}, seed={args.seed} → {args.db}")
+    employees, reports = populate(
+        conn, m, args.employees, start, end, args.seed,
+        batch_size=args.batch_size, commit_every=args.commit_every, progress=progress,
+    )
+    conn.execute("ANALYZE")
+    elapsed = time.perf_counter() - started
+    print(f"\nГотово: {employees} сотрудников, {reports:,} отчётов за {elapsed:.1f} с "
+          f"({reports / elapsed:,.0f} строк/с), размер БД {os.path.getsize(args.db) / 2**20:.0f} МБ")
+    m.db_manager.close_all()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
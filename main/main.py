@@ -5,14 +5,41 @@ import sqlite3
 import csv
 import io
 from datetime import date
+from datetime import datetime
 from datetime import time
+from datetime import timedelta
+from dataclasses import dataclass
+import argparse
 import asyncio
+import bisect
+import contextvars
+import functools
+import gzip
+import hashlib
+import hmac
+import html
+import json
+import threading
 import warnings
 import os
+import pickle
+import re
+import secrets
+import shutil
+import signal
+import sys
+import tempfile
+import zipfile
+from time import monotonic, perf_counter, sleep
+from xml.sax.saxutils import escape as xml_escape
 import pytz
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 from telegram import Update, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -20,6 +47,9 @@ from telegram.ext import (
     ConversationHandler,
     MessageHandler,
     CallbackQueryHandler,
+    BaseUpdateProcessor,
+    BasePersistence,
+    PersistenceInput,
     filters,
 )
 
@@ -36,9 +66,36 @@ ADMIN_IDS_STR = os.getenv("ADMIN_IDS", "")
 ADMIN_IDS = [int(admin_id) for admin_id in ADMIN_IDS_STR.split(',') if admin_id]
 # Часовой пояс из .env файла
 TIMEZONE_STR = os.getenv("TIMEZONE", "UTC")
+try:
+    TIMEZONE = pytz.timezone(TIMEZONE_STR)
+except pytz.UnknownTimeZoneError:
+    TIMEZONE = None  # Ошибка выводится в лог при запуске в main()
 
 # Название файла базы данных
 DB_NAME = 'reports_bot.db'
+# Запросы дольше этого порога (мс) пишутся в лог вместе с планом выполнения; 0 отключает журнал медленных запросов
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "100"))
+# Резервные копии БД: папка, сколько последних копий хранить и сжимать ли их gzip
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_COMPRESS = os.getenv("BACKUP_COMPRESS", "1").strip().lower() not in ("0", "false", "no")
+# Интервал автоматического копирования в часах (0 отключает расписание, /backup работает всегда)
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "24"))
+# Чат, куда отправляются копии по расписанию; без него копии остаются только на диске сервера
+BACKUP_CHAT_ID = os.getenv("BACKUP_CHAT_ID")
+
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+# Публичный адрес сервиса для вебхука; на Render подставляется автоматически через RENDER_EXTERNAL_URL
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or os.getenv("RENDER_EXTERNAL_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Секрет, который Telegram передаёт в заголовке X-Telegram-Bot-Api-Secret-Token (если не задан — генерируется при запуске)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))
+# Эндпоинт метрик Prometheus (/metrics); по умолчанию доступен только локально, METRICS_PORT=0 отключает его
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
 
 # Включаем логирование
 logging.basicConfig(
@@ -58,8 +115,9 @@ logger = logging.getLogger(__name__)
     AWAIT_REGISTRATION_START, REGISTER_NAME, REGISTER_LAST_NAME, REGISTER_EMPLOYEE_ID, REGISTER_POSITION,
     CONFIRM_EDIT,
     DELETE_USER_PROMPT, DELETE_USER_CONFIRM,
-    SHOW_REPORT_MENU, AWAITING_FIELD_VALUE
-) = range(10)
+    SHOW_REPORT_MENU, AWAITING_FIELD_VALUE, AWAITING_BULK_VALUES,
+    EXPORT_MENU, EXPORT_AWAIT_PERIOD, EXPORT_AWAIT_EMPLOYEE_IDS
+) = range(14)
 
 # --- Определяем поля (ключи — для БД/кода; значения — отображаемые подписи) ---
 NUMERIC_FIELDS = [
@@ -107,1266 +165,2130 @@ FULL_FIELD_LABELS = {
     "problemy": "Прочие вопросы",
 }
 
-def get_db_conn():
-    return sqlite3.connect(DB_NAME)
+# --- Метрики ---
+# Собственная минимальная реализация формата Prometheus: счётчики и гистограммы с фиксированными
+# корзинами. Запись — словарь + bisect под блокировкой, поэтому метрики можно не выключать.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
 
-def is_pending_approval(user_id):
-    """Проверяет, находится ли пользователь в списке ожидания."""
-    with get_db_conn() as conn:
-        return conn.cursor().execute("SELECT 1 FROM pending_users WHERE user_id = ?", (user_id,)).fetchone() is not None
 
-# --- 2. РАБОТА С БАЗОЙ ДАННЫХ (SQLite) ---
+def _format_labels(names, values, extra=""):
+    pairs = [n + '="' + str(v).replace("\\", "\\\\").replace('"', '\\"') + '"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
 
-def init_db():
-    """Инициализирует базу данных и создает таблицы, если их нет."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cur = conn.cursor()
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                first_name TEXT,
-                last_name TEXT,
-                employee_id TEXT UNIQUE,
-                position TEXT,
-                is_registered BOOLEAN DEFAULT 1
-            )
-        ''')
-        # Создаём таблицу reports с базовыми колонками
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS reports (
-                report_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                report_date DATE
-                -- далее динамически добавим остальные столбцы
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Gauge:
+    """Значение, которое снимается функцией в момент запроса метрик."""
+
+    def __init__(self, name, help_text, func=None):
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        if self.func is not None:
+            try:
+                lines.append(f"{self.name} {self.func()}")
+            except Exception as e:
+                logger.warning(f"Не удалось получить значение метрики {self.name}: {e}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}   # label_values -> [счётчики по корзинам (+Inf последней), сумма]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1])) for k, v in self._series.items())
+        for label_values, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = 'le="' + str(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, label_values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, label_values)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, label_values)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+HANDLER_DURATION = metrics.register(Histogram(
+    "uzotchet_handler_duration_seconds", "Время работы обработчика", ("handler",)))
+HANDLER_ERRORS = metrics.register(Counter(
+    "uzotchet_handler_errors_total", "Исключения в обработчиках", ("handler",)))
+UPDATE_DURATION = metrics.register(Histogram(
+    "uzotchet_update_duration_seconds", "Время обработки одного обновления"))
+UPDATE_DB_QUERIES = metrics.register(Histogram(
+    "uzotchet_update_db_queries", "SQL-запросов на одно обновление", buckets=COUNT_BUCKETS))
+UPDATE_DB_SECONDS = metrics.register(Histogram(
+    "uzotchet_update_db_seconds", "Время работы с БД на одно обновление"))
+DB_QUERIES = metrics.register(Counter(
+    "uzotchet_db_queries_total", "Выполненные SQL-операторы"))
+DB_SLOW_QUERIES = metrics.register(Counter(
+    "uzotchet_db_slow_queries_total", "SQL-запросы дольше порога DB_SLOW_QUERY_MS"))
+DB_CALL_DURATION = metrics.register(Histogram(
+    "uzotchet_db_call_duration_seconds", "Время выполнения функций работы с БД в потоках", ("function",)))
+BOT_API_DURATION = metrics.register(Histogram(
+    "uzotchet_bot_api_duration_seconds", "Время запроса к Bot API", ("method",)))
+BOT_API_CALLS = metrics.register(Counter(
+    "uzotchet_bot_api_calls_total", "Запросы к Bot API по методу и HTTP-коду", ("method", "code")))
+BOT_API_ERRORS = metrics.register(Counter(
+    "uzotchet_bot_api_errors_total", "Ошибки запросов к Bot API (HTTP >= 400 или сетевые)", ("method", "error")))
+JOB_DURATION = metrics.register(Histogram(
+    "uzotchet_job_duration_seconds", "Время выполнения задач job_queue", ("job",)))
+JOB_FAILURES = metrics.register(Counter(
+    "uzotchet_job_failures_total", "Задачи job_queue, завершившиеся исключением", ("job",)))
+EXPORT_CACHE_REQUESTS = metrics.register(Counter(
+    "uzotchet_export_cache_requests_total", "Выгрузки: повторная отправка по file_id (hit) или новый файл (miss)", ("result",)))
+UPDATE_QUEUE_SIZE = metrics.register(Gauge(
+    "uzotchet_update_queue_size", "Обновлений в очереди на обработку"))
+BACKUP_LAST_SUCCESS = metrics.register(Gauge(
+    "uzotchet_backup_last_success_timestamp_seconds", "Время последней успешной резервной копии БД (unix)"))
+
+
+class UpdateMetrics:
+    """Счётчики, относящиеся к обработке одного обновления (живут в contextvar)."""
+    __slots__ = ("queries", "db_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+current_update_metrics = contextvars.ContextVar("current_update_metrics", default=None)
+
+
+def count_sql_statement(sql):
+    """Учитывает выполненный запрос (кроме PRAGMA) в метриках. Вызывается курсором на каждый execute:
+    trace callback SQLite для этого не подходит — он срабатывает и на внутренние запросы триггеров и FTS5."""
+    if sql[:6].upper() == "PRAGMA":
+        return
+    DB_QUERIES.inc()
+    stats = current_update_metrics.get()
+    if stats is not None:
+        stats.queries += 1
+
+
+def instrument_callback(callback, histogram=HANDLER_DURATION, errors=HANDLER_ERRORS):
+    """Оборачивает корутину-обработчик: время работы и исключения по имени функции."""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        started = perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception:
+            errors.inc(name)
+            raise
+        finally:
+            histogram.observe(perf_counter() - started, name)
+
+    wrapper.instrumented = True
+    return wrapper
+
+
+def instrument_job(callback):
+    return instrument_callback(callback, histogram=JOB_DURATION, errors=JOB_FAILURES)
+
+
+def instrument_handlers(application):
+    """Оборачивает колбэки всех зарегистрированных обработчиков, включая вложенные в ConversationHandler."""
+    def walk(handlers):
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler):
+                walk(handler.entry_points)
+                for state_handlers in handler.states.values():
+                    walk(state_handlers)
+                walk(handler.fallbacks)
+            elif not getattr(handler.callback, "instrumented", False):
+                handler.callback = instrument_callback(handler.callback)
+
+    for group_handlers in application.handlers.values():
+        walk(group_handlers)
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, который считает вызовы Bot API, их длительность и ошибки по методам."""
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        started = perf_counter()
+        try:
+            code, payload = await super().do_request(
+                url, method, request_data=request_data, read_timeout=read_timeout,
+                write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout,
             )
-        ''')
-        # Создаём таблицу для ожидающих подтверждения пользователей
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS pending_users (
-                user_id INTEGER PRIMARY KEY,
-                requested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        except Exception as e:
+            BOT_API_ERRORS.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            BOT_API_DURATION.observe(perf_counter() - started, api_method)
+        BOT_API_CALLS.inc(api_method, str(code))
+        if code >= 400:
+            BOT_API_ERRORS.inc(api_method, str(code))
+        return code, payload
+
+# --- 2. РАБОТА С БАЗОЙ ДАННЫХ (SQLite) ---
+
+# Настройки соединения: WAL позволяет читать во время записи (например, во время выгрузки CSV),
+# synchronous=NORMAL в режиме WAL убирает fsync на каждый коммит, сохраняя целостность БД.
+DB_BUSY_TIMEOUT_MS = 5000
+DB_PRAGMAS = (
+    ("synchronous", "NORMAL"),
+    ("busy_timeout", DB_BUSY_TIMEOUT_MS),
+    ("cache_size", -16000),       # ~16 МБ страничного кэша на соединение
+    ("mmap_size", 128 * 1024 * 1024),
+    ("temp_store", "MEMORY"),
+)
+
+
+# --- Журнал медленных запросов ---
+DB_QUERY_STATS_TOP = 10       # сколько самых затратных запросов показывать в /dbstats и в логе при остановке
+SQL_PARAMS_LOG_LIMIT = 300    # символов из параметров запроса в логе
+_SQL_WHITESPACE_RE = re.compile(r"\s+")
+_SQL_PLACEHOLDER_LIST_RE = re.compile(r"\?(?:\s*,\s*\?)+")
+_SQL_EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize_sql(sql):
+    """Схлопывает пробелы и списки плейсхолдеров IN (?, ?, ...), чтобы один и тот же запрос с разным
+    числом параметров попадал в одну строку статистики."""
+    return _SQL_PLACEHOLDER_LIST_RE.sub("?, …", _SQL_WHITESPACE_RE.sub(" ", sql).strip())
+
+
+class QueryStats:
+    """
+    Статистика SQL-запросов: число вызовов, суммарное и максимальное время по каждому тексту запроса.
+    Запросы дольше threshold секунд пишутся в лог с параметрами и EXPLAIN QUERY PLAN
+    (план снимается один раз на текст запроса и кэшируется).
+
+    Время — это время execute(): для запросов с сортировкой или агрегатами в него входит почти вся работа,
+    а построчное чтение результата (например, потоковая выгрузка) не учитывается.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self._stats = {}   # normalized sql -> [вызовы, суммарное время, максимальное время]
+        self._plans = {}
+        self._lock = threading.Lock()
+
+    def record(self, conn, sql, parameters, elapsed):
+        key = normalize_sql(sql)
+        count_sql_statement(key)
+        with self._lock:
+            entry = self._stats.get(key)
+            if entry is None:
+                entry = self._stats[key] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += elapsed
+            if elapsed > entry[2]:
+                entry[2] = elapsed
+        if self.threshold and elapsed >= self.threshold:
+            DB_SLOW_QUERIES.inc()
+            params = repr(parameters)
+            if len(params) > SQL_PARAMS_LOG_LIMIT:
+                params = params[:SQL_PARAMS_LOG_LIMIT] + "…"
+            logger.warning(
+                f"Медленный запрос: {elapsed * 1000:.1f} мс\n  SQL: {key}\n  Параметры: {params}\n"
+                f"  План:\n{self.plan(conn, key, sql, parameters)}"
             )
-        ''')
-        conn.commit()
 
-        # --- Проверка и добавление столбца 'position' в таблицу 'users' ---
-        cur.execute("PRAGMA table_info(users)")
-        user_cols = {row[1] for row in cur.fetchall()}
-        if 'position' not in user_cols:
+    def plan(self, conn, key, sql, parameters):
+        plan = self._plans.get(key)
+        if plan is None and not key.upper().startswith(_SQL_EXPLAINABLE):
+            plan = "    (не строится для этого типа запроса)"
+        elif plan is None:
             try:
-                cur.execute('ALTER TABLE users ADD COLUMN position TEXT')
-                logger.info("Добавлен столбец 'position' в таблицу 'users'")
-            except Exception as e:
-                logger.exception(f"Не удалось добавить столбец 'position' в таблицу 'users': {e}")
+                rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+                plan = "\n".join(f"    {detail}" for _, _, _, detail in rows) or "    (пусто)"
+            except sqlite3.Error as e:
+                plan = f"    (план недоступен: {e})"
+            self._plans[key] = plan
+        return plan
+
+    def top(self, limit=DB_QUERY_STATS_TOP):
+        """[(sql, вызовы, суммарное время, среднее, максимум)] по убыванию суммарного времени."""
+        with self._lock:
+            items = [(sql, calls, total, total / calls, slowest) for sql, (calls, total, slowest) in self._stats.items()]
+        items.sort(key=lambda item: item[2], reverse=True)
+        return items[:limit]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self._plans.clear()
+
+    def log_summary(self, limit=DB_QUERY_STATS_TOP):
+        top = self.top(limit)
+        if not top:
+            return
+        lines = [f"{total * 1000:10.1f} мс  {calls:>8} выз.  ср. {avg * 1000:.2f} мс  макс. {slowest * 1000:.1f} мс  {sql}"
+                 for sql, calls, total, avg, slowest in top]
+        logger.info("Самые затратные SQL-запросы:\n" + "\n".join(lines))
 
-        # Получим текущие колонки таблицы reports
-        cur.execute("PRAGMA table_info(reports)")
-        existing_cols = {row[1] for row in cur.fetchall()}
 
-        # Нужно добавить user meta и все поля
-        required_cols = {
-            "user_id": "INTEGER",
-            "report_date": "DATE",
-        }
+query_stats = QueryStats(DB_SLOW_QUERY_MS / 1000)
 
-        for key, _ in ALL_FIELDS:
-            # все числовые — INTEGER, текстовые — TEXT
-            required_cols[key] = "INTEGER" if key in dict(NUMERIC_FIELDS) else "TEXT"
 
-        # Добавляем отсутствующие колонки
-        for col, col_type in required_cols.items():
-            if col not in existing_cols:
-                try:
-                    cur.execute(f'ALTER TABLE reports ADD COLUMN {col} {col_type}')
-                    logger.info(f"Добавлен столбец {col} {col_type} в таблицу reports")
-                except Exception as e:
-                    logger.exception(f"Не удалось добавить столбец {col}: {e}")
+class TracingCursor(sqlite3.Cursor):
+    """Курсор, замеряющий время каждого execute/executemany для query_stats."""
+
+    def execute(self, sql, parameters=()):
+        started = perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            query_stats.record(self.connection, sql, parameters, perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            # План строится по первому набору параметров, если они переданы списком
+            sample = seq_of_parameters[0] if isinstance(seq_of_parameters, (list, tuple)) and seq_of_parameters else ()
+            query_stats.record(self.connection, sql, sample, perf_counter() - started)
+
+
+class TracingConnection(sqlite3.Connection):
+    """Соединение, у которого execute/executemany/cursor() работают через TracingCursor."""
+
+    def cursor(self, factory=TracingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class ConnectionManager:
+    """
+    Держит долгоживущие соединения с БД вместо открытия нового на каждый запрос.
+    Соединение создаётся один раз на поток (sqlite3 не любит делить соединение между потоками)
+    и переиспользуется всеми функциями работы с БД.
+    """
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._wal_enabled = False
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_name, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False, factory=TracingConnection
+        )
+        with self._lock:
+            if not self._wal_enabled:
+                # journal_mode=WAL сохраняется в самом файле БД, достаточно выставить один раз
+                mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+                if mode.lower() != "wal":
+                    logger.warning(f"Не удалось включить режим WAL для {self.db_name}, текущий режим: {mode}")
+                self._wal_enabled = True
+            self._connections.append(conn)
+        for pragma, value in DB_PRAGMAS:
+            conn.execute(f"PRAGMA {pragma}={value}")
+        return conn
+
+    def get(self):
+        """Возвращает соединение текущего потока, открывая его при первом обращении."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    def close_all(self):
+        """Закрывает все открытые соединения (вызывается при остановке бота)."""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                logger.warning(f"Ошибка при закрытии соединения с БД: {e}")
+        self._local = threading.local()
+
+
+db_manager = ConnectionManager(DB_NAME)
+
+def local_today():
+    """Текущая дата в часовом поясе TIMEZONE: отчеты привязаны к рабочему дню сотрудников, а не сервера."""
+    return datetime.now(TIMEZONE or pytz.utc).date()
+
+def get_db_conn():
+    """
+    Возвращает долгоживущее соединение текущего потока.
+    Использование `with get_db_conn() as conn:` открывает транзакцию и коммитит её на выходе,
+    но соединение при этом не закрывается.
+    """
+    return db_manager.get()
+
+# --- Миграции схемы БД ---
+# Каждая миграция — функция, получающая курсор внутри открытой транзакции.
+# Миграции применяются строго по возрастанию версии и только один раз; номер применённой
+# версии хранится в таблице schema_version. Новые изменения схемы (в том числе новые поля отчёта)
+# нужно добавлять новой миграцией в конец списка MIGRATIONS, а не править существующие.
+
+def _migration_base_schema(cur):
+    """Базовые таблицы; для старых БД добавляет недостающие столбцы."""
+    report_cols = ",\n".join(
+        f"{key} {'INTEGER' if key in dict(NUMERIC_FIELDS) else 'TEXT'}" for key, _ in ALL_FIELDS
+    )
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            first_name TEXT,
+            last_name TEXT,
+            employee_id TEXT UNIQUE,
+            position TEXT,
+            is_registered BOOLEAN DEFAULT 1
+        )
+    ''')
+    cur.execute(f'''
+        CREATE TABLE IF NOT EXISTS reports (
+            report_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            report_date DATE,
+            {report_cols}
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS pending_users (
+            user_id INTEGER PRIMARY KEY,
+            requested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # БД, созданные до появления миграций, могут не содержать части столбцов
+    cur.execute("PRAGMA table_info(users)")
+    if 'position' not in {row[1] for row in cur.fetchall()}:
+        cur.execute('ALTER TABLE users ADD COLUMN position TEXT')
+        logger.info("Добавлен столбец 'position' в таблицу 'users'")
+
+    cur.execute("PRAGMA table_info(reports)")
+    existing_cols = {row[1] for row in cur.fetchall()}
+    for key, _ in ALL_FIELDS:
+        if key not in existing_cols:
+            col_type = "INTEGER" if key in dict(NUMERIC_FIELDS) else "TEXT"
+            cur.execute(f'ALTER TABLE reports ADD COLUMN {key} {col_type}')
+            logger.info(f"Добавлен столбец {key} {col_type} в таблицу reports")
+
+def _migration_unique_report_per_day(cur):
+    """Один отчет на пользователя в день: удаляет старые дубликаты и создает UNIQUE-индекс."""
+    cur.execute('''
+        DELETE FROM reports
+        WHERE report_id NOT IN (
+            SELECT MAX(report_id) FROM reports GROUP BY user_id, report_date
+        )
+    ''')
+    if cur.rowcount:
+        logger.warning(f"Удалено {cur.rowcount} дублирующихся отчетов (оставлены последние версии)")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_reports_user_date ON reports(user_id, report_date)")
+
+def _migration_report_date_index(cur):
+    """Индекс для выборок отчетов за день/период."""
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_reports_date ON reports(report_date)")
+
+def _migration_report_revision(cur):
+    """Счетчик правок отчета: 0 — отчет только что создан, >0 — сколько раз его обновляли."""
+    cur.execute("ALTER TABLE reports ADD COLUMN revision INTEGER NOT NULL DEFAULT 0")
+
+def _migration_persistence_tables(cur):
+    """Таблицы для сохранения user_data, chat_data и состояний диалогов между перезапусками."""
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS persistence_user_data (
+            user_id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS persistence_chat_data (
+            chat_id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS persistence_conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state BLOB NOT NULL,
+            PRIMARY KEY (name, key)
+        )
+    ''')
+
+# Сводные итоги по периодам. Начало периода — дата: день, понедельник ISO-недели или 1-е число месяца.
+SUMMARY_PERIOD_SQL = {
+    "day": "date({col})",
+    "week": "date({col}, '-' || ((CAST(strftime('%w', {col}) AS INTEGER) + 6) % 7) || ' days')",
+    "month": "date({col}, 'start of month')",
+}
+REPORT_TOTALS_TRIGGERS = ("trg_reports_totals_insert", "trg_reports_totals_delete", "trg_reports_totals_update")
+
+def _summary_upsert_sql(table, period, ref, sign):
+    """UPSERT строки итогов для строки отчета ref (NEW/OLD); sign=-1 вычитает ее вклад."""
+    keys = [k for k, _ in NUMERIC_FIELDS]
+    period_start = SUMMARY_PERIOD_SQL[period].format(col=f"{ref}.report_date")
+    per_user = table == "report_totals_user"
+    cols = ["period", "period_start"] + (["user_id"] if per_user else []) + ["reports"] + keys
+    minus = "-" if sign < 0 else ""
+    values = [f"'{period}'", period_start] + ([f"{ref}.user_id"] if per_user else []) + [f"{sign}"]
+    values += [f"{minus}COALESCE({ref}.{k}, 0)" for k in keys]
+    conflict = "period, period_start, user_id" if per_user else "period, period_start"
+    updates = ", ".join(f"{c} = {c} + excluded.{c}" for c in ["reports"] + keys)
+    # Форма INSERT ... SELECT ... WHERE: отчеты без даты или пользователя в итоги не попадают
+    return (
+        f"INSERT INTO {table} ({', '.join(cols)}) SELECT {', '.join(values)} "
+        f"WHERE {period_start} IS NOT NULL AND {ref}.user_id IS NOT NULL "
+        f"ON CONFLICT({conflict}) DO UPDATE SET {updates};"
+    )
+
+def _summary_trigger_body(ref, sign):
+    return "\n".join(
+        _summary_upsert_sql(table, period, ref, sign)
+        for table in ("report_totals_user", "report_totals_company") for period in SUMMARY_PERIOD_SQL
+    )
+
+def _migration_report_totals(cur):
+    """
+    Таблицы итогов по дням, ISO-неделям и месяцам (по сотрудникам и по компании).
+    Триггеры на reports обновляют итоги в той же транзакции, что и сохранение/правку отчета.
+    """
+    keys = [k for k, _ in NUMERIC_FIELDS]
+    field_cols = "".join(f"{k} INTEGER NOT NULL DEFAULT 0,\n" for k in keys)
+    cur.execute(f'''
+        CREATE TABLE IF NOT EXISTS report_totals_user (
+            period TEXT NOT NULL,
+            period_start DATE NOT NULL,
+            user_id INTEGER NOT NULL,
+            reports INTEGER NOT NULL DEFAULT 0,
+            {field_cols}
+            PRIMARY KEY (period, period_start, user_id)
+        ) WITHOUT ROWID
+    ''')
+    cur.execute(f'''
+        CREATE TABLE IF NOT EXISTS report_totals_company (
+            period TEXT NOT NULL,
+            period_start DATE NOT NULL,
+            reports INTEGER NOT NULL DEFAULT 0,
+            {field_cols}
+            PRIMARY KEY (period, period_start)
+        ) WITHOUT ROWID
+    ''')
+
+    rebuild_report_totals(cur)
+    create_report_totals_triggers(cur)
+
+def rebuild_report_totals(cur):
+    """
+    Пересчитывает таблицы итогов по таблице reports целиком (для миграции и массовой загрузки).
+    Учитываются только отчеты зарегистрированных сотрудников, как и в выгрузках (JOIN users).
+    """
+    keys = [k for k, _ in NUMERIC_FIELDS]
+    cur.execute("DELETE FROM report_totals_user")
+    cur.execute("DELETE FROM report_totals_company")
+    sums = ", ".join(f"SUM(COALESCE({k}, 0))" for k in keys)
+    for period, expr in SUMMARY_PERIOD_SQL.items():
+        period_start = expr.format(col="report_date")
+        valid = f"{period_start} IS NOT NULL AND user_id IN (SELECT user_id FROM users)"
+        cur.execute(
+            f"INSERT INTO report_totals_user (period, period_start, user_id, reports, {', '.join(keys)}) "
+            f"SELECT '{period}', {period_start}, user_id, COUNT(*), {sums} FROM reports WHERE {valid} GROUP BY 2, 3"
+        )
+        cur.execute(
+            f"INSERT INTO report_totals_company (period, period_start, reports, {', '.join(keys)}) "
+            f"SELECT '{period}', {period_start}, COUNT(*), {sums} FROM reports WHERE {valid} GROUP BY 2"
+        )
+
+def drop_report_totals_triggers(cur):
+    """Снимает триггеры итогов: массовая загрузка без них заметно быстрее, после нее нужны
+    rebuild_report_totals и create_report_totals_triggers."""
+    for name in REPORT_TOTALS_TRIGGERS:
+        cur.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+def create_report_totals_triggers(cur):
+    keys = [k for k, _ in NUMERIC_FIELDS]
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_reports_totals_insert AFTER INSERT ON reports BEGIN\n"
+                f"{_summary_trigger_body('NEW', 1)}\nEND")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_reports_totals_delete AFTER DELETE ON reports BEGIN\n"
+                f"{_summary_trigger_body('OLD', -1)}\nEND")
+    watched = ", ".join(["user_id", "report_date"] + keys)
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_reports_totals_update AFTER UPDATE OF {watched} ON reports BEGIN\n"
+                f"{_summary_trigger_body('OLD', -1)}\n{_summary_trigger_body('NEW', 1)}\nEND")
+
+# Полнотекстовый индекс по текстовым полям отчета (external content: текст хранится только в reports)
+REPORTS_FTS_TRIGGERS = ("trg_reports_fts_insert", "trg_reports_fts_delete", "trg_reports_fts_update")
+
+def _reports_fts_sql(ref, delete=False):
+    """Добавляет (или удаляет командой 'delete') строку ref в reports_fts."""
+    text_keys = [k for k, _ in TEXT_FIELDS]
+    values = ", ".join(f"{ref}.{k}" for k in text_keys)
+    if delete:
+        return f"INSERT INTO reports_fts (reports_fts, rowid, {', '.join(text_keys)}) VALUES ('delete', {ref}.report_id, {values});"
+    return f"INSERT INTO reports_fts (rowid, {', '.join(text_keys)}) VALUES ({ref}.report_id, {values});"
+
+def _migration_reports_fts(cur):
+    """FTS5-индекс по TEXT_FIELDS (переговоры, прочие вопросы), синхронизируемый триггерами."""
+    text_keys = [k for k, _ in TEXT_FIELDS]
+    cur.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS reports_fts USING fts5({', '.join(text_keys)}, "
+        f"content='reports', content_rowid='report_id', "
+        f"tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+    )
+    rebuild_reports_fts(cur)
+    create_reports_fts_triggers(cur)
+
+def rebuild_reports_fts(cur):
+    """Заново заполняет reports_fts по таблице reports (миграция, массовая загрузка, восстановление индекса)."""
+    cur.execute("INSERT INTO reports_fts (reports_fts) VALUES ('rebuild')")
+    cur.execute("INSERT INTO reports_fts (reports_fts) VALUES ('optimize')")
+
+def drop_reports_fts_triggers(cur):
+    for name in REPORTS_FTS_TRIGGERS:
+        cur.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+def create_reports_fts_triggers(cur):
+    text_keys = [k for k, _ in TEXT_FIELDS]
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_reports_fts_insert AFTER INSERT ON reports BEGIN\n"
+                f"{_reports_fts_sql('NEW')}\nEND")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_reports_fts_delete AFTER DELETE ON reports BEGIN\n"
+                f"{_reports_fts_sql('OLD', delete=True)}\nEND")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_reports_fts_update AFTER UPDATE OF {', '.join(text_keys)} ON reports BEGIN\n"
+                f"{_reports_fts_sql('OLD', delete=True)}\n{_reports_fts_sql('NEW')}\nEND")
+
+def _migration_data_version(cur):
+    """
+    Счетчик изменений данных, попадающих в выгрузки (reports и users). Увеличивается триггерами,
+    поэтому учитывает и правки БД в сторонних программах. PRAGMA data_version для этого не годится:
+    его значение своё у каждого соединения и не меняется от записей этого же соединения.
+    """
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS data_version (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cur.execute("INSERT OR IGNORE INTO data_version (name, version) VALUES ('export', 0)")
+    create_data_version_triggers(cur)
+
+DATA_VERSION_TABLES = ("reports", "users")
+DATA_VERSION_EVENTS = ("INSERT", "UPDATE", "DELETE")
+DATA_VERSION_TRIGGERS = tuple(
+    f"trg_{table}_version_{event.lower()}" for table in DATA_VERSION_TABLES for event in DATA_VERSION_EVENTS
+)
+BUMP_DATA_VERSION_SQL = "UPDATE data_version SET version = version + 1 WHERE name = 'export'"
+
+def bump_data_version(cur):
+    """Увеличивает счетчик вручную — после изменений, сделанных без триггеров (массовая загрузка)."""
+    cur.execute(BUMP_DATA_VERSION_SQL)
+
+def drop_data_version_triggers(cur):
+    for name in DATA_VERSION_TRIGGERS:
+        cur.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+def create_data_version_triggers(cur):
+    for table in DATA_VERSION_TABLES:
+        for event in DATA_VERSION_EVENTS:
+            cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{event.lower()} "
+                        f"AFTER {event} ON {table} BEGIN {BUMP_DATA_VERSION_SQL}; END")
+
+def _migration_orphan_reports(cur):
+    """
+    Пересчитывает итоги без отчетов сотрудников, удаленных раньше: delete_user рассчитывал на
+    каскадное удаление, которого в схеме нет, и отчеты оставались. В выгрузки (JOIN users) они не
+    попадали, а в итоги /summary попадали. Сами отчеты не трогаем; удалить их можно явно
+    командой `python main.py purge-orphans` (перед удалением делается резервная копия).
+    """
+    orphans = get_orphan_report_counts(cur)
+    if orphans:
+        logger.info(
+            f"Отчеты удаленных сотрудников исключены из итогов (остаются в БД): "
+            f"{', '.join(f'{user_id} ({count})' for user_id, count in orphans)}"
+        )
+    rebuild_report_totals(cur)
+
+MIGRATIONS = [
+    (1, "Базовые таблицы users, reports, pending_users", _migration_base_schema),
+    (2, "UNIQUE-индекс reports(user_id, report_date)", _migration_unique_report_per_day),
+    (3, "Индекс reports(report_date)", _migration_report_date_index),
+    (4, "Столбец reports.revision для UPSERT отчетов", _migration_report_revision),
+    (5, "Таблицы persistence_* для состояния диалогов", _migration_persistence_tables),
+    (6, "Таблицы итогов report_totals_* и триггеры на reports", _migration_report_totals),
+    (7, "Полнотекстовый индекс reports_fts по текстовым полям", _migration_reports_fts),
+    (8, "Счетчик изменений data_version для кэша выгрузок", _migration_data_version),
+    (9, "Итоги без отчетов ранее удаленных сотрудников", _migration_orphan_reports),
+]
+
+def get_schema_version(conn):
+    """Возвращает номер последней применённой миграции (0 для пустой БД)."""
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+def init_db():
+    """Инициализирует базу данных и применяет недостающие миграции схемы."""
+    conn = get_db_conn()
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+    # Быстрый путь: схема актуальна — миграции не проверяются по одной
+    if get_schema_version(conn) < MIGRATIONS[-1][0]:
+        apply_migrations(conn)
+    ensure_triggers(conn)
+
+def apply_migrations(conn):
+    """Применяет по порядку миграции, которых еще нет в schema_version."""
+    for version, description, migrate in MIGRATIONS:
+        # BEGIN IMMEDIATE сразу берет блокировку записи, поэтому одновременно запущенные
+        # экземпляры не применят одну и ту же миграцию дважды
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            migrate(conn.cursor())
+            conn.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)", (version, description))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.exception(f"Не удалось применить миграцию {version} ({description})")
+            raise
+        logger.info(f"Применена миграция схемы БД {version}: {description}")
+
+def ensure_triggers(conn):
+    """
+    Проверяет, что на месте триггеры итогов, поискового индекса и счетчика изменений. Пропавшие
+    (например, массовую загрузку прервали между снятием и созданием триггеров) создаются заново,
+    а данные, которые они поддерживают, пересчитываются — без триггеров они могли отстать от reports.
+    """
+    repairs = (
+        ("итоги report_totals_*", REPORT_TOTALS_TRIGGERS, rebuild_report_totals, create_report_totals_triggers),
+        ("поисковый индекс reports_fts", REPORTS_FTS_TRIGGERS, rebuild_reports_fts, create_reports_fts_triggers),
+        ("счетчик data_version", DATA_VERSION_TRIGGERS, bump_data_version, create_data_version_triggers),
+    )
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+    missing = [repair for repair in repairs if not set(repair[1]) <= existing]
+    if not missing:
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cur = conn.cursor()
+        for description, _, rebuild, create in missing:
+            logger.warning(f"Не найдены триггеры ({description}): пересчитываю данные и создаю триггеры заново")
+            rebuild(cur)
+            create(cur)
         conn.commit()
+    except Exception:
+        conn.rollback()
+        logger.exception("Не удалось восстановить триггеры БД")
+        raise
+
+# --- Кэш пользователей ---
+
+class UserDirectory:
+    """
+    Кэш зарегистрированных пользователей и списка ожидания в памяти процесса.
+    Загружается из БД один раз при старте и обновляется сразу после успешной записи в БД
+    (write-through) функциями add_user, delete_user, add_pending_user и remove_pending_user.
+    Пока кэш не загружен (например, в утилитах), функции работают напрямую с БД.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}         # user_id -> (first_name, last_name, employee_id, position)
+        self._by_employee_id = {}  # employee_id -> user_id
+        self._pending = set()
+        self.loaded = False
+
+    def load(self):
+        """Загружает пользователей и список ожидания из БД."""
+        conn = get_db_conn()
+        users = conn.execute("SELECT user_id, first_name, last_name, employee_id, position FROM users").fetchall()
+        pending = conn.execute("SELECT user_id FROM pending_users").fetchall()
+        with self._lock:
+            self._users = {row[0]: tuple(row[1:]) for row in users}
+            self._by_employee_id = {row[3]: row[0] for row in users}
+            self._pending = {row[0] for row in pending}
+            self.loaded = True
+        logger.info(f"Загружено в кэш: {len(self._users)} пользователей, {len(self._pending)} в списке ожидания")
+
+    def is_registered(self, user_id):
+        return user_id in self._users
+
+    def is_pending(self, user_id):
+        return user_id in self._pending
+
+    def get(self, user_id):
+        """Возвращает (first_name, last_name, employee_id, position) или None."""
+        return self._users.get(user_id)
+
+    def find_by_employee_id(self, employee_id):
+        """Возвращает user_id по табельному номеру или None."""
+        return self._by_employee_id.get(employee_id)
+
+    def all_users(self):
+        """Список (user_id, first_name, last_name, employee_id, position) в порядке user_id."""
+        with self._lock:
+            return [(user_id,) + info for user_id, info in sorted(self._users.items())]
+
+    def put_user(self, user_id, first_name, last_name, employee_id, position):
+        with self._lock:
+            self._users[user_id] = (first_name, last_name, employee_id, position)
+            self._by_employee_id[employee_id] = user_id
+
+    def remove_user(self, user_id):
+        with self._lock:
+            info = self._users.pop(user_id, None)
+            if info is not None:
+                self._by_employee_id.pop(info[2], None)
+
+    def add_pending(self, user_id):
+        with self._lock:
+            self._pending.add(user_id)
+
+    def remove_pending(self, user_id):
+        with self._lock:
+            self._pending.discard(user_id)
+
+
+user_directory = UserDirectory()
+
+
+class SubmissionTracker:
+    """
+    Множество сотрудников, отправивших отчет за текущий день (по TIMEZONE), и множество тех,
+    кто еще не отправил. Обновляется при сохранении отчета и при добавлении/удалении
+    сотрудников, поэтому проверка «сдал ли сегодня» — O(1), а список должников — O(число должников).
+    В полночь по TIMEZONE множества автоматически сбрасываются на новый день.
+    Администраторы в статистике не учитываются.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._day = None
+        self._submitted = set()
+        self._missing = set()
+        self.loaded = False
+
+    def load(self):
+        """Загружает из БД, кто уже отправил отчет сегодня. Требует загруженного user_directory."""
+        day = local_today()
+        submitted = set(get_users_submitted_today())
+        with self._lock:
+            self._reset(day, submitted)
+            self.loaded = True
+
+    def _reset(self, day, submitted):
+        self._day = day
+        self._submitted = {uid for uid in submitted if self._is_employee(uid)}
+        self._missing = {
+            uid for uid, *_ in user_directory.all_users()
+            if uid not in ADMIN_IDS and uid not in self._submitted
+        }
+
+    @staticmethod
+    def _is_employee(user_id):
+        return user_id not in ADMIN_IDS and user_directory.is_registered(user_id)
+
+    def tracks(self, user_id):
+        """True, если статус пользователя можно брать из трекера (зарегистрированный сотрудник)."""
+        return self.loaded and self._is_employee(user_id)
+
+    def _roll_over(self):
+        """Переходит на новый день, если наступила полночь. Вызывается под блокировкой."""
+        today = local_today()
+        if today != self._day:
+            # Отчеты за новый день сохраняются только через mark_submitted, поэтому БД читать не нужно
+            self._reset(today, set())
+
+    def mark_submitted(self, user_id, report_date):
+        with self._lock:
+            self._roll_over()
+            if report_date != self._day or not self._is_employee(user_id):
+                return
+            self._submitted.add(user_id)
+            self._missing.discard(user_id)
+
+    def add_employee(self, user_id):
+        with self._lock:
+            self._roll_over()
+            if self._is_employee(user_id) and user_id not in self._submitted:
+                self._missing.add(user_id)
+
+    def remove_employee(self, user_id):
+        with self._lock:
+            self._submitted.discard(user_id)
+            self._missing.discard(user_id)
+
+    def has_submitted(self, user_id):
+        with self._lock:
+            self._roll_over()
+            return user_id in self._submitted
+
+    def snapshot(self):
+        """Возвращает (дата, количество сдавших, множество не сдавших) на текущий момент."""
+        with self._lock:
+            self._roll_over()
+            return self._day, len(self._submitted), set(self._missing)
+
+
+submission_tracker = SubmissionTracker()
+
+def load_caches():
+    """Загружает кэш пользователей и статистику отправки отчетов за сегодня (вызывается при старте)."""
+    user_directory.load()
+    submission_tracker.load()
 
 def user_exists(user_id):
     """Проверяет, существует ли пользователь в базе."""
-    with sqlite3.connect(DB_NAME) as conn:
+    if user_directory.loaded:
+        return user_directory.is_registered(user_id)
+    with get_db_conn() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
         return cursor.fetchone() is not None
 
+def is_pending_approval(user_id):
+    """Проверяет, находится ли пользователь в списке ожидания."""
+    if user_directory.loaded:
+        return user_directory.is_pending(user_id)
+    with get_db_conn() as conn:
+        return conn.cursor().execute("SELECT 1 FROM pending_users WHERE user_id = ?", (user_id,)).fetchone() is not None
+
 def add_user(user_id, first_name, last_name, employee_id, position):
     """Добавляет нового пользователя."""
-    with sqlite3.connect(DB_NAME) as conn:
+    with get_db_conn() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "INSERT INTO users (user_id, first_name, last_name, employee_id, position) VALUES (?, ?, ?, ?, ?)",
             (user_id, first_name, last_name, employee_id, position)
         )
+        # Сотрудник вернулся, а его старые отчеты не удалялись (purge-orphans не запускали):
+        # в выгрузках они снова видны, значит и в итогах должны быть
+        cursor.execute("SELECT 1 FROM reports WHERE user_id = ? LIMIT 1", (user_id,))
+        if cursor.fetchone():
+            logger.info(f"У сотрудника {user_id} есть отчеты до повторной регистрации, пересчитываю итоги")
+            rebuild_report_totals(cursor)
         conn.commit()
+    user_directory.put_user(user_id, first_name, last_name, employee_id, position)
+    if submission_tracker.loaded:
+        submission_tracker.add_employee(user_id)
+
+def add_pending_user(user_id):
+    """Добавляет пользователя в список ожидания подтверждения."""
+    with get_db_conn() as conn:
+        conn.cursor().execute("INSERT INTO pending_users (user_id) VALUES (?)", (user_id,))
+    user_directory.add_pending(user_id)
+
+def remove_pending_user(user_id):
+    """Удаляет пользователя из списка ожидания."""
+    with get_db_conn() as conn:
+        conn.cursor().execute("DELETE FROM pending_users WHERE user_id = ?", (user_id,))
+    user_directory.remove_pending(user_id)
 
 def has_submitted_report_today(user_id):
     """Проверяет, отправлял ли пользователь отчет сегодня."""
-    with sqlite3.connect(DB_NAME) as conn:
+    if submission_tracker.tracks(user_id):
+        return submission_tracker.has_submitted(user_id)
+    with get_db_conn() as conn:
         cursor = conn.cursor()
-        today = date.today()
+        today = local_today()
         cursor.execute(
             "SELECT 1 FROM reports WHERE user_id = ? AND report_date = ?",
             (user_id, today)
         )
         return cursor.fetchone() is not None
 
-def add_report_row(user_id, data: dict):
-    """Добавляет новый отчет."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cols = ["user_id", "report_date"] + list(data.keys())
-        placeholders = ",".join("?" for _ in cols)
-        values = [user_id, date.today()] + [data[k] for k in data.keys()]
+def submit_report(user_id, data: dict, report_date=None):
+    """
+    Сохраняет отчет за день одним атомарным запросом INSERT ... ON CONFLICT DO UPDATE.
+    Возвращает True, если отчет создан, и False, если был обновлен уже существующий.
+    """
+    report_date = report_date or local_today()
+    keys = [k for k, _ in ALL_FIELDS if k in data]
+    cols = ["user_id", "report_date"] + keys
+    placeholders = ",".join("?" for _ in cols)
+    set_clause = ", ".join(f"{k} = excluded.{k}" for k in keys)
+    values = [user_id, report_date] + [data[k] for k in keys]
+
+    sql = (
+        f"INSERT INTO reports ({','.join(cols)}) VALUES ({placeholders}) "
+        f"ON CONFLICT(user_id, report_date) DO UPDATE SET {set_clause}, revision = revision + 1 "
+        f"RETURNING revision"
+    )
+    with get_db_conn() as conn:
+        revision = conn.execute(sql, values).fetchall()[0][0]
+    if submission_tracker.loaded:
+        submission_tracker.mark_submitted(user_id, report_date)
+    return revision == 0
 
-        sql = f"INSERT INTO reports ({','.join(cols)}) VALUES ({placeholders})"
-        cursor.execute(sql, values)
-        conn.commit()
+def get_today_report(user_id):
+    """Возвращает сегодняшний отчет пользователя в виде словаря {поле: значение} или None."""
+    with get_db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM reports WHERE user_id = ? AND report_date = ?", (user_id, local_today()))
+        row = cur.fetchone()
+        if not row:
+            return None
+        cols = [d[0] for d in cur.description]
+        rowdict = dict(zip(cols, row))
+        return {k: rowdict.get(k) for k, _ in ALL_FIELDS}
 
-def update_report_today(user_id, data: dict):
-    """Обновляет сегодняшний отчет пользователя."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        set_clause = ", ".join(f"{k} = ?" for k in data.keys())
-        values = list(data.values()) + [user_id, date.today()]
-        sql = f"UPDATE reports SET {set_clause} WHERE user_id = ? AND report_date = ?"
-        cursor.execute(
-            sql, values
-        )
-        conn.commit()
+HISTORY_PAGE_SIZE = 3   # отчетов на одной странице «Мои отчеты»
 
-def get_user_reports(user_id):
-    """Получает последний отчет пользователя."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT report_date, " + ", ".join(k for k, _ in ALL_FIELDS) + " FROM reports WHERE user_id = ? ORDER BY report_date DESC LIMIT 1", (user_id,))
-        return cursor.fetchall()
+def get_user_reports(user_id, direction="latest", boundary=None, limit=HISTORY_PAGE_SIZE):
+    """
+    Страница истории отчетов пользователя. Пагинация по ключу (user_id, report_date), без OFFSET:
+    каждая страница — один проход по индексу ux_reports_user_date, сколько бы отчетов ни было.
+
+    direction: "latest" — самые новые отчеты, "older" — строго раньше boundary, "newer" — строго позже boundary.
+    Возвращает (строки [report_date, *ALL_FIELDS] от новых к старым, есть ли еще отчеты в направлении листания).
+    """
+    cols = "report_date, " + ", ".join(k for k, _ in ALL_FIELDS)
+    if direction == "newer":
+        sql = f"SELECT {cols} FROM reports WHERE user_id = ? AND report_date > ? ORDER BY report_date ASC LIMIT ?"
+        params = (user_id, boundary, limit + 1)
+    elif direction == "older":
+        sql = f"SELECT {cols} FROM reports WHERE user_id = ? AND report_date < ? ORDER BY report_date DESC LIMIT ?"
+        params = (user_id, boundary, limit + 1)
+    else:
+        sql = f"SELECT {cols} FROM reports WHERE user_id = ? ORDER BY report_date DESC LIMIT ?"
+        params = (user_id, limit + 1)
+    rows = get_db_conn().execute(sql, params).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == "newer":
+        rows.reverse()
+    return rows, has_more
 
 def get_user_by_employee_id(employee_id):
     """Находит пользователя по табельному номеру."""
-    with sqlite3.connect(DB_NAME) as conn:
+    if user_directory.loaded:
+        user_id = user_directory.find_by_employee_id(employee_id)
+        if user_id is None:
+            return None
+        first_name, last_name, _, _ = user_directory.get(user_id)
+        return user_id, first_name, last_name
+    with get_db_conn() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT user_id, first_name, last_name FROM users WHERE employee_id = ?", (employee_id,))
         return cursor.fetchone()
 
 def delete_user(user_id):
-    """Удаляет пользователя и все его отчеты (каскадно)."""
-    with sqlite3.connect(DB_NAME) as conn:
+    """Удаляет пользователя и все его отчеты."""
+    with get_db_conn() as conn:
         cursor = conn.cursor()
-        # Благодаря ON DELETE CASCADE, отчеты удалятся автоматически
+        # Внешнего ключа с ON DELETE CASCADE в схеме нет — отчеты удаляются явно, в той же транзакции.
+        # Триггеры на reports вычитают их из итогов report_totals_* и из поискового индекса.
+        cursor.execute("DELETE FROM reports WHERE user_id = ?", (user_id,))
+        cursor.execute("DELETE FROM report_totals_user WHERE user_id = ?", (user_id,))
         cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
         conn.commit()
+    user_directory.remove_user(user_id)
+    if submission_tracker.loaded:
+        submission_tracker.remove_employee(user_id)
+
+def get_orphan_report_counts(cur):
+    """Отчеты сотрудников, которых нет в users: [(user_id, число отчетов), ...]."""
+    cur.execute(
+        "SELECT user_id, COUNT(*) FROM reports WHERE user_id NOT IN (SELECT user_id FROM users) "
+        "GROUP BY user_id ORDER BY user_id"
+    )
+    return cur.fetchall()
+
+def purge_orphan_reports():
+    """
+    Удаляет отчеты сотрудников, которых нет в users (остались от delete_user старых версий).
+    Перед удалением делается резервная копия; возвращает [(user_id, число отчетов), ...].
+    """
+    with get_db_conn() as conn:
+        orphans = get_orphan_report_counts(conn.cursor())
+    if not orphans:
+        return []
+    backup = backup_manager.create(label="pre-purge-orphans")
+    logger.info(f"Резервная копия перед удалением отчетов удаленных сотрудников: {backup.path}")
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        # Тот же список, что попал в копию: между чтением и удалением мог появиться сотрудник
+        orphans = get_orphan_report_counts(cursor)
+        cursor.execute("DELETE FROM reports WHERE user_id NOT IN (SELECT user_id FROM users)")
+        # Триггеры вычли удаленные отчеты из итогов, хотя в итогах их не было: пересчитываем
+        rebuild_report_totals(cursor)
+        conn.commit()
+    logger.info(
+        f"Удалены отчеты удаленных сотрудников: "
+        f"{', '.join(f'{user_id} ({count})' for user_id, count in orphans)}"
+    )
+    return orphans
 
 def get_all_registered_users():
     """Получает всех зарегистрированных пользователей."""
-    with sqlite3.connect(DB_NAME) as conn:
+    if user_directory.loaded:
+        return user_directory.all_users()
+    with get_db_conn() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT user_id, first_name, last_name, employee_id, position FROM users")
         return cursor.fetchall()
 
-def get_users_submitted_today():
-    """Получает ID пользователей, отправивших отчет сегодня."""
-    with sqlite3.connect(DB_NAME) as conn:
+def get_users_submitted_today(today=None):
+    """Получает ID пользователей, отправивших отчет сегодня (или в указанный день)."""
+    with get_db_conn() as conn:
         cursor = conn.cursor()
-        today = date.today()
-        cursor.execute("SELECT DISTINCT user_id FROM reports WHERE report_date = ?", (today,))
+        today = today or local_today()
+        cursor.execute("SELECT user_id FROM reports WHERE report_date = ?", (today,))
         return [row[0] for row in cursor.fetchall()]
 
-def get_all_reports_for_csv():
-    """Получает все отчеты для выгрузки в CSV."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cur = conn.cursor()
-        # Составляем список колонок в нужном порядке
-        header_cols = ["first_name", "last_name", "employee_id", "position", "report_date"] 
-        all_field_keys = [k for k, _ in ALL_FIELDS]
-        select_cols = ", ".join([f"u.{c}" for c in header_cols[:4]] + ["r.report_date"] + [f"r.{c}" for c in all_field_keys])
-        sql = f'''
-            SELECT {select_cols}
-            FROM reports r
-            JOIN users u ON r.user_id = u.user_id
-            ORDER BY r.report_date DESC
-        '''
-
-        cur.execute(sql)
-        rows = cur.fetchall()
-        # Заголовки для CSV (человекочитаемые)
-        headers = ["Имя", "Фамилия", "Табельный номер", "Должность", "Дата"]
-        headers += [FULL_FIELD_LABELS[key] for key in all_field_keys]
-        return headers, rows
+# Выгрузка читает отчеты из БД пачками и пишет файл на диск, а не собирает его целиком в памяти
+EXPORT_FETCH_SIZE = 500
+EXPORT_SPOOL_MAX_BYTES = 1024 * 1024  # небольшие выгрузки остаются в памяти, большие уходят во временный файл
 
+def iter_report_rows(cur, fetch_size=EXPORT_FETCH_SIZE):
+    """Построчно отдает результат запроса, читая его из курсора пачками через fetchmany."""
+    while True:
+        rows = cur.fetchmany(fetch_size)
+        if not rows:
+            return
+        yield from rows
 
-# --- 3. КЛАВИАТУРЫ (МЕНЮ) ---
+@dataclass(frozen=True)
+class ExportFilter:
+    """
+    Параметры выгрузки отчетов. Пустые значения означают «без ограничения».
+    date_from/date_to — границы периода включительно; employee_ids — табельные номера; positions — должности.
+    """
+    date_from: date = None
+    date_to: date = None
+    employee_ids: frozenset = frozenset()
+    positions: frozenset = frozenset()
+
+    def to_sql(self):
+        """Возвращает условие WHERE (без ключевого слова) и параметры запроса."""
+        conditions, params = [], []
+        # Условия по дате используют индекс ix_reports_date, по табельному номеру — UNIQUE-индекс users
+        if self.date_from is not None:
+            conditions.append("r.report_date >= ?")
+            params.append(self.date_from)
+        if self.date_to is not None:
+            conditions.append("r.report_date <= ?")
+            params.append(self.date_to)
+        if self.employee_ids:
+            conditions.append(f"u.employee_id IN ({','.join('?' for _ in self.employee_ids)})")
+            params.extend(sorted(self.employee_ids))
+        if self.positions:
+            conditions.append(f"u.position IN ({','.join('?' for _ in self.positions)})")
+            params.extend(sorted(self.positions))
+        return " AND ".join(conditions) or "1", params
+
+    def describe(self):
+        """Человекочитаемое описание фильтра (HTML)."""
+        if self.date_from is None and self.date_to is None:
+            period = "всё время"
+        elif self.date_from == self.date_to:
+            period = f"{self.date_from}"
+        else:
+            period = f"{self.date_from or '…'} — {self.date_to or '…'}"
+        employees = ", ".join(html.escape(e) for e in sorted(self.employee_ids)) or "все"
+        positions = ", ".join(html.escape(p) for p in sorted(self.positions)) or "все"
+        return (
+            f"📅 <b>Период:</b> {period}\n"
+            f"🪪 <b>Табельные номера:</b> {employees}\n"
+            f"👔 <b>Должности:</b> {positions}"
+        )
 
-def user_main_menu_keyboard():
-    """Главное меню для сотрудника."""
-    keyboard = [
-        [KeyboardButton("📝 Отправить отчет")],
-        [KeyboardButton("📂 Мои отчеты")],
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    def filename(self, extension):
+        if self.date_from is None and self.date_to is None and not self.employee_ids and not self.positions:
+            return f'all_reports_{local_today()}.{extension}'
+        return f'reports_{self.date_from or "start"}_{self.date_to or local_today()}.{extension}'
 
-def admin_main_menu_keyboard():
-    """Главное меню для администратора."""
-    keyboard = [
-        [KeyboardButton("📊 Статистика за сегодня")],
-        [KeyboardButton("🔔 Напомнить всем")],
-        [KeyboardButton("📥 Скачать все отчеты (CSV)")],
-        [KeyboardButton("👥 Список сотрудников")],
-        [KeyboardButton("🗑️ Удалить сотрудника")],
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+def get_data_version():
+    """Текущее значение счетчика изменений reports/users (см. миграцию 8)."""
+    row = get_db_conn().execute("SELECT version FROM data_version WHERE name = 'export'").fetchone()
+    return row[0] if row else 0
 
-def back_to_main_menu_keyboard():
-    """Клавиатура с кнопкой 'Назад в меню'."""
-    return ReplyKeyboardMarkup(
-        [[KeyboardButton("⬅️ Назад в главное меню")]],
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
+def get_all_reports_for_csv(export_filter: ExportFilter = None):
+    """
+    Получает отчеты для выгрузки в CSV (все или только подходящие под фильтр).
+    Возвращает заголовки и итератор по строкам: строки читаются из БД по мере обхода.
+    """
+    export_filter = export_filter or ExportFilter()
+    # Составляем список колонок в нужном порядке
+    header_cols = ["first_name", "last_name", "employee_id", "position", "report_date"] 
+    all_field_keys = [k for k, _ in ALL_FIELDS]
+    select_cols = ", ".join([f"u.{c}" for c in header_cols[:4]] + ["r.report_date"] + [f"r.{c}" for c in all_field_keys])
+    where_clause, params = export_filter.to_sql()
+    sql = f'''
+        SELECT {select_cols}
+        FROM reports r
+        JOIN users u ON r.user_id = u.user_id
+        WHERE {where_clause}
+        ORDER BY r.report_date DESC
+    '''
+
+    cur = get_db_conn().cursor()
+    cur.execute(sql, params)
+    # Заголовки для CSV (человекочитаемые)
+    headers = ["Имя", "Фамилия", "Табельный номер", "Должность", "Дата"]
+    headers += [FULL_FIELD_LABELS[key] for key in all_field_keys]
+    return headers, iter_report_rows(cur)
+
+def build_reports_csv(export_filter: ExportFilter = None):
+    """
+    Формирует CSV-файл с отчетами (по умолчанию — со всеми), не загружая их в память целиком.
+    Возвращает (файл, имя_файла) или None, если отчетов нет. Файл нужно закрыть после отправки.
+    """
+    export_filter = export_filter or ExportFilter()
+    headers, rows = get_all_reports_for_csv(export_filter)
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES, mode='w+b')
+    # Кодируем сразу при записи; utf-8-sig добавляет BOM, чтобы Excel правильно открыл файл
+    output = io.TextIOWrapper(spool, encoding='utf-8-sig', newline='')
+    writer = csv.writer(output, delimiter=';', quoting=csv.QUOTE_ALL)
+    writer.writerow(headers)
+    row_count = 0
+    for r in rows:
+        # Приводим значения к строкам, убираем переносы
+        cleaned = [str(x).replace("\n", " ").replace("\r", "") if x is not None else "" for x in r]
+        writer.writerow(cleaned)
+        row_count += 1
+    output.flush()
+    output.detach()
 
-def confirm_edit_keyboard():
-    """Клавиатура для подтверждения редактирования отчета."""
-    keyboard = [
-        [KeyboardButton("Да, редактировать")],
-        [KeyboardButton("Нет, вернуться в меню")],
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+    if row_count == 0:
+        spool.close()
+        return None
+    spool.seek(0)
+    return spool, export_filter.filename('csv')
 
-def confirm_delete_keyboard():
-    """Клавиатура для подтверждения удаления пользователя."""
-    keyboard = [
-        [KeyboardButton("Да, удалить")],
-        [KeyboardButton("Отмена")],
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-
-def start_registration_keyboard():
-    """Клавиатура с кнопкой 'Начать регистрацию'."""
-    keyboard = [
-        [KeyboardButton("🚀 Начать регистрацию")],
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-
-def build_report_inline_keyboard(current_values: dict):
-    """
-    current_values: dict key->value (может быть None если не заполнено)
-    Формируем таблицу кнопок по 2 в ряд.
-    Кнопки для числовых полей — показывают текущее значение (или 0/пусто).
-    Также добавляем кнопки для текстовых полей и кнопку SEND.
-    """
-    keyboard = []
-    # числовые — по 2 в ряд
-    for i in range(0, len(NUMERIC_FIELDS), 2):
-        row = []
-        for key, label in NUMERIC_FIELDS[i:i+2]:
-            display = current_values.get(key)
-            if display is None:
-                btn_text = f"{label} — (0)"
-            else:
-                btn_text = f"{label} — ({display})"
-            row.append(InlineKeyboardButton(btn_text, callback_data=f"field|{key}"))
-        keyboard.append(row)
-
-    # текстовые — по 2 в ряд
-    for i in range(0, len(TEXT_FIELDS), 2):
-        row = []
-        for key, label in TEXT_FIELDS[i:i+2]:
-            display = current_values.get(key)
-            if display is None or display == "":
-                btn_text = f"{label} — (пусто)"
-            else:
-                short = display if len(display) <= 20 else display[:17] + "..."
-                btn_text = f"{label} — ({short})"
-            row.append(InlineKeyboardButton(btn_text, callback_data=f"field|{key}"))
-        keyboard.append(row)
-
-    # команды управления
-    keyboard.append([
-        InlineKeyboardButton("✅ Отправить отчёт", callback_data="action|send"),
-        InlineKeyboardButton("❌ Отменить", callback_data="action|cancel"),
-    ])
-    keyboard.append([
-        InlineKeyboardButton("🔄 Сбросить все введённые значения", callback_data="action|reset")
-    ])
-    return InlineKeyboardMarkup(keyboard)
 
+class XlsxFormula:
+    """Ячейка-формула для XlsxStreamWriter; value — заранее вычисленное значение для просмотрщиков без пересчета."""
 
-# --- 4. ЛОГИКА БОТА (ОБРАБОТЧИКИ) ---
+    def __init__(self, formula, value=None):
+        self.formula = formula
+        self.value = value
 
-# --- Общие функции ---
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Обработчик команды /start. Также используется как точка входа в регистрацию."""
-    user = update.effective_user
 
-    # Если пользователь уже зарегистрирован, показать ему главное меню
-    if user_exists(user.id):
-        await show_main_menu(update, context)
-        return ConversationHandler.END
+class XlsxStreamWriter:
+    """
+    Минимальный потоковый писатель .xlsx (Office Open XML) на стандартной библиотеке.
+    XML листа пишется прямо в zip-архив по мере поступления строк, поэтому расход памяти
+    не зависит от числа строк. Поддерживаются строки, числа, даты и формулы;
+    первая строка каждого листа закрепляется как заголовок. В листе не больше MAX_ROWS строк
+    (предел Excel); следующий лист начинается вызовом add_sheet.
+    """
 
-    # Если пользователь уже в списке ожидания, просто сообщаем ему об этом
-    if is_pending_approval(user.id):
-        await update.message.reply_text(
-            "Ваша заявка на доступ уже одобрена администратором. "
-            "Пожалуйста, нажмите кнопку ниже, чтобы начать регистрацию.",
-            reply_markup=start_registration_keyboard()
+    STYLE_DEFAULT, STYLE_BOLD, STYLE_DATE = 0, 1, 2
+    MAX_ROWS = 1048576
+    _INVALID_XML_CHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+    _EXCEL_EPOCH = date(1899, 12, 30)
+
+    def __init__(self, fileobj, sheet_name="Sheet1", column_widths=None):
+        self._zip = zipfile.ZipFile(fileobj, 'w', compression=zipfile.ZIP_DEFLATED)
+        self._cols = ""
+        if column_widths:
+            self._cols = "<cols>" + "".join(
+                f'<col min="{i}" max="{i}" width="{w}" customWidth="1"/>' for i, w in enumerate(column_widths, 1)
+            ) + "</cols>"
+        self.sheet_names = []
+        self._sheet = None
+        self.add_sheet(sheet_name)
+
+    def add_sheet(self, sheet_name):
+        """Завершает текущий лист и начинает новый; дальше строки пишутся в него с первой."""
+        if self._sheet is not None:
+            self._finish_sheet()
+        self.sheet_names.append(sheet_name)
+        self._sheet = self._zip.open(f'xl/worksheets/sheet{len(self.sheet_names)}.xml', 'w', force_zip64=True)
+        self.rows_written = 0
+        self._write(
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+            '<sheetViews><sheetView workbookViewId="0">'
+            '<pane ySplit="1" topLeftCell="A2" activePane="bottomLeft" state="frozen"/>'
+            '</sheetView></sheetViews>'
+            f'{self._cols}<sheetData>'
         )
-        return ConversationHandler.END
-
-    # Если пользователь новый, отправляем запрос администраторам
-    with get_db_conn() as conn:
-        conn.cursor().execute("INSERT INTO pending_users (user_id) VALUES (?)", (user.id,))
-        conn.commit()
-
-    await update.message.reply_text("Ваш запрос на доступ отправлен администратору. Пожалуйста, ожидайте.")
-
-    # Формируем сообщение для администраторов
-    user_info = (
-        f"👤 <b>Новый запрос на доступ</b>\n\n"
-        f"<b>Имя:</b> {user.first_name}\n"
-        f"<b>Фамилия:</b> {user.last_name or '<i>(не указана)</i>'}\n"
-        f"<b>Username:</b> @{user.username or '<i>(не указан)</i>'}\n"
-        f"<b>User ID:</b> <code>{user.id}</code>"
-    )
-    approval_keyboard = InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("✅ Одобрить", callback_data=f"approve|{user.id}"),
-            InlineKeyboardButton("❌ Отклонить", callback_data=f"reject|{user.id}"),
-        ]
-    ])
-
-    # Отправляем уведомление всем администраторам
-    for admin_id in ADMIN_IDS:
-        try:
-            await context.bot.send_message(chat_id=admin_id, text=user_info, parse_mode='HTML', reply_markup=approval_keyboard)
-        except Exception as e:
-            logger.error(f"Не удалось отправить уведомление администратору {admin_id}: {e}")
-
-    return ConversationHandler.END
-
-async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показывает главное меню в зависимости от прав пользователя."""
-    user = update.effective_user
-    if not user:
-        return ConversationHandler.END
-
-    user_id = user.id
-    text, reply_markup = get_menu_for_user(user_id)
-    # Отправляем новое сообщение, чтобы гарантированно показать ReplyKeyboard
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=text, reply_markup=reply_markup)
-    return ConversationHandler.END
-
-def get_menu_for_user(user_id, force_user_menu: bool = False):
-    """Возвращает текст и клавиатуру в зависимости от прав пользователя."""
-    is_admin = user_id in ADMIN_IDS
-
-    if is_admin and not force_user_menu:
-        text = "Добро пожаловать в панель администратора!"
-        reply_markup = admin_main_menu_keyboard()
-    else:
-        text = "Добро пожаловать в главное меню сотрудника!"
-        # Для обычного сотрудника показываем стандартное меню
-        reply_markup = user_main_menu_keyboard()
-    return text, reply_markup
-
-# --- Логика регистрации ---
-async def start_registration(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Начинает процесс регистрации после нажатия кнопки."""
-    user_id = update.effective_user.id
 
-    # Дополнительная проверка: разрешена ли регистрация
-    if not is_pending_approval(user_id):
-        await update.message.reply_text("Ваша заявка еще не одобрена администратором.", reply_markup=ReplyKeyboardRemove())
-        return ConversationHandler.END
-
-    await update.message.reply_html(
-        "Отлично! Давайте начнем.\n"
-        "Пожалуйста, введите ваше <b>имя</b>:",
-        reply_markup=ReplyKeyboardRemove(),
-    )
-    context.user_data['is_registration_approved'] = True
-    return REGISTER_NAME
-
-async def register_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data['first_name'] = update.message.text
-    await update.message.reply_text(
-        "Отлично! Теперь введите вашу <b>фамилию</b>:",
-        parse_mode='HTML',
-        reply_markup=ReplyKeyboardRemove()
-    )
-    return REGISTER_LAST_NAME
-
-async def register_last_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data['last_name'] = update.message.text
-    await update.message.reply_text(
-        "Хорошо. Теперь введите ваш <b>табельный номер</b>:",
-        parse_mode='HTML',
-        reply_markup=ReplyKeyboardRemove()
-    )
-    return REGISTER_EMPLOYEE_ID
-
-async def register_employee_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data['employee_id'] = update.message.text
-    await update.message.reply_text(
-        "И последний шаг. Введите вашу <b>должность</b>:",
-        parse_mode='HTML',
-        reply_markup=ReplyKeyboardRemove()
-    )
-    return REGISTER_POSITION
-
-async def register_position(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user = update.effective_user
-    context.user_data['position'] = update.message.text
-    try:
-        add_user(
-            user_id=user.id,
-            first_name=context.user_data.get('first_name'),
-            last_name=context.user_data.get('last_name'),
-            employee_id=context.user_data.get('employee_id'),
-            position=context.user_data.get('position')
+    def _finish_sheet(self):
+        self._write('</sheetData></worksheet>')
+        self._sheet.close()
+
+    @staticmethod
+    def column_letter(index):
+        """0 -> A, 25 -> Z, 26 -> AA."""
+        letters = ""
+        index += 1
+        while index:
+            index, rem = divmod(index - 1, 26)
+            letters = chr(65 + rem) + letters
+        return letters
+
+    def _write(self, text):
+        self._sheet.write(text.encode('utf-8'))
+
+    def _cell(self, ref, value, style):
+        style_attr = f' s="{style}"' if style else ""
+        if isinstance(value, XlsxFormula):
+            cached = f"<v>{value.value}</v>" if value.value is not None else ""
+            return f'<c r="{ref}"{style_attr}><f>{xml_escape(value.formula)}</f>{cached}</c>'
+        if isinstance(value, bool):
+            value = int(value)
+        if isinstance(value, (int, float)):
+            return f'<c r="{ref}"{style_attr}><v>{value}</v></c>'
+        if isinstance(value, date):
+            serial = (value - self._EXCEL_EPOCH).days
+            return f'<c r="{ref}" s="{self.STYLE_DATE}"><v>{serial}</v></c>'
+        text = self._INVALID_XML_CHARS.sub("", str(value))
+        return f'<c r="{ref}" t="inlineStr"{style_attr}><is><t xml:space="preserve">{xml_escape(text)}</t></is></c>'
+
+    def write_row(self, values, style=STYLE_DEFAULT):
+        """Записывает строку в текущий лист; None означает пустую ячейку."""
+        if self.rows_written >= self.MAX_ROWS:
+            raise ValueError(f"В листе уже {self.MAX_ROWS} строк, нужен add_sheet")
+        self.rows_written += 1
+        row_num = self.rows_written
+        cells = "".join(
+            self._cell(f"{self.column_letter(i)}{row_num}", value, style)
+            for i, value in enumerate(values) if value is not None
         )
-        # Удаляем пользователя из списка ожидания после успешной регистрации
-        with get_db_conn() as conn:
-            conn.cursor().execute("DELETE FROM pending_users WHERE user_id = ?", (user.id,))
-            conn.commit()
-
-        await update.message.reply_text("🎉 Регистрация успешно завершена!")
-        # Показываем главное меню только после УСПЕШНОЙ регистрации
-        await show_main_menu(update, context)
-
-    except sqlite3.IntegrityError:
-        logger.warning(f"Попытка регистрации с дублирующимся табельным номером: {context.user_data.get('employee_id')}")
-        await update.message.reply_text(
-            "Произошла ошибка: сотрудник с таким табельным номером уже зарегистрирован. "
-            "Пожалуйста, начните регистрацию заново с корректным номером.",
-            reply_markup=start_registration_keyboard()
+        self._write(f'<row r="{row_num}">{cells}</row>')
+
+    def close(self):
+        """Завершает последний лист и дописывает служебные части книги."""
+        self._finish_sheet()
+        sheet_numbers = range(1, len(self.sheet_names) + 1)
+        sheet_types = "".join(
+            f'<Override PartName="/xl/worksheets/sheet{n}.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            for n in sheet_numbers
         )
-        # Не показываем меню, а даем возможность исправить ошибку
-    except Exception as e:
-        logger.error(f"Ошибка при регистрации пользователя {user.id}: {e}")
-        await update.message.reply_text(
-            "Произошла непредвиденная ошибка при регистрации. Пожалуйста, попробуйте позже."
+        sheet_names = [xml_escape(name, {'"': "&quot;"}) for name in self.sheet_names]
+        sheets = "".join(
+            f'<sheet name="{name}" sheetId="{n}" r:id="rId{n}"/>' for n, name in zip(sheet_numbers, sheet_names)
         )
-    return ConversationHandler.END
-
-# --- Логика отправки отчета ---
-async def start_submit_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Начинает диалог отправки отчета."""
-    user_id = update.effective_user.id
-    user = update.effective_user
-
-    if has_submitted_report_today(user_id):
-        await update.message.reply_text(
-            "Вы уже отправляли отчет сегодня. Хотите его отредактировать?",
-            reply_markup=confirm_edit_keyboard()
+        sheet_rels = "".join(
+            f'<Relationship Id="rId{n}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet{n}.xml"/>'
+            for n in sheet_numbers
         )
-        return CONFIRM_EDIT
-
-    # Инициализируем временную структуру в context.user_data
-    context.user_data['pending_report'] = {}
-    # значения по умолчанию None — значит не заполнил (при отправке станут 0 или '')
-    for key, _ in ALL_FIELDS:
-        context.user_data['pending_report'][key] = None
-
-    markup = build_report_inline_keyboard(context.user_data['pending_report'])
-    # Сохраняем сообщение-id, чтобы редактировать клавиатуру в будущем
-    msg = await update.message.reply_text("Пожалуйста, заполните отчёт. Нажмите на нужное поле:", reply_markup=markup)
-    context.user_data['pending_report_msg_id'] = msg.message_id
-    return SHOW_REPORT_MENU
-
-async def start_edit_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Начинает диалог редактирования отчета (загружает существующие данные)."""
-    user_id = update.effective_user.id
-    with get_db_conn() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM reports WHERE user_id = ? AND report_date = ?", (user_id, date.today()))
-        row = cur.fetchone()
-        if not row:
-            await update.message.reply_text("Ваш сегодняшний отчет не найден. Создайте новый.", reply_markup=user_main_menu_keyboard())
-            return ConversationHandler.END
-        cols = [d[0] for d in cur.description]
-        rowdict = dict(zip(cols, row))
-        pending = {k: rowdict.get(k) for k, _ in ALL_FIELDS}
-        context.user_data['pending_report'] = pending
-        markup = build_report_inline_keyboard(context.user_data['pending_report'])
-        msg = await update.message.reply_text("Загружен ваш сегодняшний отчет. Внесите необходимые правки.", reply_markup=markup)
-        context.user_data['pending_report_msg_id'] = msg.message_id
-        return SHOW_REPORT_MENU
-
-async def callback_report_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """CallbackQueryHandler для инлайн-кнопок отчёта."""
-    query = update.callback_query
-    await query.answer()
-    data = query.data
-    user = query.from_user
-
-    if 'pending_report' not in context.user_data:
-        context.user_data['pending_report'] = {k: None for k, _ in ALL_FIELDS}
+        styles_id = len(self.sheet_names) + 1
+        self._zip.writestr('[Content_Types].xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            f'{sheet_types}'
+            '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+            '</Types>'
+        ))
+        self._zip.writestr('_rels/.rels', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+            '</Relationships>'
+        ))
+        self._zip.writestr('xl/workbook.xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets>{sheets}</sheets>'
+            '</workbook>'
+        ))
+        self._zip.writestr('xl/_rels/workbook.xml.rels', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            f'{sheet_rels}'
+            f'<Relationship Id="rId{styles_id}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+            '</Relationships>'
+        ))
+        # Стили: 0 — обычный, 1 — жирный (заголовок и итоги), 2 — дата
+        self._zip.writestr('xl/styles.xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+            '<numFmts count="1"><numFmt numFmtId="164" formatCode="dd.mm.yyyy"/></numFmts>'
+            '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font>'
+            '<font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+            '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+            '<fill><patternFill patternType="gray125"/></fill></fills>'
+            '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+            '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+            '<cellXfs count="3">'
+            '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+            '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/>'
+            '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+            '</cellXfs>'
+            '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+            '</styleSheet>'
+        ))
+        self._zip.close()
+
+
+def build_reports_xlsx(export_filter: ExportFilter = None):
+    """
+    Формирует .xlsx с отчетами построчно: числовые поля пишутся числами, дата — датой,
+    заголовок закреплен, в конце — строка итогов по числовым полям.
+    Если строк больше, чем помещается в лист Excel, они продолжаются на листах «Отчеты 2», «Отчеты 3»…
+    (с тем же заголовком), а итоги на последнем листе суммируют все листы.
+    Возвращает (файл, имя_файла) или None, если отчетов нет. Файл нужно закрыть после отправки.
+    """
+    export_filter = export_filter or ExportFilter()
+    headers, rows = get_all_reports_for_csv(export_filter)
+    # Порядок колонок: 4 колонки сотрудника, дата, числовые поля, текстовые поля
+    date_col = 4
+    numeric_cols = range(date_col + 1, date_col + 1 + len(NUMERIC_FIELDS))
+    widths = [14, 16, 14, 20, 12] + [14] * len(NUMERIC_FIELDS) + [40] * len(TEXT_FIELDS)
+
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES, mode='w+b')
+    xlsx = XlsxStreamWriter(spool, sheet_name="Отчеты", column_widths=widths)
+    xlsx.write_row(headers, style=XlsxStreamWriter.STYLE_BOLD)
+    # Число строк данных на каждом листе — для диапазонов формул итогов
+    sheet_rows = [0]
+    totals = [0] * len(NUMERIC_FIELDS)
+
+    def next_sheet():
+        xlsx.add_sheet(f"Отчеты {len(xlsx.sheet_names) + 1}")
+        xlsx.write_row(headers, style=XlsxStreamWriter.STYLE_BOLD)
+        sheet_rows.append(0)
 
-    if data.startswith("field|"):
-        key = data.split("|", 1)[1]
-        context.user_data['awaiting_field'] = key
-        numeric_keys = [k for k, _ in NUMERIC_FIELDS]
-        if key in numeric_keys:
-            prompt_text = (
-                f"Пожалуйста, введите <b>число</b> для поля:\n"
-                f"<b>{FULL_FIELD_LABELS[key]}</b>\n\n"
-                f"<i>Если значение отсутствует, отправьте 0 или /skip.</i>"
-            )
-        else:
-            prompt_text = (
-                f"Пожалуйста, введите <b>текст</b> для поля:\n"
-                f"<b>{FULL_FIELD_LABELS[key]}</b>\n\n"
-                f"<i>Если информации нет, отправьте /skip.</i>"
-            )
-        prompt_msg = await query.message.reply_text(prompt_text, parse_mode='HTML')
-        context.user_data['prompt_msg_id'] = prompt_msg.message_id
-        return AWAITING_FIELD_VALUE
-
-    if data == "action|send":
-        pending = context.user_data.get('pending_report', {})
-        for k, _ in ALL_FIELDS:
-            if pending.get(k) is None: pending[k] = 0
-        for k, _ in [f for f in ALL_FIELDS if f[0] in dict(TEXT_FIELDS)]:
-            if pending.get(k) is None: pending[k] = ""
-
-        try:
-            confirmation_msg = None
-            if has_submitted_report_today(user.id):
-                update_report_today(user.id, pending)
-                confirmation_msg = await query.message.reply_text("✅ Ваш сегодняшний отчёт успешно обновлён.")
-            else:
-                add_report_row(user.id, pending)
-                confirmation_msg = await query.message.reply_text("✅ Отчёт успешно отправлен. Спасибо!")
-            
-            # Удаляем основное сообщение с меню отчета
-            main_report_msg_id = context.user_data.get('pending_report_msg_id')
-            if main_report_msg_id:
-                await context.bot.delete_message(chat_id=query.message.chat_id, message_id=main_report_msg_id)
-
-            # Удаляем финальное подтверждение через 5 секунд
-            if confirmation_msg:
-                await asyncio.sleep(5)
-                await context.bot.delete_message(chat_id=query.message.chat_id, message_id=confirmation_msg.message_id)
-        except Exception as e:
-            logger.exception(f"Ошибка при сохранении отчёта: {e}")
-            await query.message.reply_text("❌ Произошла ошибка при сохранении отчёта. Попробуйте позже.")
-        finally:
-            context.user_data.clear()
-            # await show_main_menu(query, context) # Не нужно, т.к. основное меню не пропадало
-        return ConversationHandler.END
-
-    if data == "action|cancel":
-        context.user_data.clear()
-        # Удаляем основное сообщение с меню отчета
-        main_report_msg_id = context.user_data.get('pending_report_msg_id')
-        if main_report_msg_id:
-            await context.bot.delete_message(chat_id=query.message.chat_id, message_id=main_report_msg_id)
-
-        confirmation_msg = await query.message.reply_text("Действие отменено. Отчёт не был отправлен.")
-        
-        # Удаляем сообщение через 5 секунд
-        await asyncio.sleep(5)
-        await context.bot.delete_message(chat_id=query.message.chat_id, message_id=confirmation_msg.message_id)
-
-        # await show_main_menu(query, context) # Не нужно, т.к. основное меню не пропадало
-        return ConversationHandler.END
-
-    if data == "action|reset":
-        for k, _ in ALL_FIELDS:
-            context.user_data['pending_report'][k] = None
-        new_markup = build_report_inline_keyboard(context.user_data['pending_report'])
-        try:
-            await query.edit_message_text("Значения сброшены. Заполните отчет заново:", reply_markup=new_markup)
-        except Exception:
-            await query.message.reply_text("Значения сброшены.", reply_markup=new_markup)
-        return SHOW_REPORT_MENU
-
-    if data == "action|edit_today":
-        with get_db_conn() as conn:
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM reports WHERE user_id = ? AND report_date = ?", (user.id, date.today()))
-            row = cur.fetchone()
-            if not row:
-                await query.message.reply_text("Запись не найдена.")
-                return ConversationHandler.END
-            cols = [d[0] for d in cur.description]
-            rowdict = dict(zip(cols, row))
-            pending = {k: rowdict.get(k) for k, _ in ALL_FIELDS}
-            context.user_data['pending_report'] = pending
-            markup = build_report_inline_keyboard(context.user_data['pending_report'])
-            msg = await query.message.reply_text("Редактируйте поля. Нажмите на нужное поле для изменения.", reply_markup=markup)
-            context.user_data['pending_report_msg_id'] = msg.message_id
-            return SHOW_REPORT_MENU
-
-async def message_fill_field(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обрабатывает ввод значения после того, как пользователь нажал кнопку поля."""
-    awaiting = context.user_data.get('awaiting_field')
-    if not awaiting:
-        return
-
-    text = update.message.text.strip()
-    numeric_keys = [k for k, _ in NUMERIC_FIELDS]
-    try:
-        if awaiting in numeric_keys:
-            val = int(text)
-            if val < 0: raise ValueError("Число должно быть >= 0")
-            context.user_data['pending_report'][awaiting] = val
-            confirmation_msg = await update.message.reply_text(f"Сохранено: {FULL_FIELD_LABELS[awaiting]} = {val}")
-        else:
-            context.user_data['pending_report'][awaiting] = text
-            confirmation_msg = await update.message.reply_text(f"Сохранено текстовое поле.")
-        
-        # Удаляем сообщение пользователя и подтверждение через 3 секунды
-        await asyncio.sleep(3)
-        prompt_msg_id = context.user_data.pop('prompt_msg_id', None)
-        if prompt_msg_id:
-            await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=prompt_msg_id)
-        await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=update.message.message_id)
-        await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=confirmation_msg.message_id)
-
-    except ValueError:
-        await update.message.reply_text(
-            "Пожалуйста, введите корректное целое число (>=0) или используйте /skip.",
-            reply_to_message_id=update.message.message_id
-        ) # Отвечаем на сообщение пользователя с ошибкой
-        return AWAITING_FIELD_VALUE # Остаемся в том же состоянии, чтобы пользователь мог исправить
-    finally:
-        # Этот блок больше не нужен здесь, так как мы не выходим из состояния при ошибке
-        context.user_data.pop('awaiting_field', None)
-        context.user_data.pop('prompt_msg_id', None) # На всякий случай
-
-    msg_id = context.user_data.get('pending_report_msg_id')
-    if msg_id:
-        try:
-            new_markup = build_report_inline_keyboard(context.user_data['pending_report'])
-            await context.bot.edit_message_text(
-                chat_id=update.effective_chat.id,
-                message_id=msg_id,
-                text="Отчет обновлен. Нажмите на следующее поле или отправьте отчет.",
-                reply_markup=new_markup
-            )
-        except Exception as e:
-            logger.warning(f"Не удалось обновить клавиатуру: {e}")
-    return SHOW_REPORT_MENU
-
-async def skip_field(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /skip — оставить значение по умолчанию (0 или пусто)."""
-    awaiting = context.user_data.get('awaiting_field')
-    if not awaiting:
-        await update.message.reply_text("Нет активного поля для пропуска.")
-        return
-
-    numeric_keys = [k for k, _ in NUMERIC_FIELDS]
-    if awaiting in numeric_keys:
-        context.user_data['pending_report'][awaiting] = 0
-    else:
-        context.user_data['pending_report'][awaiting] = ""
-    context.user_data.pop('awaiting_field', None)
-    
-    confirmation_msg = await update.message.reply_text("Поле пропущено и установлено по умолчанию.")
-
-    # Удаляем подтверждение через 3 секунды
-    await asyncio.sleep(3)
-    prompt_msg_id = context.user_data.get('prompt_msg_id')
-    if prompt_msg_id:
-        await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=prompt_msg_id)
-    await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=confirmation_msg.message_id)
-
-    msg_id = context.user_data.get('pending_report_msg_id')
-    if msg_id:
-        try:
-            new_markup = build_report_inline_keyboard(context.user_data['pending_report'])
-            await context.bot.edit_message_text(
-                chat_id=update.effective_chat.id,
-                message_id=msg_id,
-                text="Отчет обновлен. Нажмите на следующее поле или отправьте отчет.",
-                reply_markup=new_markup
-            )
-        except Exception as e:
-            logger.warning(f"Не удалось обновить клавиатуру после /skip: {e}")
-    return SHOW_REPORT_MENU
-
-# --- Логика просмотра отчетов ---
-async def show_my_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    reports = get_user_reports(user_id)
-
-    if not reports:
-        # Если отчетов нет, показываем сообщение и возвращаем пользователя в главное меню
-        _, reply_markup = get_menu_for_user(user_id)
-        await update.message.reply_text(
-            "У вас пока нет ни одного отчета.",
-            reply_markup=reply_markup
-        )
-        return
-
-    # Формируем и отправляем сообщение с последним отчетом
-    message_text = "📂 <b>Ваш последний отчет:</b>\n\n"
-    for r in reports:
-        report_date = r[0]
-        message_text += (
-            f"📅 <b>Дата:</b> {report_date}\n"
-        )
-        for i, (key, _) in enumerate(ALL_FIELDS):
-            label = FULL_FIELD_LABELS.get(key, key)
-            value = r[i+1]
-            message_text += f" - {label}: {value or '<i>(пусто)</i>'}\n"
-        message_text += "--------------------\n"
-
-    # После просмотра отчетов возвращаем пользователю его основную клавиатуру
-    _, reply_markup = get_menu_for_user(user_id)
-    await update.message.reply_text(message_text, parse_mode='HTML', reply_markup=reply_markup)
-
-async def show_all_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показывает администратору список всех зарегистрированных пользователей."""
-    all_users = get_all_registered_users()
-
-    if not all_users:
-        await update.message.reply_text(
-            "В системе пока нет зарегистрированных сотрудников.",
-            reply_markup=admin_main_menu_keyboard()
-        )
-        return
-
-    message_text = "👥 <b>Список всех зарегистрированных сотрудников:</b>\n\n"
-    for user_id, first_name, last_name, employee_id, position in all_users:
-        message_text += (
-            f"<b>Имя:</b> {first_name}\n"
-            f"<b>Фамилия:</b> {last_name}\n"
-            f"<b>Должность:</b> {position}\n"
-            f"<b>Табельный номер:</b> {employee_id}\n"
-            f"<b>User ID:</b> <code>{user_id}</code>\n"
-            "--------------------\n"
-        )
-
-    message_text += "\nℹ️ Чтобы исправить или удалить запись, используйте программу для работы с базами данных (например, DB Browser for SQLite) и откройте файл `reports_bot.db`."
-
-    await update.message.reply_text(
-        message_text, parse_mode='HTML', reply_markup=admin_main_menu_keyboard()
-    )
-
-# --- Логика удаления пользователя (для админа) ---
-async def start_delete_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Начинает диалог удаления пользователя."""
-    await update.message.reply_text(
-        "Введите табельный номер сотрудника, которого хотите удалить.",
-        reply_markup=ReplyKeyboardRemove()
-    )
-    return DELETE_USER_PROMPT
-
-async def prompt_delete_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Запрашивает подтверждение на удаление."""
-    employee_id = update.message.text
-    user_to_delete = get_user_by_employee_id(employee_id)
-
-    if not user_to_delete:
-        await update.message.reply_text(
-            f"Сотрудник с табельным номером '{employee_id}' не найден."
-        )
-        await show_main_menu(update, context)
-        return ConversationHandler.END
-
-    user_id, first_name, last_name = user_to_delete
-    context.user_data['user_to_delete'] = {'id': user_id, 'name': f"{first_name} {last_name}"}
-
-    await update.message.reply_text(
-        f"Вы уверены, что хотите удалить сотрудника <b>{first_name} {last_name}</b>?\n"
-        "<b>ВНИМАНИЕ:</b> Это действие удалит пользователя и все его отчеты без возможности восстановления.",
-        parse_mode='HTML',
-        reply_markup=confirm_delete_keyboard()
-    )
-    return DELETE_USER_CONFIRM
-
-async def confirm_delete_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Окончательно удаляет пользователя."""
-    # Проверяем, что пользователь нажал "Да, удалить"
-    if update.message.text != "Да, удалить":
-        await update.message.reply_text("Удаление отменено.")
-        await show_main_menu(update, context)
-        return ConversationHandler.END
-
-    user_to_delete = context.user_data.pop('user_to_delete', None)
-    if user_to_delete and 'id' in user_to_delete:
-        delete_user(user_to_delete['id'])
-        await update.message.reply_text(f"Сотрудник {user_to_delete.get('name', 'N/A')} успешно удален.")
-    else:
-        await update.message.reply_text("Не удалось найти данные для удаления. Пожалуйста, начните заново.")
-    
-    await show_main_menu(update, context)
-    return ConversationHandler.END
-
-# --- Функции администратора ---
-async def show_admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показывает статистику по сотрудникам, исключая администраторов."""
-    all_users = get_all_registered_users()
-    # Исключаем администраторов из общего списка для статистики
-    employees = [user for user in all_users if user[0] not in ADMIN_IDS]
-    
-    submitted_today_ids = get_users_submitted_today()
-    
-    # Считаем только сотрудников
-    submitted_employees_count = len([uid for uid in submitted_today_ids if uid not in ADMIN_IDS])
-    not_submitted_employees = [emp for emp in employees if emp[0] not in submitted_today_ids]
-
-    text = (
-        f"📊 <b>Статистика на {date.today()}:</b>\n\n"
-        f"✅ Отправили отчет: <b>{submitted_employees_count}</b>\n" 
-        f"❌ Не отправили отчет: <b>{len(not_submitted_employees)}</b>\n"
-        f"👥 Всего сотрудников: <b>{len(employees)}</b>\n\n"
-    )
-
-    if not_submitted_employees:
-        text += "<b>Список тех, кто не отправил отчет:</b>\n"
-        for _, first_name, last_name, _, _ in not_submitted_employees:
-            text += f" - {first_name} {last_name}\n"
-
-    await update.message.reply_text(text, parse_mode='HTML', reply_markup=admin_main_menu_keyboard())
-
-async def _send_reminders(context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Внутренняя функция для поиска и отправки напоминаний. Возвращает количество отправленных."""
-    all_users = get_all_registered_users()
-    employees = [user for user in all_users if user[0] not in ADMIN_IDS]
-    submitted_today_ids = get_users_submitted_today()
-    not_submitted_employees = [emp for emp in employees if emp[0] not in submitted_today_ids]
-
-    sent_count = 0
-    logger.info(f"Найдено {len(not_submitted_employees)} сотрудников для отправки напоминания.")
-    for user_id, _, _, _, _ in not_submitted_employees:
+    for r in rows:
+        values = list(r)
         try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="⏰ <b>Напоминание!</b>\nПожалуйста, не забудьте отправить ваш ежедневный отчет.",
-                parse_mode='HTML'
-            )
-            sent_count += 1
-            await asyncio.sleep(0.1) # Небольшая задержка, чтобы не перегружать API
-        except Exception as e:
-            logger.warning(f"Не удалось отправить напоминание пользователю {user_id}: {e}")
-    return sent_count
-
-async def remind_all_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик ручного запуска рассылки напоминаний."""
-    await update.message.reply_text("Начинаю рассылку напоминаний...")
-    sent_count = await _send_reminders(context)
-
-    await update.message.reply_text(
-        f"✅ Рассылка завершена.\nНапоминания отправлены <b>{sent_count}</b> сотрудникам.",
-        parse_mode='HTML',
-        reply_markup=admin_main_menu_keyboard()
-    )
-
-async def download_csv_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    all_reports = get_all_reports_for_csv()
-    if not all_reports:
-        await update.message.reply_text("В базе данных пока нет отчетов.", reply_markup=admin_main_menu_keyboard())
-        return
-
+            values[date_col] = date.fromisoformat(str(values[date_col]))
+        except ValueError:
+            pass
+        for n, col in enumerate(numeric_cols):
+            value = values[col]
+            if isinstance(value, str):
+                value = int(value) if value.strip().isdigit() else None
+            values[col] = value
+            totals[n] += value or 0
+        if xlsx.rows_written >= XlsxStreamWriter.MAX_ROWS:
+            next_sheet()
+        xlsx.write_row(values)
+        sheet_rows[-1] += 1
+
+    if sheet_rows[0] == 0:
+        xlsx.close()
+        spool.close()
+        return None
+
+    # Строка итогов тоже должна поместиться в лист
+    if xlsx.rows_written >= XlsxStreamWriter.MAX_ROWS:
+        next_sheet()
+    totals_row = ["Итого", None, None, None, None]
+    for n, col in enumerate(numeric_cols):
+        letter = XlsxStreamWriter.column_letter(col)
+        ranges = []
+        for name, count in zip(xlsx.sheet_names, sheet_rows):
+            if not count:
+                continue
+            prefix = "" if len(xlsx.sheet_names) == 1 else "'" + name.replace("'", "''") + "'!"
+            ranges.append(f"{prefix}{letter}2:{letter}{count + 1}")
+        totals_row.append(XlsxFormula(f"SUM({','.join(ranges)})", totals[n]))
+    xlsx.write_row(totals_row, style=XlsxStreamWriter.STYLE_BOLD)
+    xlsx.close()
+    spool.seek(0)
+    return spool, export_filter.filename('xlsx')
+
+
+# --- Асинхронный доступ к БД ---
+
+# Количество потоков для чтения; запись всегда идёт через один поток
+DB_READER_THREADS = 4
+
+
+# --- Сводные итоги ---
+SUMMARY_PERIOD_ALIASES = {
+    "day": "day", "день": "day",
+    "week": "week", "неделя": "week",
+    "month": "month", "месяц": "month",
+}
+MONTH_NAMES = ["январь", "февраль", "март", "апрель", "май", "июнь",
+               "июль", "август", "сентябрь", "октябрь", "ноябрь", "декабрь"]
+
+
+def summary_period_start(period, day):
+    """Первый день периода (день, ISO-неделя, месяц), в который попадает day."""
+    if period == "week":
+        return day - timedelta(days=day.weekday())
+    if period == "month":
+        return day.replace(day=1)
+    return day
+
+def previous_period_start(period, start):
+    if period == "week":
+        return start - timedelta(days=7)
+    if period == "month":
+        return (start - timedelta(days=1)).replace(day=1)
+    return start - timedelta(days=1)
+
+def summary_period_label(period, start):
+    if period == "week":
+        year, week, _ = start.isocalendar()
+        return f"неделя {year}-W{week:02d} ({start:%d.%m.%Y}–{start + timedelta(days=6):%d.%m.%Y})"
+    if period == "month":
+        return f"{MONTH_NAMES[start.month - 1]} {start.year}"
+    return f"{start:%d.%m.%Y}"
+
+def get_company_totals(period, period_start):
+    """Итоги по компании за период: {'reports': N, поле: сумма, ...} или None. Одна строка из report_totals_company."""
+    keys = [k for k, _ in NUMERIC_FIELDS]
+    row = get_db_conn().execute(
+        f"SELECT reports, {', '.join(keys)} FROM report_totals_company WHERE period = ? AND period_start = ?",
+        (period, period_start)
+    ).fetchone()
+    if row is None or row[0] == 0:
+        return None
+    return dict(zip(["reports"] + keys, row))
+
+def get_user_period_totals(user_id, period, period_start):
+    """Итоги одного сотрудника за период: {'reports': N, поле: сумма, ...} или None. Поиск по первичному ключу."""
+    keys = [k for k, _ in NUMERIC_FIELDS]
+    row = get_db_conn().execute(
+        f"SELECT reports, {', '.join(keys)} FROM report_totals_user "
+        f"WHERE period = ? AND period_start = ? AND user_id = ?",
+        (period, period_start, user_id)
+    ).fetchone()
+    if row is None or row[0] == 0:
+        return None
+    return dict(zip(["reports"] + keys, row))
+
+def get_user_totals(period, period_start):
+    """Итоги по сотрудникам за период: [(user_id, reports, *суммы по NUMERIC_FIELDS)] — по строке на сотрудника."""
+    keys = [k for k, _ in NUMERIC_FIELDS]
+    return get_db_conn().execute(
+        f"SELECT user_id, reports, {', '.join(keys)} FROM report_totals_user "
+        f"WHERE period = ? AND period_start = ? AND reports > 0 ORDER BY user_id",
+        (period, period_start)
+    ).fetchall()
+
+def build_user_totals_csv(period, period_start):
+    """CSV с итогами каждого сотрудника за период. Возвращает (байты, имя_файла) или None, если отчетов нет."""
+    rows = get_user_totals(period, period_start)
+    if not rows:
+        return None
     output = io.StringIO()
     writer = csv.writer(output, delimiter=';', quoting=csv.QUOTE_ALL)
-    headers, rows = get_all_reports_for_csv()
-    writer.writerow(headers)
-    for r in rows:
-        # Приводим значения к строкам, убираем переносы
-        cleaned = [str(x).replace("\n", " ").replace("\r", "") if x is not None else "" for x in r]
-        writer.writerow(cleaned)
-
-    output.seek(0)
-    file_to_send = io.BytesIO(output.getvalue().encode('utf-8-sig')) # utf-8-sig для Excel
-    file_to_send.name = f'all_reports_{date.today()}.csv'
-
-    await context.bot.send_document(chat_id=update.effective_user.id, document=file_to_send)
-    await update.message.reply_text("✅ Файл с отчетами отправлен.", reply_markup=admin_main_menu_keyboard())
-
-async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Отменяет текущий диалог."""
-    user = update.effective_user
-    if user:
-        logger.info(f"Пользователь {user.first_name} (ID: {user.id}) отменил действие.")
-    
-    await update.message.reply_text("Действие отменено.", reply_markup=ReplyKeyboardRemove())
-    await show_main_menu(update, context)
-    return ConversationHandler.END
-
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Отправляет справочное сообщение в зависимости от роли пользователя."""
-    user_id = update.effective_user.id
-    is_admin = user_id in ADMIN_IDS
-
-    if is_admin:
-        text = (
-            "ℹ️ <b>Справка для администратора</b>\n\n"
-            "Вы можете использовать следующие команды через кнопки меню:\n"
-            "📊 <b>Статистика за сегодня</b> - Показывает, кто сдал, а кто еще нет.\n"
-            "🔔 <b>Напомнить всем</b> - Отправляет напоминание тем, кто не сдал отчет.\n"
-            "📥 <b>Скачать все отчеты (CSV)</b> - Формирует и отправляет вам файл со всеми отчетами.\n"
-            "👥 <b>Список сотрудников</b> - Показывает список всех зарегистрированных пользователей.\n"
-            "🗑️ <b>Удалить сотрудника</b> - Запускает процесс удаления пользователя по табельному номеру.\n\n"
-            "Также доступны команды:\n"
-            "/start - Перезапуск бота и возврат в главное меню.\n"
-            "/cancel - Отмена текущего действия и возврат в главное меню."
-        )
-    else:
-        numeric_fields_info = "\n".join([f"• <i>{FULL_FIELD_LABELS.get(key, key)}</i>" for key, _ in NUMERIC_FIELDS])
-        text_fields_info = "\n".join([f"• <i>{FULL_FIELD_LABELS.get(key, key)}</i>" for key, _ in TEXT_FIELDS])
-
-        text = (
-            "ℹ️ <b>Справка для сотрудника</b>\n\n"
-            "Используйте кнопки меню для взаимодействия с ботом:\n"
-            "📝 <b>Отправить отчет</b> - Заполнить и отправить ваш ежедневный отчет.\n"
-            "📂 <b>Мои отчеты</b> - Просмотреть ваш последний отправленный отчет.\n\n"
-            "<b>Как заполнять отчет:</b>\n"
-            "При нажатии на кнопку 'Отправить отчет' появится меню с полями. Нажмите на поле, чтобы ввести значение.\n\n"
-            "<b>Числовые поля (нужно ввести = 1 или 2 или 3):</b>\n"
-            f"{numeric_fields_info}\n"
-            "Если по какому-то из этих пунктов нет данных, просто отправьте <b>0</b> или нажмите /skip.\n\n"
-            "<b>Текстовые поля (нужно написать текст):</b>\n"
-            f"{text_fields_info}\n"
-            "Если информации нет, нажмите /skip, чтобы оставить поле пустым.\n\n"
-            "После заполнения всех полей нажмите '✅ Отправить отчёт'."
-        )
-
-    await update.message.reply_text(text, parse_mode='HTML')
-
-async def scheduled_reminder_callback(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Колбэк для автоматической отправки напоминаний по расписанию."""
-    logger.info("Запуск автоматической рассылки напоминаний по расписанию.")
-    sent_count = await _send_reminders(context)
-    logger.info(f"Автоматическая рассылка завершена. Отправлено {sent_count} напоминаний.")
-
-async def handle_approval(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обрабатывает нажатия на кнопки одобрения/отклонения регистрации."""
-    query = update.callback_query
-    await query.answer()
-
-    action, user_id_str = query.data.split('|')
-    user_id = int(user_id_str)
-    admin = query.from_user
-
-    original_text = query.message.text_html
-
-    if action == 'approve':
-        # Проверяем, есть ли пользователь еще в списке ожидания
-        if not is_pending_approval(user_id):
-            await query.edit_message_text(f"{original_text}\n\n<i>(Действие уже выполнено другим администратором)</i>", parse_mode='HTML')
-            return
-
-        try:
-            # Отправляем пользователю приглашение к регистрации
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="✅ Ваша заявка на доступ одобрена!\n\nТеперь вы можете начать регистрацию.",
-                reply_markup=start_registration_keyboard()
-            )
-            await query.edit_message_text(f"{original_text}\n\n<b>✅ Одобрено администратором {admin.mention_html()}</b>", parse_mode='HTML')
-        except Exception as e:
-            logger.error(f"Не удалось отправить сообщение одобренному пользователю {user_id}: {e}")
-            await query.edit_message_text(f"{original_text}\n\n<i>Не удалось уведомить пользователя. Возможно, он заблокировал бота.</i>", parse_mode='HTML')
-
-    elif action == 'reject':
-        # Удаляем пользователя из списка ожидания
-        with get_db_conn() as conn:
-            conn.cursor().execute("DELETE FROM pending_users WHERE user_id = ?", (user_id,))
-            conn.commit()
-
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="❌ К сожалению, ваша заявка на доступ была отклонена."
-            )
-            await query.edit_message_text(f"{original_text}\n\n<b>❌ Отклонено администратором {admin.mention_html()}</b>", parse_mode='HTML')
-        except Exception as e:
-            logger.error(f"Не удалось отправить сообщение отклоненному пользователю {user_id}: {e}")
-            await query.edit_message_text(f"{original_text}\n\n<i>Не удалось уведомить пользователя. Возможно, он заблокировал бота.</i>", parse_mode='HTML')
-
-
-async def unknown_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обрабатывает любые сообщения, которые не были распознаны другими обработчиками."""
-    await update.message.reply_text(
-        "Я не понимаю эту команду. Пожалуйста, используйте кнопки в меню или введите /start для получения справки.",
-        reply_to_message_id=update.message.message_id,
-        parse_mode=None # Явно отключаем разбор Markdown/HTML
-    )
-
-
-# --- 5. ЗАПУСК БОТА ---
-
-def main() -> None:
-    """Основная функция для запуска бота."""
-    if not BOT_TOKEN:
-        logger.error("Токен бота не найден. Укажите его в .env файле (BOT_TOKEN=...).")
-        return
-
-    init_db()
-    application = Application.builder().token(BOT_TOKEN).build()
-
-    # Настройка ежедневных автоматических напоминаний
-    try:
-        timezone = pytz.timezone(TIMEZONE_STR)
-        job_queue = application.job_queue
-        # Запускать каждый день с понедельника (0) по пятницу (4) в 16:00
-        job_queue.run_daily(
-            scheduled_reminder_callback,
-            time=time(hour=16, minute=0, tzinfo=timezone),
-            days=(0, 1, 2, 3, 4)
-        )
-        logger.info(f"Запланирована ежедневная отправка напоминаний в 16:00 по часовому поясу {TIMEZONE_STR}")
-    except pytz.UnknownTimeZoneError:
-        logger.error(f"Неизвестный часовой пояс: '{TIMEZONE_STR}'. Автоматические напоминания не будут работать. "
-                     f"Укажите корректный часовой пояс в .env файле (например, TIMEZONE=Asia/Tashkent).")
-
-    # Основной обработчик, включающий все диалоги и кнопки
-    conv_handler = ConversationHandler(
-        entry_points=[
-            # Точка входа в регистрацию теперь - кнопка, а не /start
-            # CommandHandler("start", start), # Для новых пользователей
-            MessageHandler(filters.Regex("^📝 Отправить отчет$"), start_submit_report),
-            MessageHandler(filters.Regex("^🗑️ Удалить сотрудника$"), start_delete_user),
-            # Новая точка входа в регистрацию
-            MessageHandler(filters.Regex("^🚀 Начать регистрацию$"), start_registration),
-        ],
-        states={
-            # Состояния регистрации
-            AWAIT_REGISTRATION_START: [
-                MessageHandler(filters.Regex("^🚀 Начать регистрацию$"), start_registration)
-            ],
-            REGISTER_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, register_name)],
-            REGISTER_LAST_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, register_last_name)],
-            REGISTER_EMPLOYEE_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, register_employee_id)],
-            REGISTER_POSITION: [MessageHandler(filters.TEXT & ~filters.COMMAND, register_position)],
-            
-            # Состояние подтверждения редактирования
-            CONFIRM_EDIT: [
-                MessageHandler(filters.Regex("^Да, редактировать$"), start_edit_report),
-                MessageHandler(filters.Regex("^Нет, вернуться в меню$"), cancel),
-            ],
-            
-            # Состояния для нового процесса отчета
-            SHOW_REPORT_MENU: [CallbackQueryHandler(callback_report_menu)],
-            AWAITING_FIELD_VALUE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, message_fill_field),
-                CommandHandler("skip", skip_field),
-            ],
-
-            # Состояния удаления пользователя
-            DELETE_USER_PROMPT: [MessageHandler(filters.TEXT & ~filters.COMMAND, prompt_delete_user)],
-            DELETE_USER_CONFIRM: [
-                MessageHandler(filters.Regex("^(Да, удалить|Отмена)$"), confirm_delete_user),
-            ],
-        },
-        fallbacks=[
-            CommandHandler("cancel", cancel),
-            # Этот обработчик ловит все варианты отмены и возврата в меню
-            MessageHandler(filters.Regex("^(Отмена|⬅️ Назад в главное меню|Нет, вернуться в меню)$"), cancel),
-            # Обработчик для любых других сообщений внутри диалога
-            MessageHandler(filters.TEXT & ~filters.COMMAND, unknown_message_handler),
-        ],
-        # Этот флаг позволяет обработчикам вне ConversationHandler работать
-        allow_reentry=True
+    writer.writerow(["Имя", "Фамилия", "Табельный номер", "Должность", "Отчетов"]
+                    + [FULL_FIELD_LABELS[k] for k, _ in NUMERIC_FIELDS])
+    for user_id, *totals in rows:
+        info = user_directory.get(user_id) if user_directory.loaded else None
+        first_name, last_name, employee_id, position = info or ("", "", "", "")
+        writer.writerow([first_name, last_name, employee_id, position] + totals)
+    # utf-8-sig добавляет BOM, чтобы Excel правильно открыл файл
+    return output.getvalue().encode('utf-8-sig'), f"totals_{period}_{period_start}.csv"
+
+
+# --- Полнотекстовый поиск ---
+SEARCH_RESULTS_LIMIT = 10
+SEARCH_SNIPPET_TOKENS = 16
+SEARCH_WORD_RE = re.compile(r"\w+")
+# Маркеры совпадений в snippet(): заменяются на <b></b> уже после экранирования HTML
+SEARCH_MATCH_START, SEARCH_MATCH_END = "\x02", "\x03"
+
+
+def build_fts_query(text):
+    """Запрос FTS5 из слов пользователя: все слова обязательны, каждое ищется как префикс
+    (находит и другие падежи: «трансформатор» → «трансформаторов»). Синтаксис FTS5 из ввода не пропускается."""
+    words = SEARCH_WORD_RE.findall(text)
+    return " ".join(f'"{word}"*' for word in words)
+
+def search_reports(fts_query, date_from=None, date_to=None, limit=SEARCH_RESULTS_LIMIT):
+    """
+    Ищет по TEXT_FIELDS через reports_fts. Возвращает (всего найдено, результаты по релевантности bm25):
+    [(report_date, user_id, [фрагмент по каждому TEXT_FIELDS или '']), ...].
+    """
+    text_keys = [k for k, _ in TEXT_FIELDS]
+    snippets = ", ".join(
+        f"snippet(reports_fts, {i}, '{SEARCH_MATCH_START}', '{SEARCH_MATCH_END}', '…', {SEARCH_SNIPPET_TOKENS})"
+        for i in range(len(text_keys))
     )
+    texts = ", ".join(f"r.{k}" for k in text_keys)
+    conn = get_db_conn()
+    if date_from is None and date_to is None:
+        # Без фильтра по датам и считаем, и ранжируем только по индексу; с reports соединяем лишь найденную страницу
+        total = conn.execute("SELECT COUNT(*) FROM reports_fts WHERE reports_fts MATCH ?", (fts_query,)).fetchone()[0]
+        rows = conn.execute(
+            f"WITH hits AS ("
+            f"  SELECT rowid AS report_id, rank, {snippets} FROM reports_fts"
+            f"  WHERE reports_fts MATCH ? ORDER BY rank LIMIT ?"
+            f") SELECT r.report_date, r.user_id, {texts}, hits.* FROM hits JOIN reports r USING (report_id) ORDER BY hits.rank",
+            (fts_query, limit)
+        ).fetchall()
+        rows = [row[:2 + len(text_keys)] + row[4 + len(text_keys):] for row in rows]
+    else:
+        conditions = ["reports_fts MATCH ?", "r.report_date >= ?", "r.report_date <= ?"]
+        params = [fts_query, date_from or date.min, date_to or date.max]
+        where = " AND ".join(conditions)
+        join = "FROM reports_fts JOIN reports r ON r.report_id = reports_fts.rowid"
+        total = conn.execute(f"SELECT COUNT(*) {join} WHERE {where}", params).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT r.report_date, r.user_id, {texts}, {snippets} {join} WHERE {where} ORDER BY reports_fts.rank LIMIT ?",
+            params + [limit]
+        ).fetchall()
+
+    results = []
+    for report_date, user_id, *fields in rows:
+        values, fragments = fields[:len(text_keys)], fields[len(text_keys):]
+        # snippet() возвращает начало поля и без совпадений — такие поля не показываем
+        results.append((report_date, user_id, [
+            fragment if value and SEARCH_MATCH_START in fragment else "" for value, fragment in zip(values, fragments)
+        ]))
+    return total, results
+
+
+# --- Резервные копии ---
+BACKUP_PAGES_PER_STEP = 256              # страниц за один шаг backup API (~1 МБ при странице 4 КБ)
+BACKUP_STEP_PAUSE = 0.001                # сек между шагами, чтобы копирование не забирало весь диск у бота
+BACKUP_SEND_MAX_BYTES = 50 * 1024 * 1024  # больше этого бот не может отправить файл через Bot API
+
+
+def check_database_file(path):
+    """Проверяет файл БД (integrity_check и поисковый индекс); возвращает список проблем, пустой — файл цел."""
+    try:
+        conn = sqlite3.connect(path)
+    except sqlite3.Error as e:
+        return [str(e)]
+    try:
+        rows = [row[0] for row in conn.execute("PRAGMA integrity_check")]
+        problems = [] if rows == ["ok"] else rows
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'reports_fts'").fetchone():
+            try:
+                conn.execute("INSERT INTO reports_fts(reports_fts) VALUES('integrity-check')")
+            except sqlite3.DatabaseError as e:
+                problems.append(f"reports_fts: {e}")
+        return problems
+    except sqlite3.DatabaseError as e:
+        return [str(e)]
+    finally:
+        conn.close()
 
-    application.add_handler(conv_handler)
-    # Обработчики команд и кнопок главного меню
-    application.add_handler(CommandHandler("start", start)) # Для существующих пользователей
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("menu", show_main_menu))
-    application.add_handler(MessageHandler(filters.Regex("^📂 Мои отчеты$"), show_my_reports))
-    application.add_handler(MessageHandler(filters.Regex("^📊 Статистика за сегодня$"), show_admin_stats))
-    application.add_handler(MessageHandler(filters.Regex(r"^🔔 Напомнить всем$"), remind_all_users))
-    application.add_handler(MessageHandler(filters.Regex(r"^📥 Скачать все отчеты \(CSV\)$"), download_csv_reports))
-    application.add_handler(MessageHandler(filters.Regex(r"^👥 Список сотрудников$"), show_all_users))
-    application.add_handler(MessageHandler(filters.Regex("^⬅️ Назад в главное меню$"), show_main_menu))
+def _fsync_file(path):
+    with open(path, "rb+") as f:
+        os.fsync(f.fileno())
 
-    # Обработчик для кнопок одобрения/отклонения
-    application.add_handler(CallbackQueryHandler(handle_approval, pattern=r"^(approve|reject)\|"))
 
-    # Обработчик для всех остальных сообщений (должен быть последним)
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, unknown_message_handler))
+class BackupResult:
+    """Итоги резервного копирования: файл копии, его размер, размер БД и время."""
 
-    application.run_polling()
+    def __init__(self, path, size, db_size, duration):
+        self.path = path
+        self.size = size
+        self.db_size = db_size
+        self.duration = duration
 
+    def summary_html(self):
+        return (
+            f"💾 <b>Резервная копия готова</b>\n"
+            f"Файл: <code>{html.escape(os.path.basename(self.path))}</code>\n"
+            f"Размер: {self.size / 2**20:.1f} МБ (БД: {self.db_size / 2**20:.1f} МБ)\n"
+            f"Проверка целостности: ✅\n"
+            f"⏱ Время: {self.duration:.1f} с"
+        )
 
-if __name__ == "__main__":
-    main()
+    def __str__(self):
+        return f"{self.path}, {self.size / 2**20:.1f} МБ (БД {self.db_size / 2**20:.1f} МБ), {self.duration:.1f} с"
 
 
+class BackupManager:
+    """
+    Онлайн-копии БД через backup API SQLite, без остановки бота.
+    Страницы копируются шагами по BACKUP_PAGES_PER_STEP из отдельного соединения, которое всё время копирования
+    держит транзакцию чтения: в режиме WAL она не мешает записи, а копия получается снимком на момент начала.
+    Без неё каждый коммит бота заставлял бы backup API начинать копирование заново с первой страницы.
+    Готовая копия проверяется, при необходимости сжимается и под своим именем появляется только целой
+    (запись во временный файл, затем rename); копии сверх keep удаляются, начиная со старых.
+    """
 
+    def __init__(self, db_name, backup_dir, keep=BACKUP_KEEP, compress=BACKUP_COMPRESS):
+        self.db_name = db_name
+        self.backup_dir = backup_dir
+        self.keep = keep
+        self.compress = compress
+        self.stem = os.path.splitext(os.path.basename(db_name))[0]
+        # Только копии по расписанию и /backup; копии с пометкой (pre-restore) ротация не трогает
+        self._name_re = re.compile(rf"^{re.escape(self.stem)}-\d{{8}}-\d{{6}}\.db(\.gz)?$")
+        self._lock = threading.Lock()
+        self.last_success = None
+
+    def list_backups(self):
+        """Пути к копиям в папке, от новых к старым (время — в имени файла)."""
+        if not os.path.isdir(self.backup_dir):
+            return []
+        names = sorted((name for name in os.listdir(self.backup_dir) if self._name_re.match(name)), reverse=True)
+        return [os.path.join(self.backup_dir, name) for name in names]
+
+    def last_success_time(self):
+        """Время последней успешной копии; после перезапуска бота — по самому свежему файлу в папке."""
+        if self.last_success is None:
+            backups = self.list_backups()
+            self.last_success = os.path.getmtime(backups[0]) if backups else 0
+        return self.last_success
+
+    def create(self, label="", verify=True):
+        """Делает проверенную копию БД; возвращает BackupResult. Выполняется в потоке, а не в event loop."""
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("Резервное копирование уже выполняется.")
+        try:
+            started = perf_counter()
+            os.makedirs(self.backup_dir, exist_ok=True)
+            name = f"{self.stem}-{datetime.now():%Y%m%d-%H%M%S}{'-' + label if label else ''}.db"
+            path = os.path.join(self.backup_dir, name)
+            partial = path + ".partial"
+            compressed = path + ".gz.partial"
+            try:
+                db_size = self._copy(partial)
+                problems = check_database_file(partial) if verify else []
+                if problems:
+                    raise sqlite3.DatabaseError("Копия не прошла проверку целостности: " + "; ".join(problems[:5]))
+                if self.compress:
+                    with open(partial, "rb") as src, open(compressed, "wb") as raw:
+                        with gzip.GzipFile(filename=name, mode="wb", fileobj=raw, compresslevel=6) as dst:
+                            shutil.copyfileobj(src, dst, 1024 * 1024)
+                        raw.flush()
+                        os.fsync(raw.fileno())
+                    path += ".gz"
+                    os.replace(compressed, path)
+                else:
+                    _fsync_file(partial)
+                    os.replace(partial, path)
+            finally:
+                for leftover in (partial, compressed):
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+            if not label:
+                self.last_success = datetime.now().timestamp()
+                self.rotate()
+            return BackupResult(path, os.path.getsize(path), db_size, perf_counter() - started)
+        finally:
+            self._lock.release()
 
+    def _copy(self, target_path):
+        """Копирует БД в target_path шагами backup API; возвращает размер БД в байтах."""
+        source = sqlite3.connect(self.db_name, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+        target = sqlite3.connect(target_path)
+        try:
+            # Снимок на момент начала: транзакция чтения держится до конца копирования
+            source.execute("BEGIN")
+            source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+            # Файл копии синхронизируется на диск один раз целиком перед переименованием
+            target.execute("PRAGMA synchronous=OFF")
+            source.backup(target, pages=BACKUP_PAGES_PER_STEP, progress=lambda *_: sleep(BACKUP_STEP_PAUSE))
+            source.rollback()
+            # Копия унаследовала режим WAL; обычный журнал делает её одним самодостаточным файлом
+            target.execute("PRAGMA journal_mode=DELETE")
+            page_count = target.execute("PRAGMA page_count").fetchone()[0]
+            page_size = target.execute("PRAGMA page_size").fetchone()[0]
+            return page_count * page_size
+        finally:
+            target.close()
+            source.close()
 
+    def rotate(self):
+        """Удаляет копии сверх keep."""
+        for path in self.list_backups()[self.keep:]:
+            try:
+                os.remove(path)
+                logger.info(f"Удалена старая резервная копия {path}")
+            except OSError as e:
+                logger.warning(f"Не удалось удалить старую резервную копию {path}: {e}")
+
+    def restore(self, backup_path):
+        """
+        Заменяет содержимое БД копией (бот должен быть остановлен). Копия сначала проверяется,
+        текущая БД сохраняется копией с пометкой pre-restore; возвращает её BackupResult или None, если БД не было.
+        """
+        work = backup_path
+        if backup_path.endswith(".gz"):
+            work = self.db_name + ".restore"
+            with gzip.open(backup_path, "rb") as src, open(work, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+        try:
+            problems = check_database_file(work)
+            if problems:
+                raise sqlite3.DatabaseError("Копия не прошла проверку целостности: " + "; ".join(problems[:5]))
+            # Прежняя БД сохраняется как есть, даже повреждённая: восстанавливают обычно именно из-за этого
+            previous = self.create(label="pre-restore", verify=False) if os.path.exists(self.db_name) else None
+            source = sqlite3.connect(work)
+            target = sqlite3.connect(self.db_name, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+                source.close()
+            return previous
+        finally:
+            if work != backup_path and os.path.exists(work):
+                os.remove(work)
 
 
+backup_manager = BackupManager(DB_NAME, BACKUP_DIR)
+BACKUP_LAST_SUCCESS.func = lambda: backup_manager.last_success_time()
 
 
-# --- 2. РАБОТА С БАЗОЙ ДАННЫХ (SQLite) ---
+class AsyncDB:
+    """
+    Выполняет функции работы с БД в отдельных потоках, чтобы обработчики не блокировали event loop.
+    Все записи идут через единственный поток-писатель (SQLite всё равно допускает одного писателя),
+    чтение — через пул потоков-читателей, которые в режиме WAL не мешают записи.
+    Каждый поток работает через своё долгоживущее соединение из ConnectionManager.
+    """
 
-def init_db():
-    """Инициализирует базу данных и создает таблицы, если их нет."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cur = conn.cursor()
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                first_name TEXT,
-                last_name TEXT,
-                employee_id TEXT UNIQUE,
-                position TEXT,
-                is_registered BOOLEAN DEFAULT 1
-            )
-        ''')
-        # Создаём таблицу reports с базовыми колонками
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS reports (
-                report_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                report_date DATE
-                -- далее динамически добавим остальные столбцы
-            )
-        ''')
-        conn.commit()
+    def __init__(self, readers: int = DB_READER_THREADS):
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        # Резервное копирование идёт минутами (копия, проверка, сжатие) — в своём потоке, не занимая читателей
+        self._backup = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-backup")
+
+    async def read(self, func, *args, **kwargs):
+        """Выполняет читающую функцию в пуле читателей."""
+        return await self._run(self._readers, func, args, kwargs)
+
+    async def write(self, func, *args, **kwargs):
+        """Выполняет изменяющую функцию в потоке-писателе (записи выполняются строго по очереди)."""
+        return await self._run(self._writer, func, args, kwargs)
+
+    @staticmethod
+    async def _run(executor, func, args, kwargs):
+        # run_in_executor не переносит contextvars в поток — передаём контекст явно,
+        # чтобы запросы и время работы с БД засчитывались текущему обновлению
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(executor, ctx.run, AsyncDB._timed_call, func, args, kwargs)
+
+    @staticmethod
+    def _timed_call(func, args, kwargs):
+        started = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = perf_counter() - started
+            DB_CALL_DURATION.observe(elapsed, func.__name__)
+            stats = current_update_metrics.get()
+            if stats is not None:
+                stats.db_seconds += elapsed
 
-        # --- Проверка и добавление столбца 'position' в таблицу 'users' ---
-        cur.execute("PRAGMA table_info(users)")
-        user_cols = {row[1] for row in cur.fetchall()}
-        if 'position' not in user_cols:
-            try:
-                cur.execute('ALTER TABLE users ADD COLUMN position TEXT')
-                logger.info("Добавлен столбец 'position' в таблицу 'users'")
-            except Exception as e:
-                logger.exception(f"Не удалось добавить столбец 'position' в таблицу 'users': {e}")
+    def shutdown(self):
+        """Дожидается завершения запущенных запросов и останавливает потоки."""
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        self._backup.shutdown(wait=True)
 
-        # Получим текущие колонки таблицы reports
-        cur.execute("PRAGMA table_info(reports)")
-        existing_cols = {row[1] for row in cur.fetchall()}
+    # Асинхронные версии функций работы с БД.
+    # Запросы, которые обслуживает кэш пользователей, выполняются сразу, без перехода в поток.
+    async def user_exists(self, user_id):
+        if user_directory.loaded:
+            return user_exists(user_id)
+        return await self.read(user_exists, user_id)
 
-        # Нужно добавить user meta и все поля
-        required_cols = {
-            "user_id": "INTEGER",
-            "report_date": "DATE",
-        }
+    async def is_pending_approval(self, user_id):
+        if user_directory.loaded:
+            return is_pending_approval(user_id)
+        return await self.read(is_pending_approval, user_id)
 
-        for key, _ in NUMERIC_FIELDS + TEXT_FIELDS:
-            # все числовые — INTEGER, текстовые — TEXT
-            required_cols[key] = "INTEGER" if key in dict(NUMERIC_FIELDS) else "TEXT" # type: ignore
+    async def add_user(self, user_id, first_name, last_name, employee_id, position):
+        return await self.write(add_user, user_id, first_name, last_name, employee_id, position)
 
-        # Добавляем отсутствующие колонки
-        for col, col_type in required_cols.items():
-            if col not in existing_cols:
-                try:
-                    cur.execute(f'ALTER TABLE reports ADD COLUMN {col} {col_type}')
-                    logger.info(f"Добавлен столбец {col} {col_type} в таблицу reports")
-                except Exception as e:
-                    logger.exception(f"Не удалось добавить столбец {col}: {e}")
-        conn.commit()
+    async def add_pending_user(self, user_id):
+        return await self.write(add_pending_user, user_id)
 
-def user_exists(user_id):
-    """Проверяет, существует ли пользователь в базе."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
-        return cursor.fetchone() is not None
+    async def remove_pending_user(self, user_id):
+        return await self.write(remove_pending_user, user_id)
 
-def add_user(user_id, first_name, last_name, employee_id, position):
-    """Добавляет нового пользователя."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO users (user_id, first_name, last_name, employee_id, position) VALUES (?, ?, ?, ?, ?)",
-            (user_id, first_name, last_name, employee_id, position)
-        )
-        conn.commit()
+    async def has_submitted_report_today(self, user_id):
+        if submission_tracker.tracks(user_id):
+            return has_submitted_report_today(user_id)
+        return await self.read(has_submitted_report_today, user_id)
 
-def has_submitted_report_today(user_id):
-    """Проверяет, отправлял ли пользователь отчет сегодня."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        today = date.today()
-        cursor.execute(
-            "SELECT 1 FROM reports WHERE user_id = ? AND report_date = ?",
-            (user_id, today)
-        )
-        return cursor.fetchone() is not None
+    async def submit_report(self, user_id, data: dict, report_date=None):
+        return await self.write(submit_report, user_id, data, report_date)
 
-def add_report_row(user_id, data: dict):
-    """Добавляет новый отчет."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cols = ["user_id", "report_date"] + list(data.keys())
-        placeholders = ",".join("?" for _ in cols)
-        values = [user_id, date.today()] + [data[k] for k in data.keys()]
+    async def get_today_report(self, user_id):
+        return await self.read(get_today_report, user_id)
 
-        sql = f"INSERT INTO reports ({','.join(cols)}) VALUES ({placeholders})"
-        cursor.execute(sql, values)
-        conn.commit()
+    async def get_user_reports(self, user_id, direction="latest", boundary=None):
+        return await self.read(get_user_reports, user_id, direction, boundary)
 
-def update_report_today(user_id, data: dict):
-    """Обновляет сегодняшний отчет пользователя."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        set_clause = ", ".join(f"{k} = ?" for k in data.keys())
-        values = list(data.values()) + [user_id, date.today()]
-        sql = f"UPDATE reports SET {set_clause} WHERE user_id = ? AND report_date = ?"
-        cursor.execute(
-            sql, values
-        )
-        conn.commit()
+    async def get_user_by_employee_id(self, employee_id):
+        if user_directory.loaded:
+            return get_user_by_employee_id(employee_id)
+        return await self.read(get_user_by_employee_id, employee_id)
 
-def get_user_reports(user_id):
-    """Получает последний отчет пользователя."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT report_date, " + ", ".join(k for k, _ in NUMERIC_FIELDS + TEXT_FIELDS) + " FROM reports WHERE user_id = ? ORDER BY report_date DESC LIMIT 1", (user_id,))
-        return cursor.fetchall()
+    async def delete_user(self, user_id):
+        return await self.write(delete_user, user_id)
 
-def get_user_by_employee_id(employee_id):
-    """Находит пользователя по табельному номеру."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id, first_name, last_name FROM users WHERE employee_id = ?", (employee_id,))
-        return cursor.fetchone()
+    async def get_all_registered_users(self):
+        if user_directory.loaded:
+            return get_all_registered_users()
+        return await self.read(get_all_registered_users)
 
-def delete_user(user_id):
-    """Удаляет пользователя и все его отчеты (каскадно)."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        # Благодаря ON DELETE CASCADE, отчеты удалятся автоматически
-        cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
-        conn.commit()
+    async def get_users_submitted_today(self):
+        return await self.read(get_users_submitted_today)
 
-def get_all_registered_users():
-    """Получает всех зарегистрированных пользователей."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id, first_name, last_name, employee_id, position FROM users")
-        return cursor.fetchall()
+    async def get_data_version(self):
+        return await self.read(get_data_version)
 
-def get_users_submitted_today():
-    """Получает ID пользователей, отправивших отчет сегодня."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        today = date.today()
-        cursor.execute("SELECT DISTINCT user_id FROM reports WHERE report_date = ?", (today,))
-        return [row[0] for row in cursor.fetchall()]
+    async def build_reports_csv(self, export_filter: ExportFilter = None):
+        return await self.read(build_reports_csv, export_filter)
 
-def get_all_reports_for_csv():
-    """Получает все отчеты для выгрузки в CSV."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cur = conn.cursor()
-        # Составляем список колонок в нужном порядке
-        header_cols = ["first_name", "last_name", "employee_id", "position", "report_date"]
-        numeric_keys = [k for k, _ in NUMERIC_FIELDS]
-        text_keys = [k for k, _ in TEXT_FIELDS]
-        select_cols = ", ".join([f"u.{c}" for c in header_cols[:4]] + ["r.report_date"] + [f"r.{c}" for c in numeric_keys + text_keys])
-        sql = f'''
-            SELECT {select_cols}
-            FROM reports r
-            JOIN users u ON r.user_id = u.user_id
-            ORDER BY r.report_date DESC
-        '''
-        cur.execute(sql)
-        rows = cur.fetchall()
-        # Заголовки для CSV (человекочитаемые)
-        headers = ["Имя", "Фамилия", "Табельный номер", "Должность", "Дата"]
-        headers += [FULL_FIELD_LABELS[key] for key in numeric_keys + text_keys]
-        return headers, rows
+    async def build_reports_xlsx(self, export_filter: ExportFilter = None):
+        return await self.read(build_reports_xlsx, export_filter)
+
+    async def get_company_totals(self, period, period_start):
+        return await self.read(get_company_totals, period, period_start)
+
+    async def search_reports(self, fts_query, date_from=None, date_to=None):
+        return await self.read(search_reports, fts_query, date_from, date_to)
+
+    async def get_user_period_totals(self, user_id, period, period_start):
+        return await self.read(get_user_period_totals, user_id, period, period_start)
+
+    async def build_user_totals_csv(self, period, period_start):
+        return await self.read(build_user_totals_csv, period, period_start)
+
+    async def create_backup(self):
+        return await self._run(self._backup, backup_manager.create, (), {})
+
+
+db_async = AsyncDB()
+
+
+# --- Хранение состояния диалогов ---
+PERSISTENCE_FLUSH_INTERVAL = 5        # сек: как часто изменения user_data/диалогов сбрасываются в БД (update_interval PTB)
+PERSISTENCE_FLUSH_MAX_CHANGES = 200   # столько накопленных изменений пишутся сразу, частями внутри одного цикла
+
+
+def load_persistence_data(table, id_column):
+    """Возвращает {id: dict} из таблицы persistence_user_data или persistence_chat_data."""
+    conn = get_db_conn()
+    cur = conn.execute(f"SELECT {id_column}, data FROM {table}")
+    return {row_id: pickle.loads(data) for row_id, data in cur.fetchall()}
+
+def load_persistence_conversations(name):
+    conn = get_db_conn()
+    cur = conn.execute("SELECT key, state FROM persistence_conversations WHERE name = ?", (name,))
+    return {tuple(json.loads(key)): pickle.loads(state) for key, state in cur.fetchall()}
+
+def save_persistence_batch(user_data, chat_data, conversations):
+    """
+    Записывает накопленные изменения одной транзакцией.
+    user_data/chat_data: {id: bytes или None (удалить)}; conversations: {(name, key): bytes или None}.
+    """
+    conn = get_db_conn()
+    with conn:
+        for table, id_column, rows in (
+            ("persistence_user_data", "user_id", user_data),
+            ("persistence_chat_data", "chat_id", chat_data),
+        ):
+            conn.executemany(
+                f"INSERT INTO {table} ({id_column}, data) VALUES (?, ?) "
+                f"ON CONFLICT({id_column}) DO UPDATE SET data = excluded.data",
+                [(row_id, data) for row_id, data in rows.items() if data is not None]
+            )
+            conn.executemany(
+                f"DELETE FROM {table} WHERE {id_column} = ?",
+                [(row_id,) for row_id, data in rows.items() if data is None]
+            )
+        conn.executemany(
+            "INSERT INTO persistence_conversations (name, key, state) VALUES (?, ?, ?) "
+            "ON CONFLICT(name, key) DO UPDATE SET state = excluded.state",
+            [(name, key, state) for (name, key), state in conversations.items() if state is not None]
+        )
+        conn.executemany(
+            "DELETE FROM persistence_conversations WHERE name = ? AND key = ?",
+            [(name, key) for (name, key), state in conversations.items() if state is None]
+        )
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Сохраняет context.user_data, context.chat_data и состояния ConversationHandler в той же БД SQLite,
+    чтобы перезапуск бота (например, автодеплой на Render) не терял незаконченные отчеты.
+
+    Своего таймера нет: изменения в update_* передаёт цикл PTB, раз в update_interval
+    (PERSISTENCE_FLUSH_INTERVAL) секунд и сразу пачкой. Вся пачка пишется одной транзакцией через
+    поток-писатель сразу после этого цикла; если изменений в ней больше PERSISTENCE_FLUSH_MAX_CHANGES,
+    они пишутся частями по мере накопления. При штатной остановке PTB вызывает flush().
+    """
+
+    def __init__(self, flush_interval=PERSISTENCE_FLUSH_INTERVAL, max_changes=PERSISTENCE_FLUSH_MAX_CHANGES):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, callback_data=False),
+            update_interval=flush_interval,
+        )
+        self.max_changes = max_changes
+        # Несохранённые изменения; None означает «удалить запись»
+        self._user_data = {}
+        self._chat_data = {}
+        self._conversations = {}
+        self._scheduled = None   # запись, запланированная на конец текущего цикла PTB
+        self._retry = None       # повтор после неудачной записи
+        self._tasks = set()
+        self._write_lock = asyncio.Lock()
+
+    # --- Загрузка при старте ---
+    async def get_user_data(self):
+        return await db_async.read(load_persistence_data, "persistence_user_data", "user_id")
+
+    async def get_chat_data(self):
+        return await db_async.read(load_persistence_data, "persistence_chat_data", "chat_id")
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return await db_async.read(load_persistence_conversations, name)
+
+    # --- Изменения (PTB передаёт уже скопированные данные) ---
+    async def update_user_data(self, user_id, data):
+        self._user_data[user_id] = pickle.dumps(data) if data else None
+        await self._changed()
+
+    async def update_chat_data(self, chat_id, data):
+        self._chat_data[chat_id] = pickle.dumps(data) if data else None
+        await self._changed()
+
+    async def update_conversation(self, name, key, new_state):
+        self._conversations[(name, json.dumps(list(key)))] = None if new_state is None else pickle.dumps(new_state)
+        await self._changed()
+
+    async def drop_user_data(self, user_id):
+        self._user_data[user_id] = None
+        await self._changed()
+
+    async def drop_chat_data(self, chat_id):
+        self._chat_data[chat_id] = None
+        await self._changed()
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        for handle in (self._scheduled, self._retry):
+            if handle:
+                handle.cancel()
+        self._scheduled = self._retry = None
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._write_pending()
+
+    # --- Отложенная запись ---
+    def pending_count(self):
+        return len(self._user_data) + len(self._chat_data) + len(self._conversations)
+
+    async def _changed(self):
+        if self.pending_count() >= self.max_changes:
+            await self._write_pending()
+        elif self._scheduled is None:
+            # PTB вызывает update_* всех изменившихся пользователей и диалогов подряд, в одной итерации цикла
+            # событий, — call_soon запишет их все вместе, сразу после этой пачки, без лишнего ожидания
+            self._scheduled = asyncio.get_running_loop().call_soon(self._start_write)
+
+    def _start_write(self):
+        self._scheduled = self._retry = None
+        task = asyncio.create_task(self._write_pending())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _write_pending(self):
+        async with self._write_lock:
+            if not self.pending_count():
+                return
+            user_data, self._user_data = self._user_data, {}
+            chat_data, self._chat_data = self._chat_data, {}
+            conversations, self._conversations = self._conversations, {}
+            try:
+                await db_async.write(save_persistence_batch, user_data, chat_data, conversations)
+            except Exception as e:
+                logger.error(f"Не удалось сохранить состояние диалогов: {e}")
+                # Возвращаем изменения в очередь, не затирая те, что появились за время записи
+                for pending, failed in ((self._user_data, user_data), (self._chat_data, chat_data),
+                                        (self._conversations, conversations)):
+                    for k, v in failed.items():
+                        pending.setdefault(k, v)
+                if self._retry is None:
+                    self._retry = asyncio.get_running_loop().call_later(self.update_interval, self._start_write)
 
 
 # --- 3. КЛАВИАТУРЫ (МЕНЮ) ---
@@ -1421,6 +2343,21 @@ def start_registration_keyboard():
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
 
+@functools.lru_cache(maxsize=4096)
+def _report_button(text, callback_data):
+    # Кнопки неизменяемы, поэтому одинаковые кнопки разных отчётов можно переиспользовать
+    return InlineKeyboardButton(text, callback_data=callback_data)
+
+# Нижние строки меню отчёта не зависят от значений — собираем их один раз
+REPORT_MENU_CONTROL_ROWS = (
+    (InlineKeyboardButton("⚡ Ввести все числа одним сообщением", callback_data="action|bulk"),),
+    (
+        InlineKeyboardButton("✅ Отправить отчёт", callback_data="action|send"),
+        InlineKeyboardButton("❌ Отменить", callback_data="action|cancel"),
+    ),
+    (InlineKeyboardButton("🔄 Сбросить все введённые значения", callback_data="action|reset"),),
+)
+
 def build_report_inline_keyboard(current_values: dict):
     """
     current_values: dict key->value (может быть None если не заполнено)
@@ -1438,7 +2375,7 @@ def build_report_inline_keyboard(current_values: dict):
                 btn_text = f"{label} — (0)"
             else:
                 btn_text = f"{label} — ({display})"
-            row.append(InlineKeyboardButton(btn_text, callback_data=f"field|{key}"))
+            row.append(_report_button(btn_text, f"field|{key}"))
         keyboard.append(row)
 
     # текстовые — по 2 в ряд
@@ -1451,32 +2388,412 @@ def build_report_inline_keyboard(current_values: dict):
             else:
                 short = display if len(display) <= 20 else display[:17] + "..."
                 btn_text = f"{label} — ({short})"
-            row.append(InlineKeyboardButton(btn_text, callback_data=f"field|{key}"))
+            row.append(_report_button(btn_text, f"field|{key}"))
         keyboard.append(row)
 
     # команды управления
-    keyboard.append([
-        InlineKeyboardButton("✅ Отправить отчёт", callback_data="action|send"),
-        InlineKeyboardButton("❌ Отменить", callback_data="action|cancel"),
-    ])
-    keyboard.append([
-        InlineKeyboardButton("🔄 Сбросить все введённые значения", callback_data="action|reset")
-    ])
+    keyboard.extend(REPORT_MENU_CONTROL_ROWS)
     return InlineKeyboardMarkup(keyboard)
 
 
+# --- Рассылка сообщений ---
+# Лимиты Telegram Bot API: не более ~30 сообщений в секунду суммарно и ~1 сообщения в секунду в один чат.
+BROADCAST_RATE_PER_SECOND = 25       # держимся ниже глобального лимита с запасом
+BROADCAST_PER_CHAT_INTERVAL = 1.0    # минимальный интервал между сообщениями в один чат, секунды
+BROADCAST_CONCURRENCY = 8            # сколько запросов к API выполняется одновременно
+BROADCAST_MAX_ATTEMPTS = 3           # попыток на одного получателя при RetryAfter/сетевых ошибках
+
+
+class TokenBucket:
+    """
+    Ограничитель скорости «ведро с жетонами»: не больше rate операций в секунду в среднем
+    и не больше capacity подряд. pause() останавливает выдачу жетонов (например, после RetryAfter).
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = None
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        loop = asyncio.get_running_loop()
+        self._paused_until = max(self._paused_until, loop.time() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                now = loop.time()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                if self._updated is not None:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BroadcastResult:
+    """Итоги рассылки: доставлено, заблокировали бота, ошибки."""
+
+    def __init__(self):
+        self.sent = 0
+        self.blocked = []
+        self.failed = []
+        self.retries = 0
+        self.duration = 0.0
+
+    def summary_html(self):
+        return (
+            f"📨 Доставлено: <b>{self.sent}</b>\n"
+            f"🚫 Заблокировали бота: <b>{len(self.blocked)}</b>\n"
+            f"⚠️ Ошибки доставки: <b>{len(self.failed)}</b>\n"
+            f"⏱ Время рассылки: {self.duration:.1f} с"
+        )
+
+    def __str__(self):
+        return (f"доставлено {self.sent}, заблокировали {len(self.blocked)}, ошибок {len(self.failed)}, "
+                f"повторов {self.retries}, {self.duration:.1f} с")
+
+
+class BroadcastEngine:
+    """
+    Рассылка одного сообщения многим получателям с соблюдением лимитов Telegram.
+    Несколько воркеров берут получателей из очереди; общий TokenBucket ограничивает скорость,
+    при RetryAfter вся рассылка приостанавливается на указанное время, а сообщение ставится
+    в очередь повторно. Пользователи, заблокировавшие бота, учитываются отдельно.
+    """
+
+    def __init__(self, rate=BROADCAST_RATE_PER_SECOND, concurrency=BROADCAST_CONCURRENCY,
+                 per_chat_interval=BROADCAST_PER_CHAT_INTERVAL, max_attempts=BROADCAST_MAX_ATTEMPTS):
+        self.rate = rate
+        self.concurrency = concurrency
+        self.per_chat_interval = per_chat_interval
+        self.max_attempts = max_attempts
+
+    async def broadcast(self, bot, chat_ids, text, **send_kwargs) -> BroadcastResult:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        result = BroadcastResult()
+        # Без «запаса» жетонов: сообщения идут равномерно и не превышают лимит даже в первую секунду
+        bucket = TokenBucket(self.rate, capacity=1)
+        last_sent = {}
+        queue = asyncio.Queue()
+        for chat_id in chat_ids:
+            queue.put_nowait((chat_id, 1))
+        if queue.empty():
+            return result
+
+        async def worker():
+            while True:
+                chat_id, attempt = await queue.get()
+                try:
+                    # Лимит на один чат важен для повторных попыток
+                    wait = last_sent.get(chat_id, -self.per_chat_interval) + self.per_chat_interval - loop.time()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                    await bucket.acquire()
+                    last_sent[chat_id] = loop.time()
+                    await bot.send_message(chat_id=chat_id, text=text, **send_kwargs)
+                    result.sent += 1
+                except RetryAfter as e:
+                    retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                    logger.warning(f"Рассылка: превышен лимит Telegram, пауза {retry_after} с")
+                    bucket.pause(retry_after)
+                    self._retry(queue, result, chat_id, attempt, e)
+                except Forbidden:
+                    result.blocked.append(chat_id)
+                except BadRequest as e:
+                    # Например, «chat not found» — повтор не поможет
+                    result.failed.append((chat_id, str(e)))
+                except NetworkError as e:
+                    self._retry(queue, result, chat_id, attempt, e)
+                except Exception as e:
+                    logger.warning(f"Не удалось отправить сообщение пользователю {chat_id}: {e}")
+                    result.failed.append((chat_id, str(e)))
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(min(self.concurrency, queue.qsize()))]
+        try:
+            await queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        result.duration = loop.time() - started
+        return result
+
+    def _retry(self, queue, result, chat_id, attempt, error):
+        if attempt < self.max_attempts:
+            result.retries += 1
+            queue.put_nowait((chat_id, attempt + 1))
+        else:
+            logger.warning(f"Не удалось отправить сообщение пользователю {chat_id} после {attempt} попыток: {error}")
+            result.failed.append((chat_id, str(error)))
+
+
+broadcast_engine = BroadcastEngine()
+
+
+# --- Отложенное удаление сообщений ---
+DELETION_BATCH_WINDOW = 0.5   # удаления в один чат, наступающие в пределах окна, объединяются в один запрос
+DELETION_MAX_BATCH = 100      # deleteMessages принимает не более 100 идентификаторов за раз
+
+
+class MessageDeletionScheduler:
+    """
+    Удаляет сообщения через заданное время, не задерживая обработчик.
+    Время округляется вверх до окна DELETION_BATCH_WINDOW, и все сообщения одного чата,
+    попавшие в одно окно, удаляются одним вызовом deleteMessages по таймеру цикла событий.
+    """
+
+    def __init__(self, window=DELETION_BATCH_WINDOW):
+        self.window = window
+        self._buckets = {}   # (chat_id, slot) -> (bot, [message_id, ...])
+        self._timers = {}    # (chat_id, slot) -> asyncio.TimerHandle
+        self._tasks = set()
+
+    def schedule(self, bot, chat_id, message_ids, delay=0):
+        """Ставит сообщения message_ids чата chat_id на удаление через delay секунд и сразу возвращает управление."""
+        message_ids = [m for m in message_ids if m]
+        if not message_ids:
+            return
+        loop = asyncio.get_running_loop()
+        slot = -int(-(loop.time() + delay) // self.window)  # округление вверх до границы окна
+        key = (chat_id, slot)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = (bot, [])
+            self._timers[key] = loop.call_at(slot * self.window, self._flush, key)
+        bucket[1].extend(message_ids)
+
+    def pending_count(self):
+        return sum(len(ids) for _, ids in self._buckets.values())
+
+    def _flush(self, key):
+        self._timers.pop(key, None)
+        bot, message_ids = self._buckets.pop(key)
+        task = asyncio.create_task(self._delete(bot, key[0], message_ids))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    async def _delete(bot, chat_id, message_ids):
+        for i in range(0, len(message_ids), DELETION_MAX_BATCH):
+            chunk = message_ids[i:i + DELETION_MAX_BATCH]
+            try:
+                if len(chunk) == 1:
+                    await bot.delete_message(chat_id=chat_id, message_id=chunk[0])
+                else:
+                    await bot.delete_messages(chat_id=chat_id, message_ids=chunk)
+            except Exception as e:
+                logger.warning(f"Не удалось удалить сообщения {chunk} в чате {chat_id}: {e}")
+
+    async def flush_all(self):
+        """Немедленно удаляет всё, что ещё стоит в очереди (вызывается при остановке бота)."""
+        for key, timer in list(self._timers.items()):
+            timer.cancel()
+            self._flush(key)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+deletion_scheduler = MessageDeletionScheduler()
+
+
+# --- Обновление меню отчёта ---
+REPORT_MENU_REFRESH_DELAY = 0.7   # сек: изменения меню одного отчёта в пределах окна схлопываются в одно редактирование
+REPORT_MENU_MAX_TRACKED = 10000   # столько открытых меню помнится; брошенные без отправки и отмены вытесняются старейшими
+
+
+class ReportMenuRefresher:
+    """
+    Обновляет сообщение с меню отчёта не чаще одного раза за REPORT_MENU_REFRESH_DELAY.
+    Первый запрос запускает таймер, следующие запросы в пределах окна лишь заменяют данные,
+    и по таймеру отправляется одно editMessageText с последним состоянием. Если текст и клавиатура
+    не отличаются от уже показанных, запрос к API не выполняется вовсе.
+    В каждом чате одновременно открыто не больше одного меню отчёта, поэтому состояние хранится по chat_id.
+    Показанным считается только то, что Telegram действительно принял: после неудачной правки
+    следующий запрос с тем же содержимым отправляется снова.
+    """
+
+    def __init__(self, delay=REPORT_MENU_REFRESH_DELAY, max_tracked=REPORT_MENU_MAX_TRACKED):
+        self.delay = delay
+        self.max_tracked = max_tracked
+        self._pending = {}   # chat_id -> (bot, message_id, text, values)
+        self._timers = {}    # chat_id -> asyncio.TimerHandle
+        self._shown = OrderedDict()   # chat_id -> (message_id, text, markup), что сейчас видит пользователь
+        self._tasks = set()
+        self.edits_sent = 0
+        self.edits_skipped = 0
+
+    def remember(self, chat_id, message_id, text, markup):
+        """Запоминает меню, отправленное или изменённое в обход очереди; ожидающее обновление отменяется."""
+        self._cancel(chat_id)
+        self._shown[chat_id] = (message_id, text, markup)
+        self._shown.move_to_end(chat_id)
+        while len(self._shown) > self.max_tracked:
+            self._shown.popitem(last=False)
+
+    def request(self, bot, chat_id, message_id, text, values):
+        """Просит показать в меню значения values; само редактирование произойдёт по таймеру."""
+        self._pending[chat_id] = (bot, message_id, text, dict(values))
+        if chat_id not in self._timers:
+            loop = asyncio.get_running_loop()
+            self._timers[chat_id] = loop.call_later(self.delay, self._flush, chat_id)
+
+    def forget(self, chat_id):
+        """Меню закрыто (отчёт отправлен или отменён) — обновлять больше нечего."""
+        self._cancel(chat_id)
+        self._shown.pop(chat_id, None)
+
+    def _cancel(self, chat_id):
+        timer = self._timers.pop(chat_id, None)
+        if timer:
+            timer.cancel()
+        self._pending.pop(chat_id, None)
+
+    def _flush(self, chat_id):
+        self._timers.pop(chat_id, None)
+        bot, message_id, text, values = self._pending.pop(chat_id)
+        task = asyncio.create_task(self._edit(bot, chat_id, message_id, text, values))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _edit(self, bot, chat_id, message_id, text, values):
+        markup = build_report_inline_keyboard(values)
+        shown = (message_id, text, markup)
+        if self._shown.get(chat_id) == shown:
+            self.edits_skipped += 1
+            return
+        try:
+            await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, reply_markup=markup)
+            self.edits_sent += 1
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                logger.warning(f"Не удалось обновить меню отчёта в чате {chat_id}: {e}")
+                self._unknown(chat_id, message_id)
+                return
+        except Exception as e:
+            logger.warning(f"Не удалось обновить меню отчёта в чате {chat_id}: {e}")
+            self._unknown(chat_id, message_id)
+            return
+        # Пока шла правка, меню могли закрыть (forget) или заменить новым — тогда запоминать нечего
+        if self._shown.get(chat_id, (None,))[0] == message_id:
+            self._shown[chat_id] = shown
+
+    def _unknown(self, chat_id, message_id):
+        """Правка не прошла — что видит пользователь, неизвестно, и следующее обновление не пропускается."""
+        if self._shown.get(chat_id, (None,))[0] == message_id:
+            self._shown[chat_id] = (message_id, None, None)
+
+    async def flush_all(self):
+        """Немедленно выполняет все отложенные обновления (вызывается при остановке бота)."""
+        for chat_id, timer in list(self._timers.items()):
+            timer.cancel()
+            self._flush(chat_id)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+report_menu_refresher = ReportMenuRefresher()
+
+
+# --- Параллельная обработка обновлений ---
+MAX_CONCURRENT_UPDATES = 64   # сколько обновлений от разных пользователей обрабатывается одновременно
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обрабатывает обновления разных пользователей параллельно, а обновления одного пользователя —
+    строго по очереди, в порядке поступления. Так состояния ConversationHandler и context.user_data
+    одного сотрудника не гоняются друг с другом, а медленная выгрузка одного не задерживает остальных.
+    Слот из max_concurrent_updates обновление занимает только после того, как подошла его очередь у пользователя,
+    поэтому накопившиеся обновления одного сотрудника не отбирают слоты у других.
+    """
+
+    def __init__(self, max_concurrent_updates=MAX_CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}     # user_id/chat_id -> asyncio.Lock
+        self._waiters = {}   # user_id/chat_id -> сколько обновлений держат или ждут блокировку
+
+    @staticmethod
+    def _key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def process_update(self, update, coroutine):
+        # Базовый process_update сначала занимает семафор, а уже потом вызывает do_process_update —
+        # ожидание блокировки пользователя внутри него держало бы слот. Здесь порядок обратный.
+        key = self._key(update)
+        if key is None:
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+            return
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            # asyncio.Lock будит ожидающих в порядке очереди, поэтому порядок обновлений сохраняется
+            async with lock:
+                async with self._semaphore:
+                    await self.do_process_update(update, coroutine)
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                # Пользователь ничего больше не ждёт — блокировку можно выбросить
+                del self._waiters[key]
+                del self._locks[key]
+
+    async def do_process_update(self, update, coroutine):
+        await self._process_measured(coroutine)
+
+    @staticmethod
+    async def _process_measured(coroutine):
+        stats = UpdateMetrics()
+        token = current_update_metrics.set(stats)
+        started = perf_counter()
+        try:
+            await coroutine
+        finally:
+            current_update_metrics.reset(token)
+            UPDATE_DURATION.observe(perf_counter() - started)
+            UPDATE_DB_QUERIES.observe(stats.queries)
+            UPDATE_DB_SECONDS.observe(stats.db_seconds)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
 # --- 4. ЛОГИКА БОТА (ОБРАБОТЧИКИ) ---
 
 # --- Общие функции ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработчик команды /start. Также используется как точка входа в регистрацию."""
     user = update.effective_user
-    if user_exists(user.id):
+
+    # Если пользователь уже зарегистрирован, показать ему главное меню
+    if await db_async.user_exists(user.id):
         await show_main_menu(update, context)
         return ConversationHandler.END
 
     # Если пользователь уже в списке ожидания, просто сообщаем ему об этом
-    if is_pending_approval(user.id):
+    if await db_async.is_pending_approval(user.id):
         await update.message.reply_text(
             "Ваша заявка на доступ уже одобрена администратором. "
             "Пожалуйста, нажмите кнопку ниже, чтобы начать регистрацию.",
@@ -1485,9 +2802,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return ConversationHandler.END
 
     # Если пользователь новый, отправляем запрос администраторам
-    with get_db_conn() as conn:
-        conn.cursor().execute("INSERT INTO pending_users (user_id) VALUES (?)", (user.id,))
-        conn.commit()
+    await db_async.add_pending_user(user.id)
 
     await update.message.reply_text("Ваш запрос на доступ отправлен администратору. Пожалуйста, ожидайте.")
 
@@ -1522,6 +2837,8 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
     user_id = user.id
+    # Диалог завершается — незаконченное меню отчёта больше не обновляется
+    report_menu_refresher.forget(update.effective_chat.id)
     text, reply_markup = get_menu_for_user(user_id)
     # Отправляем новое сообщение, чтобы гарантированно показать ReplyKeyboard
     await context.bot.send_message(chat_id=update.effective_chat.id, text=text, reply_markup=reply_markup)
@@ -1546,7 +2863,7 @@ async def start_registration(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = update.effective_user.id
 
     # Дополнительная проверка: разрешена ли регистрация
-    if not is_pending_approval(user_id):
+    if not await db_async.is_pending_approval(user_id):
         await update.message.reply_text("Ваша заявка еще не одобрена администратором.", reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
 
@@ -1589,7 +2906,7 @@ async def register_position(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user = update.effective_user
     context.user_data['position'] = update.message.text
     try:
-        add_user(
+        await db_async.add_user(
             user_id=user.id,
             first_name=context.user_data.get('first_name'),
             last_name=context.user_data.get('last_name'),
@@ -1597,11 +2914,12 @@ async def register_position(update: Update, context: ContextTypes.DEFAULT_TYPE)
             position=context.user_data.get('position')
         )
         # Удаляем пользователя из списка ожидания после успешной регистрации
-        with get_db_conn() as conn:
-            conn.cursor().execute("DELETE FROM pending_users WHERE user_id = ?", (user.id,))
-            conn.commit()
+        await db_async.remove_pending_user(user.id)
 
         await update.message.reply_text("🎉 Регистрация успешно завершена!")
+        # Показываем главное меню только после УСПЕШНОЙ регистрации
+        await show_main_menu(update, context)
+
     except sqlite3.IntegrityError:
         logger.warning(f"Попытка регистрации с дублирующимся табельным номером: {context.user_data.get('employee_id')}")
         await update.message.reply_text(
@@ -1609,6 +2927,7 @@ async def register_position(update: Update, context: ContextTypes.DEFAULT_TYPE)
             "Пожалуйста, начните регистрацию заново с корректным номером.",
             reply_markup=start_registration_keyboard()
         )
+        # Не показываем меню, а даем возможность исправить ошибку
     except Exception as e:
         logger.error(f"Ошибка при регистрации пользователя {user.id}: {e}")
         await update.message.reply_text(
@@ -1622,7 +2941,7 @@ async def start_submit_report(update: Update, context: ContextTypes.DEFAULT_TYPE
     user_id = update.effective_user.id
     user = update.effective_user
 
-    if has_submitted_report_today(user_id):
+    if await db_async.has_submitted_report_today(user_id):
         await update.message.reply_text(
             "Вы уже отправляли отчет сегодня. Хотите его отредактировать?",
             reply_markup=confirm_edit_keyboard()
@@ -1637,29 +2956,26 @@ async def start_submit_report(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     markup = build_report_inline_keyboard(context.user_data['pending_report'])
     # Сохраняем сообщение-id, чтобы редактировать клавиатуру в будущем
-    msg = await update.message.reply_text("Пожалуйста, заполните отчёт. Нажмите на нужное поле:", reply_markup=markup)
+    text = "Пожалуйста, заполните отчёт. Нажмите на нужное поле:"
+    msg = await update.message.reply_text(text, reply_markup=markup)
     context.user_data['pending_report_msg_id'] = msg.message_id
+    report_menu_refresher.remember(update.effective_chat.id, msg.message_id, text, markup)
     return SHOW_REPORT_MENU
 
 async def start_edit_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Начинает диалог редактирования отчета (загружает существующие данные)."""
     user_id = update.effective_user.id
-    with get_db_conn() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM reports WHERE user_id = ? AND report_date = ?", (user_id, date.today()))
-        row = cur.fetchone()
-        if not row:
-            await update.message.reply_text("Ваш сегодняшний отчет не найден. Создайте новый.", reply_markup=user_main_menu_keyboard())
-            return ConversationHandler.END
-        cols = [d[0] for d in cur.description]
-        rowdict = dict(zip(cols, row))
-        pending = {k: rowdict.get(k) for k, _ in ALL_FIELDS}
-        context.user_data['pending_report'] = pending
-        markup = build_report_inline_keyboard(context.user_data['pending_report'])
-        msg = await update.message.reply_text("Загружен ваш сегодняшний отчет. Внесите необходимые правки.", reply_markup=markup, reply_keyboard_remove=True)
-        msg = await update.message.reply_text("Загружен ваш сегодняшний отчет. Внесите необходимые правки.", reply_markup=markup)
-        context.user_data['pending_report_msg_id'] = msg.message_id
-        return SHOW_REPORT_MENU
+    pending = await db_async.get_today_report(user_id)
+    if pending is None:
+        await update.message.reply_text("Ваш сегодняшний отчет не найден. Создайте новый.", reply_markup=user_main_menu_keyboard())
+        return ConversationHandler.END
+    context.user_data['pending_report'] = pending
+    markup = build_report_inline_keyboard(context.user_data['pending_report'])
+    text = "Загружен ваш сегодняшний отчет. Внесите необходимые правки."
+    msg = await update.message.reply_text(text, reply_markup=markup)
+    context.user_data['pending_report_msg_id'] = msg.message_id
+    report_menu_refresher.remember(update.effective_chat.id, msg.message_id, text, markup)
+    return SHOW_REPORT_MENU
 
 async def callback_report_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """CallbackQueryHandler для инлайн-кнопок отчёта."""
@@ -1671,6 +2987,10 @@ async def callback_report_menu(update: Update, context: ContextTypes.DEFAULT_TYP
     if 'pending_report' not in context.user_data:
         context.user_data['pending_report'] = {k: None for k, _ in ALL_FIELDS}
 
+    # Подсказка от предыдущего поля или пакетного ввода больше не нужна
+    if data.startswith("field|") or data == "action|bulk":
+        deletion_scheduler.schedule(context.bot, query.message.chat_id, [context.user_data.pop('prompt_msg_id', None)])
+
     if data.startswith("field|"):
         key = data.split("|", 1)[1]
         context.user_data['awaiting_field'] = key
@@ -1691,6 +3011,12 @@ async def callback_report_menu(update: Update, context: ContextTypes.DEFAULT_TYP
         context.user_data['prompt_msg_id'] = prompt_msg.message_id
         return AWAITING_FIELD_VALUE
 
+    if data == "action|bulk":
+        context.user_data.pop('awaiting_field', None)
+        prompt_msg = await query.message.reply_text(bulk_prompt_text(), parse_mode='HTML')
+        context.user_data['prompt_msg_id'] = prompt_msg.message_id
+        return AWAITING_BULK_VALUES
+
     if data == "action|send":
         pending = context.user_data.get('pending_report', {})
         for k, _ in ALL_FIELDS:
@@ -1700,73 +3026,62 @@ async def callback_report_menu(update: Update, context: ContextTypes.DEFAULT_TYP
 
         try:
             confirmation_msg = None
-            if has_submitted_report_today(user.id):
-                update_report_today(user.id, pending)
-                confirmation_msg = await query.message.reply_text("✅ Ваш сегодняшний отчёт успешно обновлён.")
-            else:
-                add_report_row(user.id, pending)
+            if await db_async.submit_report(user.id, pending):
                 confirmation_msg = await query.message.reply_text("✅ Отчёт успешно отправлен. Спасибо!")
+            else:
+                confirmation_msg = await query.message.reply_text("✅ Ваш сегодняшний отчёт успешно обновлён.")
             
-            # Удаляем основное сообщение с меню отчета
-            main_report_msg_id = context.user_data.get('pending_report_msg_id')
-            if main_report_msg_id:
-                await context.bot.delete_message(chat_id=query.message.chat_id, message_id=main_report_msg_id)
-
-            # Удаляем финальное подтверждение через 5 секунд
-            if confirmation_msg:
-                await asyncio.sleep(5)
-                await context.bot.delete_message(chat_id=query.message.chat_id, message_id=confirmation_msg.message_id)
+            # Удаляем основное сообщение с меню отчета сразу, а финальное подтверждение — через 5 секунд
+            report_menu_refresher.forget(query.message.chat_id)
+            deletion_scheduler.schedule(context.bot, query.message.chat_id, [context.user_data.get('pending_report_msg_id')])
+            deletion_scheduler.schedule(context.bot, query.message.chat_id, [confirmation_msg.message_id], delay=5)
         except Exception as e:
             logger.exception(f"Ошибка при сохранении отчёта: {e}")
             await query.message.reply_text("❌ Произошла ошибка при сохранении отчёта. Попробуйте позже.")
         finally:
-            context.user_data.clear() # Очищаем временные данные
-            await show_main_menu(query, context) # Возвращаем пользователя в главное меню
+            context.user_data.clear()
             # await show_main_menu(query, context) # Не нужно, т.к. основное меню не пропадало
         return ConversationHandler.END
 
     if data == "action|cancel":
-        context.user_data.clear()
         # Удаляем основное сообщение с меню отчета
         main_report_msg_id = context.user_data.get('pending_report_msg_id')
-        if main_report_msg_id:
-            await context.bot.delete_message(chat_id=query.message.chat_id, message_id=main_report_msg_id)
+        context.user_data.clear()
+        report_menu_refresher.forget(query.message.chat_id)
+        deletion_scheduler.schedule(context.bot, query.message.chat_id, [main_report_msg_id])
 
         confirmation_msg = await query.message.reply_text("Действие отменено. Отчёт не был отправлен.")
         
         # Удаляем сообщение через 5 секунд
-        await asyncio.sleep(5)
-        await context.bot.delete_message(chat_id=query.message.chat_id, message_id=confirmation_msg.message_id)
+        deletion_scheduler.schedule(context.bot, query.message.chat_id, [confirmation_msg.message_id], delay=5)
 
-        await show_main_menu(query, context) # Возвращаем пользователя в главное меню
+        # await show_main_menu(query, context) # Не нужно, т.к. основное меню не пропадало
         return ConversationHandler.END
 
     if data == "action|reset":
         for k, _ in ALL_FIELDS:
             context.user_data['pending_report'][k] = None
         new_markup = build_report_inline_keyboard(context.user_data['pending_report'])
+        text = "Значения сброшены. Заполните отчет заново:"
         try:
-            await query.edit_message_text("Значения сброшены. Заполните отчет заново:", reply_markup=new_markup)
+            await query.edit_message_text(text, reply_markup=new_markup)
+            report_menu_refresher.remember(query.message.chat_id, query.message.message_id, text, new_markup)
         except Exception:
             await query.message.reply_text("Значения сброшены.", reply_markup=new_markup)
         return SHOW_REPORT_MENU
 
     if data == "action|edit_today":
-        with get_db_conn() as conn:
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM reports WHERE user_id = ? AND report_date = ?", (user.id, date.today()))
-            row = cur.fetchone()
-            if not row:
-                await query.message.reply_text("Запись не найдена.")
-                return ConversationHandler.END
-            cols = [d[0] for d in cur.description]
-            rowdict = dict(zip(cols, row))
-            pending = {k: rowdict.get(k) for k, _ in ALL_FIELDS}
-            context.user_data['pending_report'] = pending
-            markup = build_report_inline_keyboard(context.user_data['pending_report'])
-            msg = await query.message.reply_text("Редактируйте поля. Нажмите на нужное поле для изменения.", reply_markup=markup)
-            context.user_data['pending_report_msg_id'] = msg.message_id
-            return SHOW_REPORT_MENU
+        pending = await db_async.get_today_report(user.id)
+        if pending is None:
+            await query.message.reply_text("Запись не найдена.")
+            return ConversationHandler.END
+        context.user_data['pending_report'] = pending
+        markup = build_report_inline_keyboard(context.user_data['pending_report'])
+        text = "Редактируйте поля. Нажмите на нужное поле для изменения."
+        msg = await query.message.reply_text(text, reply_markup=markup)
+        context.user_data['pending_report_msg_id'] = msg.message_id
+        report_menu_refresher.remember(query.message.chat_id, msg.message_id, text, markup)
+        return SHOW_REPORT_MENU
 
 async def message_fill_field(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает ввод значения после того, как пользователь нажал кнопку поля."""
@@ -1786,18 +3101,19 @@ async def message_fill_field(update: Update, context: ContextTypes.DEFAULT_TYPE)
             context.user_data['pending_report'][awaiting] = text
             confirmation_msg = await update.message.reply_text(f"Сохранено текстовое поле.")
         
-        # Удаляем сообщение пользователя и подтверждение через 3 секунды
-        await asyncio.sleep(3)
-        prompt_msg_id = context.user_data.pop('prompt_msg_id', None)
-        if prompt_msg_id:
-            await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=prompt_msg_id)
-        await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=update.message.message_id)
-        await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=confirmation_msg.message_id)
+        # Удаляем подсказку, сообщение пользователя и подтверждение через 3 секунды
+        deletion_scheduler.schedule(
+            context.bot, update.effective_chat.id,
+            [context.user_data.pop('prompt_msg_id', None), update.message.message_id, confirmation_msg.message_id],
+            delay=3,
+        )
 
     except ValueError:
-        await update.message.reply_text("Пожалуйста, введите корректное целое число (>=0) или используйте /skip.", quote=True)
-        # Отвечаем на сообщение пользователя с ошибкой
-        return AWAITING_FIELD_VALUE
+        await update.message.reply_text(
+            "Пожалуйста, введите корректное целое число (>=0) или используйте /skip.",
+            reply_to_message_id=update.message.message_id
+        ) # Отвечаем на сообщение пользователя с ошибкой
+        return AWAITING_FIELD_VALUE # Остаемся в том же состоянии, чтобы пользователь мог исправить
     finally:
         # Этот блок больше не нужен здесь, так как мы не выходим из состояния при ошибке
         context.user_data.pop('awaiting_field', None)
@@ -1805,16 +3121,11 @@ async def message_fill_field(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     msg_id = context.user_data.get('pending_report_msg_id')
     if msg_id:
-        try:
-            new_markup = build_report_inline_keyboard(context.user_data['pending_report'])
-            await context.bot.edit_message_text(
-                chat_id=update.effective_chat.id,
-                message_id=msg_id,
-                text="Отчет обновлен. Нажмите на следующее поле или отправьте отчет.",
-                reply_markup=new_markup
-            )
-        except Exception as e:
-            logger.warning(f"Не удалось обновить клавиатуру: {e}")
+        # Быстрые правки подряд схлопываются в одно редактирование меню
+        report_menu_refresher.request(
+            context.bot, update.effective_chat.id, msg_id,
+            "Отчет обновлен. Нажмите на следующее поле или отправьте отчет.", context.user_data['pending_report'],
+        )
     return SHOW_REPORT_MENU
 
 async def skip_field(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1833,33 +3144,223 @@ async def skip_field(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     confirmation_msg = await update.message.reply_text("Поле пропущено и установлено по умолчанию.")
 
-    # Удаляем подтверждение через 3 секунды
-    await asyncio.sleep(3)
-    prompt_msg_id = context.user_data.get('prompt_msg_id')
-    if prompt_msg_id:
-        await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=prompt_msg_id)
-    await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=confirmation_msg.message_id)
+    # Удаляем подсказку и подтверждение через 3 секунды
+    deletion_scheduler.schedule(
+        context.bot, update.effective_chat.id,
+        [context.user_data.pop('prompt_msg_id', None), confirmation_msg.message_id],
+        delay=3,
+    )
 
     msg_id = context.user_data.get('pending_report_msg_id')
     if msg_id:
+        # Быстрые правки подряд схлопываются в одно редактирование меню
+        report_menu_refresher.request(
+            context.bot, update.effective_chat.id, msg_id,
+            "Отчет обновлен. Нажмите на следующее поле или отправьте отчет.", context.user_data['pending_report'],
+        )
+    return SHOW_REPORT_MENU
+
+# --- Ввод всех чисел одним сообщением ---
+# Сообщение похоже на пакетный ввод, если в нём есть цифры и только латиница, цифры, разделители и «=»/«:».
+BULK_INPUT_RE = re.compile(r"^(?=.*\d)[0-9A-Za-z_\s=:,;+-]+$")
+BULK_TOKEN_SEPARATORS_RE = re.compile(r"[\s,;]+")
+BULK_PAIR_SPACES_RE = re.compile(r"\s*([=:])\s*")
+
+
+def parse_bulk_report(text):
+    """
+    Разбирает значения всех числовых полей из одного сообщения. Поддерживаются два формата:
+      • 14 чисел подряд в порядке полей отчёта (через пробел, перевод строки, запятую или «;»);
+      • пары «поле=значение», где поле — ключ из NUMERIC_FIELDS или его номер (1–14); можно указать не все поля.
+    Возвращает dict key->int. При ошибках выбрасывает ValueError со списком всех проблем сразу.
+    """
+    numeric_keys = [k for k, _ in NUMERIC_FIELDS]
+    tokens = [t for t in BULK_TOKEN_SEPARATORS_RE.split(BULK_PAIR_SPACES_RE.sub(r"\1", text.strip())) if t]
+    if not tokens:
+        raise ValueError("Сообщение не содержит значений.")
+
+    errors = []
+    values = {}
+
+    def parse_value(raw, label):
         try:
-            new_markup = build_report_inline_keyboard(context.user_data['pending_report'])
-            await context.bot.edit_message_text(
-                chat_id=update.effective_chat.id,
-                message_id=msg_id,
-                text="Отчет обновлен. Нажмите на следующее поле или отправьте отчет.",
-                reply_markup=new_markup
-            )
-        except Exception as e:
-            logger.warning(f"Не удалось обновить клавиатуру после /skip: {e}")
+            val = int(raw)
+        except ValueError:
+            errors.append(f"{label}: «{raw}» — не целое число")
+            return None
+        if val < 0:
+            errors.append(f"{label}: число должно быть >= 0")
+            return None
+        return val
+
+    pairs = [t for t in tokens if '=' in t or ':' in t]
+    if pairs and len(pairs) != len(tokens):
+        raise ValueError("Используйте один формат: либо только числа по порядку, либо только пары поле=значение.")
+
+    if pairs:
+        for token in tokens:
+            name, _, raw = token.replace(':', '=').partition('=')
+            if name.isdigit() and 1 <= int(name) <= len(numeric_keys):
+                key = numeric_keys[int(name) - 1]
+            elif name.lower() in numeric_keys:
+                key = name.lower()
+            else:
+                errors.append(f"«{name}» — неизвестное поле")
+                continue
+            if key in values:
+                errors.append(f"{FULL_FIELD_LABELS[key]}: указано несколько раз")
+                continue
+            values[key] = parse_value(raw, FULL_FIELD_LABELS[key])
+    else:
+        if len(tokens) != len(numeric_keys):
+            raise ValueError(f"Ожидается {len(numeric_keys)} чисел, получено {len(tokens)}.")
+        for key, raw in zip(numeric_keys, tokens):
+            values[key] = parse_value(raw, FULL_FIELD_LABELS[key])
+
+    if errors:
+        raise ValueError("\n".join(errors))
+    return values
+
+
+def bulk_prompt_text():
+    fields_list = "\n".join(f"{i}. {FULL_FIELD_LABELS[key]}" for i, (key, _) in enumerate(NUMERIC_FIELDS, 1))
+    return (
+        f"Отправьте одним сообщением <b>{len(NUMERIC_FIELDS)} чисел</b> через пробел или с новой строки, "
+        f"в таком порядке:\n{fields_list}\n\n"
+        f"Можно указать только нужные поля парами <code>номер=значение</code>, например: <code>1=5 3=2 14=1</code>.\n"
+        f"<i>Чтобы вернуться к полям по одному, нажмите любую кнопку в меню отчёта.</i>"
+    )
+
+
+async def message_bulk_values(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Применяет к отчёту все числовые значения из одного сообщения."""
+    if 'pending_report' not in context.user_data:
+        return await unknown_message_handler(update, context)
+    try:
+        values = parse_bulk_report(update.message.text)
+    except ValueError as e:
+        await update.message.reply_text(
+            f"Не удалось разобрать значения:\n{html.escape(str(e))}\n\nИсправьте и отправьте сообщение ещё раз.",
+            parse_mode='HTML', reply_to_message_id=update.message.message_id
+        )
+        return AWAITING_BULK_VALUES if context.user_data.get('prompt_msg_id') else SHOW_REPORT_MENU
+
+    context.user_data['pending_report'].update(values)
+    confirmation_msg = await update.message.reply_text(f"Сохранено значений: {len(values)}.")
+
+    # Удаляем подсказку, сообщение пользователя и подтверждение через 3 секунды
+    deletion_scheduler.schedule(
+        context.bot, update.effective_chat.id,
+        [context.user_data.pop('prompt_msg_id', None), update.message.message_id, confirmation_msg.message_id],
+        delay=3,
+    )
+
+    msg_id = context.user_data.get('pending_report_msg_id')
+    if msg_id:
+        # Быстрые правки подряд схлопываются в одно редактирование меню
+        report_menu_refresher.request(
+            context.bot, update.effective_chat.id, msg_id,
+            "Отчет обновлен. Проверьте значения и отправьте отчет.", context.user_data['pending_report'],
+        )
     return SHOW_REPORT_MENU
 
 # --- Логика просмотра отчетов ---
+HISTORY_SUMMARY_PERIODS = {"w": "week", "m": "month"}
+HISTORY_FIELD_MAX_CHARS = 300   # длинные текстовые поля в истории обрезаются, полностью они есть в выгрузке
+HISTORY_MESSAGE_MAX_CHARS = 4000  # Telegram не принимает сообщения длиннее 4096 символов
+
+def history_report_text(row):
+    """Один отчет страницы истории; все значения экранируются, длинные тексты обрезаются."""
+    text = f"📅 <b>Дата:</b> {html.escape(str(row[0]))}\n"
+    for i, (key, _) in enumerate(ALL_FIELDS):
+        label = html.escape(FULL_FIELD_LABELS.get(key, key))
+        value = row[i+1]
+        if not value:
+            text += f" - {label}: <i>(пусто)</i>\n"
+            continue
+        value = str(value)
+        if len(value) > HISTORY_FIELD_MAX_CHARS:
+            value = value[:HISTORY_FIELD_MAX_CHARS].rstrip() + "…"
+        text += f" - {label}: {html.escape(value)}\n"
+    return text + "--------------------\n"
+
+def history_page_text(rows, direction="latest"):
+    """
+    (текст, сколько отчетов в него поместилось). Отчеты добавляются, пока сообщение укладывается
+    в HISTORY_MESSAGE_MAX_CHARS; при листании «позже» оставляются ближайшие к границе, то есть более старые.
+    """
+    header = "📂 <b>Ваши отчеты:</b>\n\n"
+    blocks = [history_report_text(r) for r in rows]
+    order = range(len(blocks) - 1, -1, -1) if direction == "newer" else range(len(blocks))
+    kept, length = [], len(header)
+    for index in order:
+        if kept and length + len(blocks[index]) > HISTORY_MESSAGE_MAX_CHARS:
+            break
+        kept.append(index)
+        length += len(blocks[index])
+    kept.sort()
+    return header + "".join(blocks[i] for i in kept), kept
+
+def history_page_keyboard(rows, direction, has_more, page):
+    """
+    Кнопки страницы истории. Граница листания — дата крайнего показанного отчета, поэтому состояние
+    не хранится: callback_data «hist|o|<дата>» / «hist|n|<дата>» сами задают следующую страницу.
+    page — callback_data текущей страницы (без «hist|»), чтобы из итогов вернуться на нее же.
+    """
+    # В сторону, откуда пришли, отчеты точно есть; в сторону листания — если запрос вернул лишний
+    has_older = has_more if direction in ("latest", "older") else True
+    has_newer = has_more if direction == "newer" else direction == "older"
+    newest, oldest = rows[0][0], rows[-1][0]
+    navigation = []
+    if has_older:
+        navigation.append(InlineKeyboardButton("◀ Раньше", callback_data=f"hist|o|{oldest}"))
+    if has_newer:
+        navigation.append(InlineKeyboardButton("Позже ▶", callback_data=f"hist|n|{newest}"))
+    keyboard = [navigation] if navigation else []
+    keyboard.append([
+        InlineKeyboardButton("📅 Итоги недели", callback_data=f"hist|s|w|{newest}|{page}"),
+        InlineKeyboardButton("🗓 Итоги месяца", callback_data=f"hist|s|m|{newest}|{page}"),
+    ])
+    return InlineKeyboardMarkup(keyboard)
+
+async def build_history_page(user_id, direction="latest", boundary=None):
+    """(текст, клавиатура) страницы истории или None, если отчетов в этом направлении нет."""
+    rows, has_more = await db_async.get_user_reports(user_id, direction, boundary)
+    if not rows:
+        return None
+    page = {"older": "o", "newer": "n"}.get(direction, "l") + (f"|{boundary}" if boundary else "")
+    text, kept = history_page_text(rows, direction)
+    if len(kept) < len(rows):
+        # Не поместившиеся отчеты остаются в направлении листания и откроются следующей страницей
+        rows, has_more = [rows[i] for i in kept], True
+    return text, history_page_keyboard(rows, direction, has_more, page)
+
+async def build_history_summary(user_id, period_code, start, page):
+    """(текст, клавиатура) с итогами сотрудника за неделю или месяц — одна строка из report_totals_user."""
+    period = HISTORY_SUMMARY_PERIODS[period_code]
+    totals = await db_async.get_user_period_totals(user_id, period, start)
+    text = f"📈 <b>Ваши итоги: {summary_period_label(period, start)}</b>\n\n"
+    if totals is None:
+        text += "<i>За этот период отчетов нет.</i>\n"
+    else:
+        text += f"Отчетов: <b>{totals['reports']}</b>\n\n"
+        for key, _ in NUMERIC_FIELDS:
+            text += f" - {FULL_FIELD_LABELS.get(key, key)}: <b>{totals[key]}</b>\n"
+
+    navigation = [InlineKeyboardButton(
+        "◀ Раньше", callback_data=f"hist|s|{period_code}|{previous_period_start(period, start)}|{page}"
+    )]
+    next_start = summary_period_start(period, start + timedelta(days=31 if period == "month" else 7))
+    if next_start <= local_today():
+        navigation.append(InlineKeyboardButton("Позже ▶", callback_data=f"hist|s|{period_code}|{next_start}|{page}"))
+    keyboard = [navigation, [InlineKeyboardButton("⬅️ К отчетам", callback_data=f"hist|{page}")]]
+    return text, InlineKeyboardMarkup(keyboard)
+
 async def show_my_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    reports = get_user_reports(user_id)
+    page = await build_history_page(user_id)
 
-    if not reports:
+    if page is None:
         # Если отчетов нет, показываем сообщение и возвращаем пользователя в главное меню
         _, reply_markup = get_menu_for_user(user_id)
         await update.message.reply_text(
@@ -1868,26 +3369,54 @@ async def show_my_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    # Формируем и отправляем сообщение с последним отчетом
-    message_text = "📂 <b>Ваш последний отчет:</b>\n\n"
-    for r in reports:
-        report_date = r[0]
-        message_text += (
-            f"📅 <b>Дата:</b> {report_date}\n"
-        )
-        for i, (key, _) in enumerate(ALL_FIELDS):
-            label = FULL_FIELD_LABELS.get(key, key)
-            value = r[i+1]
-            message_text += f" - {label}: {value or '<i>(пусто)</i>'}\n"
-        message_text += "--------------------\n"
-
-    # После просмотра отчетов возвращаем пользователю его основную клавиатуру
+    text, keyboard = page
+    # У сообщения может быть только одна клавиатура: главное меню возвращается отдельной строкой,
+    # а под страницей — кнопки листания
     _, reply_markup = get_menu_for_user(user_id)
-    await update.message.reply_text(message_text, parse_mode='HTML', reply_markup=reply_markup)
+    await update.message.reply_text("📂 История отчетов: листайте кнопками под сообщением.", reply_markup=reply_markup)
+    await update.message.reply_text(text, parse_mode='HTML', reply_markup=keyboard)
+
+async def callback_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Листание истории отчетов и итоги за неделю/месяц: одно чтение по индексу и одна правка сообщения."""
+    query = update.callback_query
+    await query.answer()
+    user_id = query.from_user.id
+    parts = query.data.split("|")[1:]
+
+    try:
+        if parts[0] == "s":
+            period = HISTORY_SUMMARY_PERIODS[parts[1]]
+            start = summary_period_start(period, date.fromisoformat(parts[2]))
+            result = await build_history_summary(user_id, parts[1], start, "|".join(parts[3:]))
+        else:
+            direction = {"o": "older", "n": "newer"}.get(parts[0], "latest")
+            result = await build_history_page(user_id, direction, parts[1] if len(parts) > 1 else None)
+            # Отчеты могли удалить — тогда показываем самые новые
+            if result is None:
+                result = await build_history_page(user_id)
+    except (KeyError, IndexError, ValueError):
+        logger.warning(f"Некорректные данные кнопки истории: {query.data}")
+        return
+    if result is None:
+        await query.edit_message_text("У вас пока нет ни одного отчета.")
+        return
+
+    text, keyboard = result
+    try:
+        await query.edit_message_text(text, parse_mode='HTML', reply_markup=keyboard)
+    except BadRequest as e:
+        if "not modified" in str(e).lower():
+            return
+        # Сообщение могло быть удалено или стать слишком старым для правки — показываем страницу заново
+        logger.warning(f"Не удалось обновить страницу истории пользователя {user_id}: {e}")
+        try:
+            await context.bot.send_message(user_id, text, parse_mode='HTML', reply_markup=keyboard)
+        except BadRequest as e:
+            logger.error(f"Не удалось показать страницу истории пользователю {user_id}: {e}")
 
 async def show_all_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает администратору список всех зарегистрированных пользователей."""
-    all_users = get_all_registered_users()
+    all_users = await db_async.get_all_registered_users()
 
     if not all_users:
         await update.message.reply_text(
@@ -1918,23 +3447,18 @@ async def start_delete_user(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """Начинает диалог удаления пользователя."""
     await update.message.reply_text(
         "Введите табельный номер сотрудника, которого хотите удалить.",
-        reply_markup=ReplyKeyboardMarkup(
-            [[KeyboardButton("Отмена")]],
-            resize_keyboard=True, one_time_keyboard=True
-        )
+        reply_markup=ReplyKeyboardRemove()
     )
     return DELETE_USER_PROMPT
 
 async def prompt_delete_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Запрашивает подтверждение на удаление."""
     employee_id = update.message.text
-    user_to_delete = get_user_by_employee_id(employee_id)
+    user_to_delete = await db_async.get_user_by_employee_id(employee_id)
 
     if not user_to_delete:
         await update.message.reply_text(
             f"Сотрудник с табельным номером '{employee_id}' не найден."
-            f"Сотрудник с табельным номером `{employee_id}` не найден.",
-            parse_mode='MarkdownV2'
         )
         await show_main_menu(update, context)
         return ConversationHandler.END
@@ -1960,7 +3484,9 @@ async def confirm_delete_user(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     user_to_delete = context.user_data.pop('user_to_delete', None)
     if user_to_delete and 'id' in user_to_delete:
-        delete_user(user_to_delete['id'])
+        await db_async.delete_user(user_to_delete['id'])
+        # Незаконченный отчет удаленного сотрудника больше не нужен
+        context.application.drop_user_data(user_to_delete['id'])
         await update.message.reply_text(f"Сотрудник {user_to_delete.get('name', 'N/A')} успешно удален.")
     else:
         await update.message.reply_text("Не удалось найти данные для удаления. Пожалуйста, начните заново.")
@@ -1969,23 +3495,27 @@ async def confirm_delete_user(update: Update, context: ContextTypes.DEFAULT_TYPE
     return ConversationHandler.END
 
 # --- Функции администратора ---
+def get_not_submitted_employees(missing_ids):
+    """Возвращает [(user_id, first_name, last_name, employee_id, position)] для должников, по алфавиту."""
+    employees = []
+    for user_id in missing_ids:
+        info = user_directory.get(user_id)
+        if info is not None:
+            employees.append((user_id,) + info)
+    employees.sort(key=lambda emp: (emp[2] or "", emp[1] or ""))
+    return employees
+
 async def show_admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает статистику по сотрудникам, исключая администраторов."""
-    all_users = get_all_registered_users()
-    # Исключаем администраторов из общего списка для статистики
-    employees = [user for user in all_users if user[0] not in ADMIN_IDS]
-    
-    submitted_today_ids = get_users_submitted_today()
-    
-    # Считаем только сотрудников
-    submitted_employees_count = len([uid for uid in submitted_today_ids if uid not in ADMIN_IDS])
-    not_submitted_employees = [emp for emp in employees if emp[0] not in submitted_today_ids]
+    # Статистика берется из submission_tracker — без запросов к БД
+    today, submitted_employees_count, missing_ids = submission_tracker.snapshot()
+    not_submitted_employees = get_not_submitted_employees(missing_ids)
 
     text = (
-        f"📊 <b>Статистика на {date.today()}:</b>\n\n"
+        f"📊 <b>Статистика на {today}:</b>\n\n"
         f"✅ Отправили отчет: <b>{submitted_employees_count}</b>\n" 
         f"❌ Не отправили отчет: <b>{len(not_submitted_employees)}</b>\n"
-        f"👥 Всего сотрудников: <b>{len(employees)}</b>\n\n"
+        f"👥 Всего сотрудников: <b>{submitted_employees_count + len(not_submitted_employees)}</b>\n\n"
     )
 
     if not_submitted_employees:
@@ -1995,60 +3525,460 @@ async def show_admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text(text, parse_mode='HTML', reply_markup=admin_main_menu_keyboard())
 
-async def _send_reminders(context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Внутренняя функция для поиска и отправки напоминаний. Возвращает количество отправленных."""
-    all_users = get_all_registered_users()
-    employees = [user for user in all_users if user[0] not in ADMIN_IDS]
-    submitted_today_ids = get_users_submitted_today()
-    not_submitted_employees = [emp for emp in employees if emp[0] not in submitted_today_ids]
-
-    sent_count = 0
-    logger.info(f"Найдено {len(not_submitted_employees)} сотрудников для отправки напоминания.")
-    for user_id, _, _, _, _ in not_submitted_employees:
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="⏰ <b>Напоминание!</b>\nПожалуйста, не забудьте отправить ваш ежедневный отчет.",
-                parse_mode='HTML'
-            )
-            sent_count += 1
-            await asyncio.sleep(0.1) # Небольшая задержка, чтобы не перегружать API
-        except Exception as e:
-            logger.warning(f"Не удалось отправить напоминание пользователю {user_id}: {e}")
-    return sent_count
+async def _send_reminders(context: ContextTypes.DEFAULT_TYPE) -> BroadcastResult:
+    """Внутренняя функция для поиска и отправки напоминаний. Возвращает итоги рассылки."""
+    _, _, missing_ids = submission_tracker.snapshot()
+    logger.info(f"Найдено {len(missing_ids)} сотрудников для отправки напоминания.")
+    return await broadcast_engine.broadcast(
+        context.bot,
+        sorted(missing_ids),
+        text="⏰ <b>Напоминание!</b>\nПожалуйста, не забудьте отправить ваш ежедневный отчет.",
+        parse_mode='HTML'
+    )
 
 async def remind_all_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик ручного запуска рассылки напоминаний."""
     await update.message.reply_text("Начинаю рассылку напоминаний...")
-    sent_count = await _send_reminders(context)
+    result = await _send_reminders(context)
 
     await update.message.reply_text(
-        f"✅ Рассылка завершена.\nНапоминания отправлены <b>{sent_count}</b> сотрудникам.",
+        f"✅ Рассылка завершена.\n\n{result.summary_html()}",
         parse_mode='HTML',
         reply_markup=admin_main_menu_keyboard()
     )
 
-async def download_csv_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    all_reports = get_all_reports_for_csv()
-    if not all_reports:
-        await update.message.reply_text("В базе данных пока нет отчетов.", reply_markup=admin_main_menu_keyboard())
+async def show_db_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /dbstats: самые затратные SQL-запросы с момента запуска (/dbstats reset — обнулить)."""
+    if context.args and context.args[0] == "reset":
+        query_stats.reset()
+        await update.message.reply_text("Статистика SQL-запросов обнулена.")
+        return
+    top = query_stats.top()
+    if not top:
+        await update.message.reply_text("Статистика SQL-запросов пока пуста.")
         return
+    text = f"🐢 <b>Самые затратные SQL-запросы</b> (порог журнала: {DB_SLOW_QUERY_MS:g} мс)\n\n"
+    for sql, calls, total, avg, slowest in top:
+        short_sql = sql if len(sql) <= 200 else sql[:200] + "…"
+        text += (f"<b>{total * 1000:.0f} мс</b> всего, {calls} выз., ср. {avg * 1000:.2f} мс, макс. {slowest * 1000:.1f} мс\n"
+                 f"<code>{html.escape(short_sql)}</code>\n\n")
+    await update.message.reply_text(text, parse_mode='HTML')
 
-    output = io.StringIO()
-    writer = csv.writer(output, delimiter=';', quoting=csv.QUOTE_ALL)
-    headers, rows = get_all_reports_for_csv()
-    writer.writerow(headers)
-    for r in rows:
-        # Приводим значения к строкам, убираем переносы
-        cleaned = [str(x).replace("\n", " ").replace("\r", "") if x is not None else "" for x in r]
-        writer.writerow(cleaned)
+async def send_backup_file(bot, chat_id, result: BackupResult):
+    """Отправляет файл копии в чат, если он проходит по размеру для Bot API."""
+    if result.size > BACKUP_SEND_MAX_BYTES:
+        await bot.send_message(
+            chat_id, f"Файл копии больше {BACKUP_SEND_MAX_BYTES // 2**20} МБ, Telegram не даст его отправить. "
+                     f"Копия сохранена на сервере: {result.path}"
+        )
+        return
+    with open(result.path, "rb") as f:
+        await bot.send_document(chat_id=chat_id, document=f, filename=os.path.basename(result.path), write_timeout=300)
+
+async def backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /backup: внеочередная резервная копия БД; файл копии присылается в чат."""
+    message = await update.message.reply_text("⏳ Делаю резервную копию базы данных...")
+    try:
+        result = await db_async.create_backup()
+    except RuntimeError as e:
+        await message.edit_text(str(e))
+        return
+    except (sqlite3.Error, OSError) as e:
+        logger.error(f"Ошибка резервного копирования по команде /backup: {e}")
+        await message.edit_text(f"❌ Не удалось сделать резервную копию: {e}")
+        return
+    logger.info(f"Резервная копия по команде /backup: {result}")
+    await message.edit_text(result.summary_html(), parse_mode='HTML')
+    await send_backup_file(context.bot, update.effective_chat.id, result)
+
+def parse_summary_args(args):
+    """Аргументы /summary и /summary_users: [day|week|month] [ГГГГ-ММ-ДД] -> (период, начало периода)."""
+    period, day = "week", local_today()
+    for arg in args:
+        if arg.lower() in SUMMARY_PERIOD_ALIASES:
+            period = SUMMARY_PERIOD_ALIASES[arg.lower()]
+        else:
+            try:
+                day = datetime.strptime(arg, "%Y-%m-%d").date()
+            except ValueError:
+                raise ValueError(f"Не понимаю «{arg}». Формат: /summary [day|week|month] [ГГГГ-ММ-ДД]")
+    return period, summary_period_start(period, day)
+
+async def show_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /summary: итоги компании за день, неделю или месяц (по умолчанию — текущая неделя)."""
+    try:
+        period, start = parse_summary_args(context.args)
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return
+    previous_start = previous_period_start(period, start)
+    totals = await db_async.get_company_totals(period, start)
+    previous = await db_async.get_company_totals(period, previous_start) or {}
+    if totals is None:
+        await update.message.reply_text(f"За период {summary_period_label(period, start)} отчетов нет.")
+        return
+
+    text = (
+        f"📈 <b>Итоги: {summary_period_label(period, start)}</b>\n"
+        f"<i>В скобках — {summary_period_label(period, previous_start)}</i>\n\n"
+        f"Отчетов: <b>{totals['reports']}</b> ({previous.get('reports', 0)})\n\n"
+    )
+    for key, _ in NUMERIC_FIELDS:
+        text += f" - {FULL_FIELD_LABELS.get(key, key)}: <b>{totals[key]}</b> ({previous.get(key, 0)})\n"
+    text += "\nИтоги по каждому сотруднику: /summary_users с теми же параметрами."
+    await update.message.reply_text(text, parse_mode='HTML')
+
+async def send_summary_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /summary_users: CSV с итогами каждого сотрудника за период."""
+    try:
+        period, start = parse_summary_args(context.args)
+    except ValueError as e:
+        await update.message.reply_text(str(e).replace("/summary", "/summary_users"))
+        return
+    export = await db_async.build_user_totals_csv(period, start)
+    if export is None:
+        await update.message.reply_text(f"За период {summary_period_label(period, start)} отчетов нет.")
+        return
+    data, filename = export
+    await update.message.reply_document(
+        document=data, filename=filename, caption=f"Итоги по сотрудникам: {summary_period_label(period, start)}"
+    )
+
+SEARCH_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}|\d{1,2}\.\d{1,2}\.\d{4}")
+SEARCH_USAGE = (
+    "Использование: /search <слова> [дата или период]\n"
+    "Например: /search трансформатор 01.01.2024 31.03.2024"
+)
+
+def highlight_snippet(fragment):
+    return html.escape(fragment).replace(SEARCH_MATCH_START, "<b>").replace(SEARCH_MATCH_END, "</b>")
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /search: полнотекстовый поиск по переговорам и прочим вопросам с фильтром по датам."""
+    text = " ".join(context.args)
+    dates = SEARCH_DATE_RE.findall(text)
+    date_from = date_to = None
+    try:
+        if dates:
+            date_from, date_to = parse_date_range(" ".join(dates))
+    except ValueError as e:
+        await update.message.reply_text(f"{e}.\n\n{SEARCH_USAGE}")
+        return
+    fts_query = build_fts_query(SEARCH_DATE_RE.sub(" ", text))
+    if not fts_query:
+        await update.message.reply_text(SEARCH_USAGE)
+        return
+
+    try:
+        total, results = await db_async.search_reports(fts_query, date_from, date_to)
+    except sqlite3.OperationalError as e:
+        logger.error(f"Ошибка полнотекстового поиска по запросу {fts_query!r}: {e}")
+        await update.message.reply_text("Не удалось выполнить поиск.")
+        return
+    period = f" за {date_from:%d.%m.%Y}–{date_to:%d.%m.%Y}" if date_from else ""
+    if not results:
+        await update.message.reply_text(f"Ничего не найдено{period}.")
+        return
+
+    message_text = f"🔎 <b>Найдено отчетов: {total}</b>{period}"
+    if total > len(results):
+        message_text += f" (показаны {len(results)} самых подходящих)"
+    message_text += "\n\n"
+    for report_date, user_id, fragments in results:
+        info = user_directory.get(user_id) if user_directory.loaded else None
+        name = html.escape(f"{info[0]} {info[1]}") if info else f"ID {user_id}"
+        message_text += f"📅 <b>{report_date}</b> — {name}\n"
+        for (key, _), fragment in zip(TEXT_FIELDS, fragments):
+            if fragment:
+                message_text += f" - <i>{FULL_FIELD_LABELS.get(key, key)}:</i> {highlight_snippet(fragment)}\n"
+        message_text += "\n"
+    await update.message.reply_text(message_text, parse_mode='HTML')
+
+# --- Мастер выгрузки отчетов ---
+EXPORT_PERIODS = [
+    ("today", "Сегодня"),
+    ("week", "Эта неделя"),
+    ("last_week", "Прошлая неделя"),
+    ("month", "Этот месяц"),
+    ("last_month", "Прошлый месяц"),
+    ("all", "Всё время"),
+]
+
+EXPORT_CACHE_MAX_ENTRIES = 64
+EXPORT_CACHE_TTL = 24 * 3600   # сек: после этого файл формируется заново, даже если данные не менялись
+
+
+class ExportCache:
+    """
+    Кэш отправленных выгрузок: (формат, фильтр, имя файла) -> file_id документа в Telegram.
+    Запись действительна, пока не изменились данные (счетчик get_data_version) и не истек EXPORT_CACHE_TTL;
+    повторная выгрузка тех же данных — один sendDocument по file_id, без формирования и загрузки файла.
+    Работает только в event loop, поэтому без блокировок.
+    """
+
+    def __init__(self, max_entries=EXPORT_CACHE_MAX_ENTRIES, ttl=EXPORT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()   # key -> (версия данных, file_id, время отправки)
+
+    def get(self, key, version):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        cached_version, file_id, stored_at = entry
+        if cached_version != version or monotonic() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return file_id
+
+    def put(self, key, version, file_id):
+        # Данные изменились — записи со старой версией уже никогда не пригодятся
+        for stale_key in [k for k, (v, _, _) in self._entries.items() if v != version]:
+            del self._entries[stale_key]
+        self._entries[key] = (version, file_id, monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def discard(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+export_cache = ExportCache()
+
+def export_period_range(period, today):
+    """Возвращает (date_from, date_to) для предустановленного периода выгрузки."""
+    if period == "today":
+        return today, today
+    if period == "week":
+        return today - timedelta(days=today.weekday()), today
+    if period == "last_week":
+        start = today - timedelta(days=today.weekday() + 7)
+        return start, start + timedelta(days=6)
+    if period == "month":
+        return today.replace(day=1), today
+    if period == "last_month":
+        end = today.replace(day=1) - timedelta(days=1)
+        return end.replace(day=1), end
+    return None, None
+
+def parse_date_range(text):
+    """
+    Разбирает период из текста: одна или две даты в формате ДД.ММ.ГГГГ или ГГГГ-ММ-ДД.
+    Возвращает (date_from, date_to); при ошибке выбрасывает ValueError.
+    """
+    parts = re.findall(r"\d{4}-\d{2}-\d{2}|\d{1,2}\.\d{1,2}\.\d{4}", text)
+    if not 1 <= len(parts) <= 2:
+        raise ValueError("Нужно указать одну или две даты")
+    dates = [
+        datetime.strptime(p, "%Y-%m-%d").date() if "-" in p else datetime.strptime(p, "%d.%m.%Y").date()
+        for p in parts
+    ]
+    date_from, date_to = dates[0], dates[-1]
+    if date_from > date_to:
+        raise ValueError("Начало периода позже конца")
+    return date_from, date_to
+
+def _get_export_wizard(context: ContextTypes.DEFAULT_TYPE):
+    """Состояние мастера выгрузки в context.user_data."""
+    wizard = context.user_data.get('export_wizard')
+    if wizard is None:
+        wizard = {'period': 'all', 'date_from': None, 'date_to': None, 'employee_ids': [], 'positions': []}
+        context.user_data['export_wizard'] = wizard
+    return wizard
+
+def build_export_filter(wizard):
+    if wizard['period'] == 'custom':
+        date_from, date_to = wizard['date_from'], wizard['date_to']
+    else:
+        date_from, date_to = export_period_range(wizard['period'], local_today())
+    return ExportFilter(
+        date_from=date_from,
+        date_to=date_to,
+        employee_ids=frozenset(wizard['employee_ids']),
+        positions=frozenset(wizard['positions']),
+    )
+
+def build_export_menu_keyboard(wizard):
+    """Главное меню мастера выгрузки: период, фильтры и кнопка скачивания."""
+    keyboard = []
+    for i in range(0, len(EXPORT_PERIODS), 2):
+        row = []
+        for key, label in EXPORT_PERIODS[i:i+2]:
+            mark = "✅ " if wizard['period'] == key else ""
+            row.append(InlineKeyboardButton(f"{mark}{label}", callback_data=f"export|period|{key}"))
+        keyboard.append(row)
+    custom_mark = "✅ " if wizard['period'] == 'custom' else ""
+    keyboard.append([InlineKeyboardButton(f"{custom_mark}📅 Свой период", callback_data="export|custom_period")])
+    keyboard.append([
+        InlineKeyboardButton("👔 Должности", callback_data="export|positions"),
+        InlineKeyboardButton("🪪 Табельные номера", callback_data="export|employees"),
+    ])
+    keyboard.append([
+        InlineKeyboardButton("📥 Скачать CSV", callback_data="export|csv"),
+        InlineKeyboardButton("📊 Скачать Excel", callback_data="export|xlsx"),
+    ])
+    keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="export|cancel")])
+    return InlineKeyboardMarkup(keyboard)
+
+def build_export_positions_keyboard(wizard, positions):
+    """Подменю выбора должностей: нажатие включает/выключает должность."""
+    keyboard = []
+    for i, position in enumerate(positions):
+        mark = "✅ " if position in wizard['positions'] else ""
+        keyboard.append([InlineKeyboardButton(f"{mark}{position}", callback_data=f"export|pos|{i}")])
+    keyboard.append([
+        InlineKeyboardButton("Все должности", callback_data="export|pos_all"),
+        InlineKeyboardButton("⬅️ Готово", callback_data="export|menu"),
+    ])
+    return InlineKeyboardMarkup(keyboard)
+
+def export_menu_text(wizard):
+    return "📥 <b>Выгрузка отчетов</b>\n\n" + build_export_filter(wizard).describe()
+
+async def _refresh_export_menu(context: ContextTypes.DEFAULT_TYPE, chat_id):
+    """Перерисовывает сообщение мастера после ввода текста пользователем."""
+    wizard = _get_export_wizard(context)
+    try:
+        await context.bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=wizard['msg_id'],
+            text=export_menu_text(wizard),
+            parse_mode='HTML',
+            reply_markup=build_export_menu_keyboard(wizard),
+        )
+    except Exception as e:
+        logger.warning(f"Не удалось обновить меню выгрузки: {e}")
+
+async def download_csv_reports(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Запускает мастер выгрузки: администратор выбирает период, сотрудников и должности."""
+    context.user_data.pop('export_wizard', None)
+    wizard = _get_export_wizard(context)
+    msg = await update.message.reply_text(
+        export_menu_text(wizard), parse_mode='HTML', reply_markup=build_export_menu_keyboard(wizard)
+    )
+    wizard['msg_id'] = msg.message_id
+    return EXPORT_MENU
+
+async def callback_export_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """CallbackQueryHandler для кнопок мастера выгрузки."""
+    query = update.callback_query
+    await query.answer()
+    _, action, *args = query.data.split("|")
+    wizard = _get_export_wizard(context)
+
+    if action == "period":
+        wizard['period'] = args[0]
+    elif action == "custom_period":
+        await query.message.reply_text(
+            "Введите период: одну дату или две через дефис, например <code>01.09.2024 - 30.09.2024</code>.",
+            parse_mode='HTML'
+        )
+        return EXPORT_AWAIT_PERIOD
+    elif action == "employees":
+        await query.message.reply_text(
+            "Введите табельные номера через запятую или пробел. Отправьте <b>-</b>, чтобы выгружать всех.",
+            parse_mode='HTML'
+        )
+        return EXPORT_AWAIT_EMPLOYEE_IDS
+    elif action in ("positions", "pos", "pos_all"):
+        if action == "positions":
+            wizard['position_choices'] = sorted({u[4] for u in user_directory.all_users() if u[4]})
+        choices = wizard.get('position_choices', [])
+        if action == "pos" and int(args[0]) < len(choices):
+            position = choices[int(args[0])]
+            if position in wizard['positions']:
+                wizard['positions'].remove(position)
+            else:
+                wizard['positions'].append(position)
+        elif action == "pos_all":
+            wizard['positions'] = []
+        await query.edit_message_text(
+            export_menu_text(wizard), parse_mode='HTML',
+            reply_markup=build_export_positions_keyboard(wizard, choices)
+        )
+        return EXPORT_MENU
+    elif action == "cancel":
+        context.user_data.pop('export_wizard', None)
+        await query.edit_message_text("Выгрузка отменена.")
+        return ConversationHandler.END
+    elif action in ("csv", "xlsx"):
+        export_filter = build_export_filter(wizard)
+        context.user_data.pop('export_wizard', None)
+        # Версию данных берем до формирования файла: если отчеты изменятся в процессе,
+        # следующая выгрузка просто сформирует файл заново
+        version = await db_async.get_data_version()
+        cache_key = (action, export_filter, export_filter.filename(action))
+        file_id = export_cache.get(cache_key, version)
+        if file_id is not None:
+            try:
+                await context.bot.send_document(chat_id=query.from_user.id, document=file_id)
+            except BadRequest as e:
+                logger.warning(f"Не удалось отправить выгрузку из кэша, формирую заново: {e}")
+                export_cache.discard(cache_key)
+            else:
+                EXPORT_CACHE_REQUESTS.inc("hit")
+                await query.edit_message_text("✅ Файл с отчетами отправлен.\n\n" + export_filter.describe(), parse_mode='HTML')
+                return ConversationHandler.END
+        EXPORT_CACHE_REQUESTS.inc("miss")
+
+        await query.edit_message_text("⏳ Формирую файл...\n\n" + export_filter.describe(), parse_mode='HTML')
+        # Файл формируется в потоке-читателе, чтобы выгрузка не блокировала остальных пользователей
+        if action == "xlsx":
+            export = await db_async.build_reports_xlsx(export_filter)
+        else:
+            export = await db_async.build_reports_csv(export_filter)
+        if export is None:
+            await query.edit_message_text("Нет отчетов по выбранным условиям.\n\n" + export_filter.describe(), parse_mode='HTML')
+            return ConversationHandler.END
+
+        file_to_send, filename = export
+        try:
+            # Небольшая выгрузка остаётся в памяти, у такого SpooledTemporaryFile нет имени,
+            # и PTB не может принять его как файл — передаём содержимое байтами
+            document = file_to_send if file_to_send.name is not None else file_to_send.read()
+            message = await context.bot.send_document(chat_id=query.from_user.id, document=document, filename=filename)
+        finally:
+            file_to_send.close()
+        if message.document is not None:
+            export_cache.put(cache_key, version, message.document.file_id)
+        await query.edit_message_text("✅ Файл с отчетами отправлен.\n\n" + export_filter.describe(), parse_mode='HTML')
+        return ConversationHandler.END
+
+    await query.edit_message_text(
+        export_menu_text(wizard), parse_mode='HTML', reply_markup=build_export_menu_keyboard(wizard)
+    )
+    return EXPORT_MENU
+
+async def message_export_period(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Принимает произвольный период выгрузки."""
+    try:
+        date_from, date_to = parse_date_range(update.message.text)
+    except ValueError:
+        await update.message.reply_text(
+            "Не удалось разобрать период. Пример: 01.09.2024 - 30.09.2024", quote=True
+        )
+        return EXPORT_AWAIT_PERIOD
 
-    output.seek(0)
-    file_to_send = io.BytesIO(output.getvalue().encode('utf-8-sig')) # utf-8-sig для Excel
-    file_to_send.name = f'all_reports_{date.today()}.csv'
+    wizard = _get_export_wizard(context)
+    wizard.update(period='custom', date_from=date_from, date_to=date_to)
+    await _refresh_export_menu(context, update.effective_chat.id)
+    return EXPORT_MENU
 
-    await context.bot.send_document(chat_id=update.effective_user.id, document=file_to_send)
-    await update.message.reply_text("✅ Файл с отчетами отправлен.", reply_markup=admin_main_menu_keyboard())
+async def message_export_employee_ids(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Принимает список табельных номеров для выгрузки."""
+    text = update.message.text.strip()
+    wizard = _get_export_wizard(context)
+    if text in ("-", "все", "Все"):
+        wizard['employee_ids'] = []
+    else:
+        wizard['employee_ids'] = sorted({e for e in re.split(r"[\s,;]+", text) if e})
+    await _refresh_export_menu(context, update.effective_chat.id)
+    return EXPORT_MENU
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Отменяет текущий диалог."""
@@ -2071,12 +4001,17 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             "Вы можете использовать следующие команды через кнопки меню:\n"
             "📊 <b>Статистика за сегодня</b> - Показывает, кто сдал, а кто еще нет.\n"
             "🔔 <b>Напомнить всем</b> - Отправляет напоминание тем, кто не сдал отчет.\n"
-            "📥 <b>Скачать все отчеты (CSV)</b> - Формирует и отправляет вам файл со всеми отчетами.\n"
+            "📥 <b>Скачать все отчеты (CSV)</b> - Выгрузка отчетов в файл: за всё время или за выбранный период, по сотрудникам и должностям.\n"
             "👥 <b>Список сотрудников</b> - Показывает список всех зарегистрированных пользователей.\n"
             "🗑️ <b>Удалить сотрудника</b> - Запускает процесс удаления пользователя по табельному номеру.\n\n"
             "Также доступны команды:\n"
             "/start - Перезапуск бота и возврат в главное меню.\n"
-            "/cancel - Отмена текущего действия и возврат в главное меню."
+            "/cancel - Отмена текущего действия и возврат в главное меню.\n"
+            "/search <слова> [период] - Поиск по переговорам и прочим вопросам.\n"
+            "/summary [day|week|month] [ГГГГ-ММ-ДД] - Итоги компании за период (по умолчанию — текущая неделя).\n"
+            "/summary_users [day|week|month] [ГГГГ-ММ-ДД] - Итоги каждого сотрудника за период (CSV).\n"
+            "/dbstats - Самые затратные запросы к базе данных.\n"
+            "/backup - Резервная копия базы данных (файл придёт в этот чат)."
         )
     else:
         numeric_fields_info = "\n".join([f"• <i>{FULL_FIELD_LABELS.get(key, key)}</i>" for key, _ in NUMERIC_FIELDS])
@@ -2086,9 +4021,11 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             "ℹ️ <b>Справка для сотрудника</b>\n\n"
             "Используйте кнопки меню для взаимодействия с ботом:\n"
             "📝 <b>Отправить отчет</b> - Заполнить и отправить ваш ежедневный отчет.\n"
-            "📂 <b>Мои отчеты</b> - Просмотреть ваш последний отправленный отчет.\n\n"
+            "📂 <b>Мои отчеты</b> - История ваших отчетов (листайте кнопками ◀ / ▶) и итоги за неделю и месяц.\n\n"
             "<b>Как заполнять отчет:</b>\n"
-            "При нажатии на кнопку 'Отправить отчет' появится меню с полями. Нажмите на поле, чтобы ввести значение.\n\n"
+            "При нажатии на кнопку 'Отправить отчет' появится меню с полями. Нажмите на поле, чтобы ввести значение.\n"
+            "Быстрее — отправить все числа одним сообщением по порядку полей (например, <code>1 0 2 0 1 0 0 0 0 0 1 0 0 0</code>) "
+            "или парами <code>номер=значение</code>: кнопка '⚡ Ввести все числа одним сообщением'.\n\n"
             "<b>Числовые поля (нужно ввести = 1 или 2 или 3):</b>\n"
             f"{numeric_fields_info}\n"
             "Если по какому-то из этих пунктов нет данных, просто отправьте <b>0</b> или нажмите /skip.\n\n"
@@ -2103,8 +4040,19 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 async def scheduled_reminder_callback(context: ContextTypes.DEFAULT_TYPE) -> None:
     """Колбэк для автоматической отправки напоминаний по расписанию."""
     logger.info("Запуск автоматической рассылки напоминаний по расписанию.")
-    sent_count = await _send_reminders(context)
-    logger.info(f"Автоматическая рассылка завершена. Отправлено {sent_count} напоминаний.")
+    result = await _send_reminders(context)
+    logger.info(f"Автоматическая рассылка завершена: {result}")
+
+async def scheduled_backup_callback(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Колбэк резервного копирования БД по расписанию."""
+    try:
+        result = await db_async.create_backup()
+    except RuntimeError as e:
+        logger.warning(f"Резервное копирование по расписанию пропущено: {e}")
+        return
+    logger.info(f"Резервная копия по расписанию: {result}")
+    if BACKUP_CHAT_ID:
+        await send_backup_file(context.bot, BACKUP_CHAT_ID, result)
 
 async def handle_approval(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обрабатывает нажатия на кнопки одобрения/отклонения регистрации."""
@@ -2119,7 +4067,7 @@ async def handle_approval(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     if action == 'approve':
         # Проверяем, есть ли пользователь еще в списке ожидания
-        if not is_pending_approval(user_id):
+        if not await db_async.is_pending_approval(user_id):
             await query.edit_message_text(f"{original_text}\n\n<i>(Действие уже выполнено другим администратором)</i>", parse_mode='HTML')
             return
 
@@ -2137,9 +4085,7 @@ async def handle_approval(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     elif action == 'reject':
         # Удаляем пользователя из списка ожидания
-        with get_db_conn() as conn:
-            conn.cursor().execute("DELETE FROM pending_users WHERE user_id = ?", (user_id,))
-            conn.commit()
+        await db_async.remove_pending_user(user_id)
 
         try:
             await context.bot.send_message(
@@ -2152,8 +4098,287 @@ async def handle_approval(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             await query.edit_message_text(f"{original_text}\n\n<i>Не удалось уведомить пользователя. Возможно, он заблокировал бота.</i>", parse_mode='HTML')
 
 
+async def unknown_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обрабатывает любые сообщения, которые не были распознаны другими обработчиками."""
+    await update.message.reply_text(
+        "Я не понимаю эту команду. Пожалуйста, используйте кнопки в меню или введите /start для получения справки.",
+        reply_to_message_id=update.message.message_id,
+        parse_mode=None # Явно отключаем разбор Markdown/HTML
+    )
+
+
 # --- 5. ЗАПУСК БОТА ---
 
+# --- HTTP-сервер (вебхук и метрики) ---
+HTTP_MAX_BODY = 1024 * 1024       # максимальный размер тела запроса, байт
+HTTP_IDLE_TIMEOUT = 75            # сек: закрываем простаивающее keep-alive соединение
+WEBHOOK_QUEUE_SIZE = 1000         # максимум обновлений в очереди; дальше вебхук отвечает 503 и Telegram повторит позже
+WEBHOOK_ENQUEUE_TIMEOUT = 5       # сек: сколько ждать места в очереди, прежде чем ответить 503
+WEBHOOK_MAX_CONNECTIONS = 40      # сколько параллельных соединений разрешаем Telegram
+
+HTTP_REASONS = {
+    200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+    411: "Length Required", 413: "Payload Too Large", 503: "Service Unavailable",
+}
+
+
+class HttpServer:
+    """
+    Минимальный HTTP/1.1-сервер на asyncio без сторонних зависимостей: keep-alive, ограничение размера тела
+    и таймаут простоя. Подклассы реализуют dispatch(method, path, headers, body) -> (код, тело, заголовки),
+    где тело — dict (JSON), str (text/plain) или None.
+    """
+
+    description = "HTTP-сервер"
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        logger.info(f"{self.description} слушает {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_client(self, reader, writer):
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), HTTP_IDLE_TIMEOUT)
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await self._respond(writer, 400, keep_alive=False)
+                    break
+
+                headers = {}
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), HTTP_IDLE_TIMEOUT)
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                if "transfer-encoding" in headers:
+                    await self._respond(writer, 411, keep_alive=False)
+                    break
+                try:
+                    length = int(headers.get("content-length") or 0)
+                except ValueError:
+                    await self._respond(writer, 400, keep_alive=False)
+                    break
+                if length > HTTP_MAX_BODY:
+                    await self._respond(writer, 413, keep_alive=False)
+                    break
+                body = await asyncio.wait_for(reader.readexactly(length), HTTP_IDLE_TIMEOUT) if length else b""
+
+                status, payload, extra_headers = await self.dispatch(method, target.split("?", 1)[0], headers, body)
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                await self._respond(writer, status, payload, keep_alive, extra_headers, head_only=method == "HEAD")
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        except Exception as e:
+            logger.exception(f"Ошибка при обработке HTTP-запроса: {e}")
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def dispatch(self, method, path, headers, body):
+        raise NotImplementedError
+
+    @staticmethod
+    async def _respond(writer, status, payload=None, keep_alive=True, extra_headers=None, head_only=False):
+        if isinstance(payload, str):
+            body, content_type = payload.encode(), "text/plain; charset=utf-8"
+        elif payload is not None:
+            body, content_type = json.dumps(payload).encode(), "application/json"
+        else:
+            body, content_type = b"", None
+        extra_headers = dict(extra_headers or {})
+        content_type = extra_headers.pop("Content-Type", content_type)
+        lines = [
+            f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}",
+            f"Content-Length: {len(body)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        if content_type:
+            lines.append(f"Content-Type: {content_type}")
+        for name, value in extra_headers.items():
+            lines.append(f"{name}: {value}")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (b"" if head_only else body))
+        await writer.drain()
+
+
+# --- Режим вебхука ---
+class WebhookServer(HttpServer):
+    """
+    Минимальный HTTP/1.1-сервер на asyncio для приёма обновлений от Telegram без сторонних зависимостей.
+
+      POST <WEBHOOK_PATH> — обновление от Telegram; проверяется заголовок X-Telegram-Bot-Api-Secret-Token,
+                            обновление кладётся в application.update_queue. Если очередь заполнена дольше
+                            WEBHOOK_ENQUEUE_TIMEOUT секунд, отвечаем 503 — Telegram доставит обновление повторно.
+      GET  /healthz       — проверка живости для Render и мониторинга.
+
+    Для локальной проверки достаточно отправить сохранённое обновление (если в WEBHOOK_SECRET есть символы
+    кроме A-Z, a-z, 0-9, _ и -, в заголовке нужен его SHA-256, см. webhook_secret_token):
+        curl -X POST http://localhost:8080/webhook -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" -d @update.json
+    """
+
+    description = "Вебхук-сервер"
+
+    def __init__(self, application, secret, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH):
+        super().__init__(host, port)
+        self.application = application
+        self.secret = secret
+        self.path = path
+        self.received = 0
+        self.rejected = 0
+
+    async def dispatch(self, method, path, headers, body):
+        if path == "/healthz":
+            if method not in ("GET", "HEAD"):
+                return 405, None, {"Allow": "GET, HEAD"}
+            return 200, {
+                "status": "ok",
+                "mode": "webhook",
+                "update_queue": self.application.update_queue.qsize(),
+                "received": self.received,
+                "rejected": self.rejected,
+            }, None
+
+        if path != self.path:
+            return 404, None, None
+        if method != "POST":
+            return 405, None, {"Allow": "POST"}
+        token = headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token.encode(), self.secret.encode()):
+            logger.warning("Запрос на вебхук с неверным секретным токеном отклонён")
+            return 403, None, None
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except Exception as e:
+            logger.warning(f"Некорректное обновление на вебхуке: {e}")
+            return 400, None, None
+        if update is None:
+            return 400, None, None
+
+        try:
+            await asyncio.wait_for(self.application.update_queue.put(update), WEBHOOK_ENQUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            logger.warning(f"Очередь обновлений заполнена, обновление {update.update_id} отклонено (503)")
+            return 503, None, {"Retry-After": "1"}
+        self.received += 1
+        return 200, None, None
+
+
+# --- Эндпоинт метрик ---
+class MetricsServer(HttpServer):
+    """Отдаёт метрики в текстовом формате Prometheus: GET /metrics."""
+
+    description = "Эндпоинт метрик"
+
+    async def dispatch(self, method, path, headers, body):
+        if path != "/metrics":
+            return 404, None, None
+        if method not in ("GET", "HEAD"):
+            return 405, None, {"Allow": "GET, HEAD"}
+        return 200, metrics.render(), {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+WEBHOOK_SECRET_TOKEN_RE = re.compile(r"^[A-Za-z0-9_-]{1,256}$")
+
+def webhook_secret_token(secret):
+    """
+    Секрет в виде, который принимает setWebhook: только [A-Za-z0-9_-], до 256 символов.
+    Другие значения (Render generateValue выдаёт base64 с +, / и =) заменяются их SHA-256 в hex —
+    он одинаков при каждом запуске, поэтому вебхук, зарегистрированный прежним процессом, продолжает работать.
+    """
+    token = secret if WEBHOOK_SECRET_TOKEN_RE.match(secret) else hashlib.sha256(secret.encode()).hexdigest()
+    if not WEBHOOK_SECRET_TOKEN_RE.match(token):
+        raise ValueError("Недопустимый секрет вебхука: Telegram принимает только A-Z, a-z, 0-9, _ и - (до 256 символов).")
+    return token
+
+async def run_webhook(application: Application, secret: str) -> None:
+    """Запускает бота в режиме вебхука и работает до SIGINT/SIGTERM; secret — уже проверенный webhook_secret_token."""
+    server = WebhookServer(application, secret)
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows: остановка по Ctrl+C через KeyboardInterrupt
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        if WEBHOOK_URL:
+            # Вебхук при остановке не снимаем: пока сервис спит, Telegram копит обновления и будит его запросом
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=secret,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+            logger.info(f"Вебхук зарегистрирован: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        else:
+            logger.warning("WEBHOOK_URL не задан: вебхук в Telegram не регистрируется (режим локальной проверки).")
+        await application.start()
+        await server.start()
+        try:
+            await stop_event.wait()
+        finally:
+            await server.stop()
+            if application.running:
+                await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    finally:
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+metrics_server = None
+
+async def on_init(application: Application) -> None:
+    """Запускает локальный эндпоинт метрик."""
+    global metrics_server
+    UPDATE_QUEUE_SIZE.func = application.update_queue.qsize
+    if METRICS_PORT:
+        metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT)
+        try:
+            await metrics_server.start()
+        except OSError as e:
+            logger.error(f"Не удалось запустить эндпоинт метрик на {METRICS_HOST}:{METRICS_PORT}: {e}")
+            metrics_server = None
+
+async def on_stop(application: Application) -> None:
+    """Пока бот ещё доступен, выполняет отложенные обновления меню и удаления сообщений."""
+    await report_menu_refresher.flush_all()
+    await deletion_scheduler.flush_all()
+    if metrics_server:
+        await metrics_server.stop()
+
+async def on_shutdown(application: Application) -> None:
+    """Останавливает потоки работы с БД и закрывает соединения при остановке бота."""
+    query_stats.log_summary()
+    db_async.shutdown()
+    db_manager.close_all()
+
 def main() -> None:
     """Основная функция для запуска бота."""
     if not BOT_TOKEN:
@@ -2161,23 +4386,63 @@ def main() -> None:
         return
 
     init_db()
-    application = Application.builder().token(BOT_TOKEN).build()
+    load_caches()
+    if BOT_MODE not in ("polling", "webhook"):
+        logger.error(f"Неизвестный режим BOT_MODE='{BOT_MODE}'. Допустимые значения: polling, webhook.")
+        return
+
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .get_updates_request(InstrumentedRequest(connection_pool_size=1))
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .persistence(SQLitePersistence())
+        .post_init(on_init)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if BOT_MODE == "webhook":
+        # Ограниченная очередь: при перегрузке вебхук отвечает 503, а не копит обновления в памяти
+        builder = builder.update_queue(asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)).updater(None)
+    application = builder.build()
 
     # Настройка ежедневных автоматических напоминаний
-    try:
-        timezone = pytz.timezone(TIMEZONE_STR)
+    if TIMEZONE is not None:
         job_queue = application.job_queue
         # Запускать каждый день с понедельника (0) по пятницу (4) в 16:00
         job_queue.run_daily(
-            scheduled_reminder_callback,
-            time=time(hour=16, minute=0, tzinfo=timezone),
+            instrument_job(scheduled_reminder_callback),
+            time=time(hour=16, minute=0, tzinfo=TIMEZONE),
             days=(0, 1, 2, 3, 4)
         )
         logger.info(f"Запланирована ежедневная отправка напоминаний в 16:00 по часовому поясу {TIMEZONE_STR}")
-    except pytz.UnknownTimeZoneError:
+    else:
         logger.error(f"Неизвестный часовой пояс: '{TIMEZONE_STR}'. Автоматические напоминания не будут работать. "
                      f"Укажите корректный часовой пояс в .env файле (например, TIMEZONE=Asia/Tashkent).")
 
+    # Резервное копирование БД по расписанию; первая копия — вскоре после запуска
+    if BACKUP_INTERVAL_HOURS > 0:
+        application.job_queue.run_repeating(
+            instrument_job(scheduled_backup_callback),
+            interval=timedelta(hours=BACKUP_INTERVAL_HOURS),
+            first=timedelta(minutes=10),
+        )
+        logger.info(f"Запланировано резервное копирование БД каждые {BACKUP_INTERVAL_HOURS:g} ч в {BACKUP_DIR}")
+
+    register_handlers(application)
+    if BOT_MODE == "webhook":
+        try:
+            secret = webhook_secret_token(WEBHOOK_SECRET or secrets.token_urlsafe(32))
+        except ValueError as e:
+            logger.error(str(e))
+            return
+        asyncio.run(run_webhook(application, secret))
+    else:
+        application.run_polling()
+
+def register_handlers(application: Application) -> None:
+    """Регистрирует все обработчики бота в приложении."""
     # Основной обработчик, включающий все диалоги и кнопки
     conv_handler = ConversationHandler(
         entry_points=[
@@ -2185,6 +4450,7 @@ def main() -> None:
             # CommandHandler("start", start), # Для новых пользователей
             MessageHandler(filters.Regex("^📝 Отправить отчет$"), start_submit_report),
             MessageHandler(filters.Regex("^🗑️ Удалить сотрудника$"), start_delete_user),
+            MessageHandler(filters.Regex(r"^📥 Скачать все отчеты \(CSV\)$"), download_csv_reports),
             # Новая точка входа в регистрацию
             MessageHandler(filters.Regex("^🚀 Начать регистрацию$"), start_registration),
         ],
@@ -2205,25 +4471,43 @@ def main() -> None:
             ],
             
             # Состояния для нового процесса отчета
-            SHOW_REPORT_MENU: [CallbackQueryHandler(callback_report_menu)],
+            SHOW_REPORT_MENU: [
+                CallbackQueryHandler(callback_report_menu, pattern=r"^(field|action)\|"),
+                # Числа можно прислать и без кнопки «Ввести все числа»
+                MessageHandler(filters.Regex(BULK_INPUT_RE) & ~filters.COMMAND, message_bulk_values),
+            ],
             AWAITING_FIELD_VALUE: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, message_fill_field),
                 CommandHandler("skip", skip_field),
             ],
+            AWAITING_BULK_VALUES: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, message_bulk_values),
+                CallbackQueryHandler(callback_report_menu, pattern=r"^(field|action)\|"),
+            ],
 
             # Состояния удаления пользователя
             DELETE_USER_PROMPT: [MessageHandler(filters.TEXT & ~filters.COMMAND, prompt_delete_user)],
             DELETE_USER_CONFIRM: [
                 MessageHandler(filters.Regex("^(Да, удалить|Отмена)$"), confirm_delete_user),
             ],
+
+            # Состояния мастера выгрузки отчетов
+            EXPORT_MENU: [CallbackQueryHandler(callback_export_menu, pattern=r"^export\|")],
+            EXPORT_AWAIT_PERIOD: [MessageHandler(filters.TEXT & ~filters.COMMAND, message_export_period)],
+            EXPORT_AWAIT_EMPLOYEE_IDS: [MessageHandler(filters.TEXT & ~filters.COMMAND, message_export_employee_ids)],
         },
         fallbacks=[
             CommandHandler("cancel", cancel),
             # Этот обработчик ловит все варианты отмены и возврата в меню
             MessageHandler(filters.Regex("^(Отмена|⬅️ Назад в главное меню|Нет, вернуться в меню)$"), cancel),
+            # Обработчик для любых других сообщений внутри диалога
+            MessageHandler(filters.TEXT & ~filters.COMMAND, unknown_message_handler),
         ],
         # Этот флаг позволяет обработчикам вне ConversationHandler работать
-        allow_reentry=True
+        allow_reentry=True,
+        # Состояние диалога сохраняется в БД и переживает перезапуск бота
+        name="main_conversation",
+        persistent=True,
     )
 
     application.add_handler(conv_handler)
@@ -2231,19 +4515,96 @@ def main() -> None:
     application.add_handler(CommandHandler("start", start)) # Для существующих пользователей
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("menu", show_main_menu))
+    application.add_handler(CommandHandler("dbstats", show_db_stats, filters=filters.User(user_id=ADMIN_IDS)))
+    application.add_handler(CommandHandler("backup", backup_command, filters=filters.User(user_id=ADMIN_IDS)))
+    application.add_handler(CommandHandler("search", search_command, filters=filters.User(user_id=ADMIN_IDS)))
+    application.add_handler(CommandHandler("summary", show_summary, filters=filters.User(user_id=ADMIN_IDS)))
+    application.add_handler(CommandHandler("summary_users", send_summary_users, filters=filters.User(user_id=ADMIN_IDS)))
     application.add_handler(MessageHandler(filters.Regex("^📂 Мои отчеты$"), show_my_reports))
+    application.add_handler(CallbackQueryHandler(callback_history, pattern=r"^hist\|"))
     application.add_handler(MessageHandler(filters.Regex("^📊 Статистика за сегодня$"), show_admin_stats))
     application.add_handler(MessageHandler(filters.Regex(r"^🔔 Напомнить всем$"), remind_all_users))
-    application.add_handler(MessageHandler(filters.Regex(r"^📥 Скачать все отчеты \(CSV\)$"), download_csv_reports))
     application.add_handler(MessageHandler(filters.Regex(r"^👥 Список сотрудников$"), show_all_users))
     application.add_handler(MessageHandler(filters.Regex("^⬅️ Назад в главное меню$"), show_main_menu))
 
+    # Обработчик для кнопок одобрения/отклонения
+    application.add_handler(CallbackQueryHandler(handle_approval, pattern=r"^(approve|reject)\|"))
+
     # Обработчик для всех остальных сообщений (должен быть последним)
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, unknown_message_handler))
 
-
-    application.run_polling()
+    # Время работы и ошибки каждого обработчика попадают в метрики
+    instrument_handlers(application)
+
+
+def backup_cli(argv):
+    """Обслуживание БД из командной строки: python main.py backup | list | restore ФАЙЛ | purge-orphans."""
+    parser = argparse.ArgumentParser(prog="main.py", description="Резервные копии и обслуживание базы данных бота")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("backup", help="сделать резервную копию сейчас (бот может работать)")
+    commands.add_parser("list", help=f"показать копии в папке {BACKUP_DIR}")
+    restore = commands.add_parser("restore", help="восстановить БД из копии (бот должен быть остановлен)")
+    restore.add_argument("path", help="файл копии (.db или .db.gz); можно указать только имя файла из папки копий")
+    restore.add_argument("--yes", action="store_true", help="не спрашивать подтверждение")
+    purge = commands.add_parser(
+        "purge-orphans", help="удалить отчеты сотрудников, которых уже нет в базе (сначала делается копия)"
+    )
+    purge.add_argument("--yes", action="store_true", help="не спрашивать подтверждение")
+    args = parser.parse_args(argv)
+
+    if args.command == "backup":
+        print(f"Резервная копия готова: {backup_manager.create()}")
+    elif args.command == "list":
+        backups = backup_manager.list_backups()
+        if not backups:
+            print(f"В папке {BACKUP_DIR} нет резервных копий.")
+        for path in backups:
+            print(f"{os.path.basename(path)}\t{os.path.getsize(path) / 2**20:.1f} МБ")
+    elif args.command == "purge-orphans":
+        init_db()
+        with get_db_conn() as conn:
+            orphans = get_orphan_report_counts(conn.cursor())
+        if not orphans:
+            print("Отчетов удаленных сотрудников нет.")
+            return 0
+        for user_id, count in orphans:
+            print(f"{user_id}\t{count}")
+        if not args.yes:
+            total = sum(count for _, count in orphans)
+            answer = input(f"Удалить {total} отчетов {len(orphans)} сотрудников? Перед удалением будет сделана копия. [y/N] ")
+            if answer.strip().lower() not in ("y", "yes", "д", "да"):
+                print("Отменено.")
+                return 1
+        try:
+            purged = purge_orphan_reports()
+        except (sqlite3.Error, OSError, RuntimeError) as e:
+            print(f"Удаление не выполнено: {e}")
+            return 1
+        print(f"Удалены отчеты {len(purged)} сотрудников.")
+    else:
+        path = args.path
+        if not os.path.exists(path) and os.path.exists(os.path.join(BACKUP_DIR, path)):
+            path = os.path.join(BACKUP_DIR, path)
+        if not os.path.exists(path):
+            print(f"Файл {args.path} не найден.")
+            return 1
+        if not args.yes:
+            answer = input(f"Бот остановлен? Содержимое {DB_NAME} будет заменено копией {path}. Продолжить? [y/N] ")
+            if answer.strip().lower() not in ("y", "yes", "д", "да"):
+                print("Отменено.")
+                return 1
+        try:
+            previous = backup_manager.restore(path)
+        except (sqlite3.Error, OSError) as e:
+            print(f"Восстановление не выполнено: {e}")
+            return 1
+        if previous:
+            print(f"Прежняя БД сохранена: {previous.path}")
+        print(f"БД {DB_NAME} восстановлена из {path}.")
+    return 0
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(backup_cli(sys.argv[1:]))
     main()